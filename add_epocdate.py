@@ -1,11 +1,15 @@
 import os
+import argparse
 import pymysql
-from datetime import datetime, timedelta
+from timeutil import OFFSET_MINUTES, epoch_ms
 
 MYSQL_USER = os.environ.get("MYSQLUSER", "root")
 MYSQL_PASSWORD = os.environ.get("MYSQLPW", "")
 MYSQL_DB = os.environ.get("MYSQLDB", "test")
 
+# Rows updated per transaction in the Python path
+BATCH_SIZE = 1000
+
 mysql_conn = pymysql.connect(
     host="localhost",
     user=MYSQL_USER,
@@ -16,26 +20,95 @@ mysql_conn = pymysql.connect(
 )
 cur = mysql_conn.cursor()
 
-# Add epocdate column if it doesn't exist
-cur.execute("SHOW COLUMNS FROM treatments LIKE 'epocdate'")
-if not cur.fetchone():
-    cur.execute("ALTER TABLE treatments ADD COLUMN epocdate BIGINT DEFAULT NULL")
 
-# Fetch rows with created_at and mysqlid
-cur.execute("SELECT mysqlid, created_at FROM treatments")
-rows = cur.fetchall()
+def ensure_column():
+    # Add epocdate column if it doesn't exist
+    cur.execute("SHOW COLUMNS FROM treatments LIKE 'epocdate'")
+    if not cur.fetchone():
+        cur.execute("ALTER TABLE treatments ADD COLUMN epocdate BIGINT DEFAULT NULL")
+
+
+def backfill_python(only_missing=True):
+    """Compute epocdate in Python and write it in batched transactions."""
+    query = "SELECT mysqlid, created_at FROM treatments"
+    if only_missing:
+        query += " WHERE epocdate IS NULL AND created_at IS NOT NULL"
+    cur.execute(query)
+    rows = cur.fetchall()
 
-for mysqlid, created_at in rows:
-    epoch_ms = None
-    if created_at:
+    updates = [(epoch_ms(created_at, OFFSET_MINUTES), mysqlid) for mysqlid, created_at in rows]
+    if only_missing:
+        # Unparseable values stay NULL; skip rewriting them on every run.
+        updates = [update for update in updates if update[0] is not None]
+    for start in range(0, len(updates), BATCH_SIZE):
+        mysql_conn.begin()
         try:
-            dt = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
-            # Apply 120 minute offset to align with the expected timezone
-            dt += timedelta(minutes=120)
-            epoch_ms = int(dt.timestamp() * 1000)
+            cur.executemany(
+                "UPDATE treatments SET epocdate=%s WHERE mysqlid=%s",
+                updates[start:start + BATCH_SIZE],
+            )
+            mysql_conn.commit()
         except Exception:
-            epoch_ms = None
-    cur.execute("UPDATE treatments SET epocdate=%s WHERE mysqlid=%s", (epoch_ms, mysqlid))
+            mysql_conn.rollback()
+            raise
+    return len(updates)
+
+
+def backfill_sql():
+    """Fill missing epocdate values with a single UPDATE.
+
+    Handles the ISO-8601 forms Nightscout writes (``...Z`` or an explicit
+    ``+hh:mm`` offset, with or without milliseconds); other strings are left
+    NULL for the Python path.
+    """
+    cur.execute("SET time_zone = '+00:00'")
+    cur.execute(
+        f"""
+        UPDATE treatments
+        SET epocdate = (
+            UNIX_TIMESTAMP(
+                CONVERT_TZ(
+                    STR_TO_DATE(LEFT(created_at, 19), '%Y-%m-%dT%H:%i:%s'),
+                    IF(created_at LIKE '%Z', '+00:00', RIGHT(created_at, 6)),
+                    '+00:00'
+                )
+            )
+            + {OFFSET_MINUTES * 60}
+        ) * 1000
+            + IF(SUBSTRING(created_at, 20, 1) = '.', CAST(SUBSTRING(created_at, 21, 3) AS UNSIGNED), 0)
+        WHERE epocdate IS NULL
+          AND created_at REGEXP '^[0-9]{{4}}-[0-9]{{2}}-[0-9]{{2}}T[0-9]{{2}}:[0-9]{{2}}:[0-9]{{2}}(\\\\.[0-9]{{3}})?(Z|[+-][0-9]{{2}}:[0-9]{{2}})$'
+        """
+    )
+    return cur.rowcount
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill treatments.epocdate from created_at")
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help="Recompute every row instead of only rows where epocdate is NULL",
+    )
+    parser.add_argument(
+        "--sql",
+        action="store_true",
+        help="Compute missing values with one UPDATE using MySQL date functions",
+    )
+    args = parser.parse_args()
+
+    ensure_column()
+    if args.sql:
+        updated = backfill_sql()
+        # Anything the UPDATE could not parse falls back to Python.
+        updated += backfill_python()
+    else:
+        updated = backfill_python(only_missing=not args.all)
+    print(f"Updated {updated} treatments")
+
+    cur.close()
+    mysql_conn.close()
+
 
-cur.close()
-mysql_conn.close()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,536 @@
+"""Database backends: the MySQL server or an embedded SQLite/DuckDB file.
+
+Usage::
+
+    python backends.py copy sqlite:cgm.db       # copy entries/treatments from MySQL
+    python backends.py copy duckdb:cgm.duckdb
+
+Scripts taking ``--db`` (default: the CGM_DB environment variable, else
+``mysql``) open their connection with connect():
+
+- ``mysql`` – the server from the MYSQL* variables
+- ``sqlite:PATH`` – an SQLite file (standard library)
+- ``duckdb:PATH`` – a DuckDB file (needs the duckdb package, and pyarrow
+  for fast batched inserts)
+
+Embedded connections take the same ``%s`` placeholders as pymysql. SQL that
+differs between the engines goes through the Backend of a cursor
+(backend_of()): replace_into(), insert_ignore() and upsert() stand for
+REPLACE INTO, INSERT IGNORE and ON DUPLICATE KEY UPDATE, has_column() for
+SHOW COLUMNS, and ddl() rewrites the MySQL CREATE/ALTER TABLE statements
+(ENUM, AUTO_INCREMENT, KEY clauses, table options). The embedded engines
+have no ON UPDATE CURRENT_TIMESTAMP, so ``modified_at`` does not track
+edits there; new rows are still picked up by id.
+"""
+
+import os
+import re
+import sys
+import argparse
+from abc import ABC, abstractmethod
+from datetime import date, datetime
+
+MYSQL_HOST = os.environ.get("MYSQLHOST", "localhost")
+MYSQL_USER = os.environ.get("MYSQLUSER", "root")
+MYSQL_PASSWORD = os.environ.get("MYSQLPW", "")
+MYSQL_DB = os.environ.get("MYSQLDB", "test")
+
+DEFAULT_DB = os.environ.get("CGM_DB", "mysql")
+
+# Rows per batch when copying the raw tables
+COPY_BATCH = 5000
+
+# Raw tables an embedded database needs for create_star_schema.py, as
+# written by mongo_to_mysql.py (only the columns the transforms read).
+RAW_TABLES = {
+    "entries": (
+        """
+        CREATE TABLE IF NOT EXISTS entries (
+            mysqlid INT PRIMARY KEY,
+            date DOUBLE DEFAULT NULL,
+            sgv INT DEFAULT NULL,
+            delta DOUBLE DEFAULT NULL,
+            direction TEXT DEFAULT NULL
+        )
+        """,
+        ["mysqlid", "date", "sgv", "delta", "direction"],
+    ),
+    "treatments": (
+        """
+        CREATE TABLE IF NOT EXISTS treatments (
+            mysqlid INT PRIMARY KEY,
+            created_at TEXT DEFAULT NULL,
+            epocdate BIGINT DEFAULT NULL,
+            eventType TEXT DEFAULT NULL,
+            carbs DOUBLE DEFAULT NULL,
+            protein DOUBLE DEFAULT NULL,
+            fat DOUBLE DEFAULT NULL,
+            insulinInjections TEXT DEFAULT NULL,
+            notes TEXT DEFAULT NULL
+        )
+        """,
+        ["mysqlid", "created_at", "epocdate", "eventType", "carbs", "protein", "fat", "insulinInjections", "notes"],
+    ),
+}
+
+
+def split_top_level(text):
+    """Split *text* on commas outside parentheses and quotes."""
+    parts, depth, quoted, current = [], 0, False, []
+    for char in text:
+        if char == "'":
+            quoted = not quoted
+        elif not quoted and char == "(":
+            depth += 1
+        elif not quoted and char == ")":
+            depth -= 1
+        elif not quoted and depth == 0 and char == ",":
+            parts.append("".join(current).strip())
+            current = []
+            continue
+        current.append(char)
+    if "".join(current).strip():
+        parts.append("".join(current).strip())
+    return parts
+
+
+class MySQLBackend:
+    name = "mysql"
+    now = "NOW()"
+
+    def connect(self, **kwargs):
+        # Imported here so the embedded backends work without pymysql.
+        import pymysql
+
+        return pymysql.connect(
+            host=MYSQL_HOST,
+            user=MYSQL_USER,
+            password=MYSQL_PASSWORD,
+            database=MYSQL_DB,
+            charset="utf8mb4",
+            autocommit=True,
+            **kwargs,
+        )
+
+    @staticmethod
+    def _values(table, columns):
+        return f"{table} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})"
+
+    def replace_into(self, table, columns):
+        """Insert rows, replacing any with the same primary or unique key."""
+        return f"REPLACE INTO {self._values(table, columns)}"
+
+    def insert_ignore(self, table, columns, keys):
+        """Insert rows, skipping those where the unique *keys* already exist."""
+        return f"INSERT IGNORE INTO {self._values(table, columns)}"
+
+    def upsert(self, table, columns, keys):
+        """Insert rows, updating the non-key columns where *keys* match."""
+        updates = ", ".join(f"{c}=VALUES({c})" for c in columns if c not in keys)
+        return f"INSERT INTO {self._values(table, columns)} ON DUPLICATE KEY UPDATE {updates}"
+
+    def has_column(self, cur, table, column):
+        cur.execute(f"SHOW COLUMNS FROM {table} LIKE %s", (column,))
+        return cur.fetchone() is not None
+
+    def ddl(self, statement):
+        """Return the statements creating or altering a table on this backend."""
+        return [statement]
+
+    def stream(self, conn, query, params, chunk_size):
+        """Yield lists of at most *chunk_size* rows of *query*.
+
+        Reads through an unbuffered cursor on a separate connection, so
+        *conn* can keep writing while the rows arrive.
+        """
+        import pymysql.cursors
+
+        read_conn = self.connect(cursorclass=pymysql.cursors.SSCursor)
+        try:
+            with read_conn.cursor() as src:
+                # The server waits on us while we write each chunk.
+                src.execute("SET SESSION net_write_timeout = 3600")
+                src.execute(query, params or None)
+                while True:
+                    rows = src.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    yield rows
+        finally:
+            read_conn.close()
+
+
+class EmbeddedBackend(MySQLBackend, ABC):
+    """SQL shared by SQLite and DuckDB."""
+
+    now = "CURRENT_TIMESTAMP"
+    # Column clauses MySQL accepts that the embedded engines do not
+    dropped_column_sql = [r"\s+ON UPDATE CURRENT_TIMESTAMP", r"\s+UNSIGNED", r"\s+(?:AFTER \w+|FIRST)$"]
+
+    def __init__(self, path):
+        self.path = path
+
+    def replace_into(self, table, columns):
+        return f"INSERT OR REPLACE INTO {self._values(table, columns)}"
+
+    def insert_ignore(self, table, columns, keys):
+        # Naming the key keeps DuckDB from checking every unique index per row.
+        return f"INSERT INTO {self._values(table, columns)} ON CONFLICT ({', '.join(keys)}) DO NOTHING"
+
+    def upsert(self, table, columns, keys):
+        updates = ", ".join(f"{c}=excluded.{c}" for c in columns if c not in keys)
+        return f"INSERT INTO {self._values(table, columns)} ON CONFLICT ({', '.join(keys)}) DO UPDATE SET {updates}"
+
+    def has_column(self, cur, table, column):
+        cur.execute(f"SELECT 1 FROM pragma_table_info('{table}') WHERE name = %s", (column,))
+        return cur.fetchone() is not None
+
+    def column(self, definition):
+        definition = re.sub(r"\bENUM\s*\([^)]*\)", "VARCHAR(32)", definition, flags=re.I)
+        definition = re.sub(r"\b(INT|BIGINT)\(\d+\)", r"\1", definition, flags=re.I)
+        for pattern in self.dropped_column_sql:
+            definition = re.sub(pattern, "", definition, flags=re.I)
+        return definition
+
+    @abstractmethod
+    def serial(self, table, name):
+        """Return ``(statements to run first, column definition)`` for an
+        auto-numbered primary key column."""
+
+    def added_column(self, definition):
+        """Column definition for ALTER TABLE ADD COLUMN."""
+        # Neither engine can add a NOT NULL column to existing rows.
+        return re.sub(r"\s+NOT NULL", "", self.column(definition), flags=re.I)
+
+    def index(self, table, name, columns, unique=False):
+        # Index names are global here, not per table as in MySQL.
+        kind = "UNIQUE INDEX" if unique else "INDEX"
+        return f"CREATE {kind} IF NOT EXISTS {table}_{name} ON {table} {columns}"
+
+    def ddl(self, statement):
+        sql = " ".join(statement.split())
+        create = re.match(r"CREATE TABLE (IF NOT EXISTS )?(\w+) \((.*)\)[^)]*$", sql, re.I)
+        if create:
+            return self.create_table(create.group(2), create.group(3))
+        alter = re.match(r"ALTER TABLE (\w+) (.*)$", sql, re.I)
+        if alter:
+            return self.alter_table(alter.group(1), alter.group(2))
+        return [statement]
+
+    def create_table(self, table, body):
+        items = split_top_level(body)
+        serial = None
+        for item in items:
+            if re.search(r"\bAUTO_INCREMENT\b", item, re.I):
+                serial = item.split()[0]
+        before, columns, after = [], [], []
+        for item in items:
+            upper = item.upper()
+            if upper.startswith("FOREIGN KEY"):
+                continue
+            if upper.startswith("PRIMARY KEY"):
+                if serial is None or item[item.index("("):].strip("() ") != serial:
+                    columns.append(item)
+                continue
+            unique = re.match(r"UNIQUE (?:KEY|INDEX) \w+ (\(.*\))$", item, re.I)
+            if unique:
+                columns.append(f"UNIQUE {unique.group(1)}")
+                continue
+            key = re.match(r"(?:KEY|INDEX) (\w+) (\(.*\))$", item, re.I)
+            if key:
+                after.append(self.index(table, key.group(1), key.group(2)))
+                continue
+            if item.split()[0] == serial:
+                statements, definition = self.serial(table, serial)
+                before += statements
+                columns.append(definition)
+                continue
+            columns.append(self.column(item))
+        return before + [f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(columns)})"] + [sql for sql in after if sql]
+
+    def alter_table(self, table, clauses):
+        statements = []
+        for clause in split_top_level(clauses):
+            index = re.match(r"ADD (UNIQUE )?(?:KEY|INDEX) (\w+) (\(.*\))$", clause, re.I)
+            if index:
+                sql = self.index(table, index.group(2), index.group(3), bool(index.group(1)))
+                if sql:
+                    statements.append(sql)
+                continue
+            column = re.match(r"ADD COLUMN (.*)$", clause, re.I)
+            if column:
+                statements.append(f"ALTER TABLE {table} ADD COLUMN {self.added_column(column.group(1))}")
+                continue
+            statements.append(f"ALTER TABLE {table} {clause}")
+        return statements
+
+    def stream(self, conn, query, params, chunk_size):
+        """Yield lists of rows from a reader cursor of *conn*."""
+        src = conn.reader()
+        try:
+            src.execute(query, params or None)
+            while True:
+                rows = src.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            src.close()
+
+
+class SQLiteBackend(EmbeddedBackend):
+    name = "sqlite"
+
+    def connect(self, **kwargs):
+        import sqlite3
+
+        sqlite3.register_adapter(date, date.isoformat)
+        sqlite3.register_adapter(datetime, lambda value: value.isoformat(" "))
+        sqlite3.register_converter("DATE", lambda raw: date.fromisoformat(raw.decode()))
+        for name in ("DATETIME", "TIMESTAMP"):
+            sqlite3.register_converter(name, lambda raw: datetime.fromisoformat(raw.decode()))
+        conn = sqlite3.connect(self.path, isolation_level=None, detect_types=sqlite3.PARSE_DECLTYPES)
+        # Readers do not block the writer (stream() reads while facts are written).
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return EmbeddedConnection(self, conn)
+
+    def serial(self, table, name):
+        return [], f"{name} INTEGER PRIMARY KEY AUTOINCREMENT"
+
+    def added_column(self, definition):
+        # SQLite only adds columns with a constant default.
+        definition = super().added_column(definition)
+        return re.sub(r"\s+DEFAULT CURRENT_TIMESTAMP", "", definition, flags=re.I)
+
+
+class DuckDBBackend(EmbeddedBackend):
+    name = "duckdb"
+    # CURRENT_TIMESTAMP carries a time zone, which needs pytz in Python.
+    now = "CAST(now() AS TIMESTAMP)"
+
+    def connect(self, **kwargs):
+        import duckdb
+
+        return EmbeddedConnection(self, duckdb.connect(self.path))
+
+    def index(self, table, name, columns, unique=False):
+        # Min/max zone maps already prune range scans, and an ART index on a
+        # column makes ON CONFLICT updates of it fail, so only unique keys
+        # become indexes.
+        return super().index(table, name, columns, unique) if unique else None
+
+    def serial(self, table, name):
+        sequence = f"{table}_{name}_seq"
+        return (
+            [f"CREATE SEQUENCE IF NOT EXISTS {sequence}"],
+            f"{name} BIGINT PRIMARY KEY DEFAULT nextval('{sequence}')",
+        )
+
+
+class EmbeddedConnection:
+    """DB-API connection wrapper whose cursors accept ``%s`` placeholders.
+
+    Statements run in autocommit mode like the MySQL connections; begin(),
+    commit() and rollback() group them into a transaction.
+    """
+
+    def __init__(self, backend, conn):
+        self.backend = backend
+        self.conn = conn
+
+    def cursor(self, *args):
+        if self.backend.name == "duckdb":
+            # A DuckDB cursor is a second connection outside our transaction.
+            return EmbeddedCursor(self.backend, self.conn, owned=False)
+        return EmbeddedCursor(self.backend, self.conn.cursor())
+
+    def reader(self):
+        """Cursor for reading while cursor() keeps writing."""
+        return EmbeddedCursor(self.backend, self.conn.cursor())
+
+    def begin(self):
+        self.conn.execute("BEGIN")
+
+    def commit(self):
+        self.conn.execute("COMMIT")
+
+    def rollback(self):
+        self.conn.execute("ROLLBACK")
+
+    def close(self):
+        self.conn.close()
+
+
+class EmbeddedCursor:
+    # A VALUES list of placeholders only, as written by executemany() callers
+    VALUES = re.compile(r"\bVALUES\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.I)
+
+    def __init__(self, backend, cursor, owned=True):
+        self.backend = backend
+        self.cursor = cursor
+        self.owned = owned
+
+    @staticmethod
+    def placeholders(query):
+        # pymysql interpolates "%s" and "%%" only when parameters are given.
+        return re.sub(r"%([s%])", lambda m: "?" if m.group(1) == "s" else "%", query)
+
+    def execute(self, query, params=None):
+        if params is None:
+            self.cursor.execute(query)
+        else:
+            self.cursor.execute(self.placeholders(query), list(params))
+        return self
+
+    def executemany(self, query, rows):
+        rows = [tuple(row) for row in rows]
+        if not rows:
+            return self
+        query = self.placeholders(query)
+        values = self.VALUES.search(query)
+        if self.backend.name == "duckdb" and values:
+            try:
+                import pyarrow as pa
+            except ImportError:
+                pa = None
+            if pa is not None:
+                # Binding Python values one statement at a time is very slow
+                # in DuckDB; insert the whole batch from an Arrow table.
+                batch = pa.table({f"c{i}": pa.array(list(column)) for i, column in enumerate(zip(*rows))})
+                self.cursor.register("_batch", batch)
+                try:
+                    self.cursor.execute(query[: values.start()] + "SELECT * FROM _batch" + query[values.end():])
+                finally:
+                    self.cursor.unregister("_batch")
+                return self
+        if self.backend.name == "sqlite" and not self.cursor.connection.in_transaction:
+            # Autocommit would commit every row; commit the batch once instead.
+            self.cursor.execute("BEGIN")
+            try:
+                self.cursor.executemany(query, rows)
+            except Exception:
+                self.cursor.execute("ROLLBACK")
+                raise
+            self.cursor.execute("COMMIT")
+            return self
+        self.cursor.executemany(query, rows)
+        return self
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        return tuple(row) if row is not None else None
+
+    def fetchall(self):
+        return [tuple(row) for row in self.cursor.fetchall()]
+
+    def fetchmany(self, size):
+        return [tuple(row) for row in self.cursor.fetchmany(size)]
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    @property
+    def rowcount(self):
+        return getattr(self.cursor, "rowcount", -1)
+
+    @property
+    def lastrowid(self):
+        return getattr(self.cursor, "lastrowid", None)
+
+    def close(self):
+        if self.owned:
+            self.cursor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+MYSQL = MySQLBackend()
+
+
+def backend_for(url=None):
+    """Return the Backend for a ``--db`` value."""
+    url = url or DEFAULT_DB
+    kind, _, path = url.partition(":")
+    if kind == "mysql":
+        return MYSQL
+    if kind in ("sqlite", "duckdb") and path:
+        return (SQLiteBackend if kind == "sqlite" else DuckDBBackend)(path)
+    raise ValueError(f"Unknown database {url!r}; use mysql, sqlite:PATH or duckdb:PATH")
+
+
+def connect(url=None, **kwargs):
+    return backend_for(url).connect(**kwargs)
+
+
+def backend_of(cur):
+    """Return the Backend a cursor belongs to."""
+    return getattr(cur, "backend", MYSQL)
+
+
+def run_ddl(cur, statement):
+    """Execute a MySQL CREATE/ALTER TABLE statement on *cur*'s backend."""
+    for sql in backend_of(cur).ddl(statement):
+        cur.execute(sql)
+
+
+def number(value):
+    """Numeric value of a raw column MySQL stores as text (protein, fat)."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def copy_raw_tables(dest, source=None, batch=COPY_BATCH):
+    """Copy the raw tables create_star_schema.py reads from *source* into
+    *dest*, replacing rows with the same ``mysqlid``. Returns rows copied."""
+    src_backend = backend_for(source)
+    src_conn = src_backend.connect()
+    dest_cur = dest.cursor()
+    copied = 0
+    try:
+        for table, (create, columns) in RAW_TABLES.items():
+            run_ddl(dest_cur, create)
+            insert = backend_of(dest_cur).replace_into(table, columns)
+            numeric = [columns.index(c) for c in ("protein", "fat") if c in columns]
+            query = f"SELECT {', '.join(columns)} FROM {table}"
+            for rows in src_backend.stream(src_conn, query, (), batch):
+                if numeric:
+                    rows = [
+                        tuple(number(v) if i in numeric else v for i, v in enumerate(row))
+                        for row in rows
+                    ]
+                dest_cur.executemany(insert, rows)
+                copied += len(rows)
+    finally:
+        dest_cur.close()
+        src_conn.close()
+    return copied
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage embedded copies of the CGM database")
+    sub = parser.add_subparsers(dest="command", required=True)
+    copy = sub.add_parser("copy", help="Copy entries and treatments into an embedded database")
+    copy.add_argument("dest", help="Target database, e.g. sqlite:cgm.db or duckdb:cgm.duckdb")
+    copy.add_argument("--source", default="mysql", help="Database to copy from (default: mysql)")
+    args = parser.parse_args(argv)
+
+    try:
+        dest = connect(args.dest)
+    except ValueError as exc:
+        parser.error(str(exc))
+    copied = copy_raw_tables(dest, args.source)
+    dest.close()
+    print(f"Copied {copied} rows to {args.dest}; build the star schema with "
+          f"create_star_schema.py --db {args.dest}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,153 @@
+"""Compare the star-schema build and compute_metrics.py on each database backend.
+
+Usage::
+
+    python benchmark_backends.py [--dir bench_db] [--backends mysql sqlite duckdb] [--repeat 3]
+
+The raw tables are copied from --source (default MySQL) into a fresh SQLite
+and DuckDB file under --dir, and ``create_star_schema.py --db`` builds the
+star schema in each. The MySQL star schema is only rebuilt for timing with
+``--rebuild-mysql``. compute_metrics.py then runs with the default windows on
+every backend, timing load_data() with the NumPy engine and the per-meal SQL
+engine (best of --repeat), and checks the results agree with the first
+backend.
+"""
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+from backends import backend_for, connect, copy_raw_tables
+from compute_metrics import DEFAULT_SETTINGS, as_plain, compute_metrics, fetch_meals, load_data, sql_stats
+
+DEFAULT_DIR = "bench_db"
+DEFAULT_REPEAT = 3
+
+FILES = {"sqlite": "cgm.db", "duckdb": "cgm.duckdb"}
+
+
+def db_url(name, directory):
+    return name if name == "mysql" else f"{name}:{os.path.join(directory, FILES[name])}"
+
+
+def remove_database(path):
+    for suffix in ("", ".wal", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def timed(func, repeat):
+    """Return ``(result, best seconds)`` of *repeat* calls of *func*."""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def build(url, source):
+    """Copy the raw tables into *url* (embedded only) and build the star
+    schema in a separate process. Returns ``(copy seconds, build seconds)``."""
+    copy_elapsed = None
+    if url != "mysql":
+        remove_database(backend_for(url).path)
+        started = time.perf_counter()
+        conn = connect(url)
+        copy_raw_tables(conn, source)
+        conn.close()
+        copy_elapsed = time.perf_counter() - started
+    started = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "create_star_schema.py", "--db", url],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    return copy_elapsed, time.perf_counter() - started
+
+
+def run_metrics(url, repeat):
+    """Time compute_metrics on *url*; return the timings and the stats."""
+    conn = connect(url)
+    cur = conn.cursor()
+    settings = DEFAULT_SETTINGS
+    data, load_elapsed = timed(lambda: load_data(cur, settings=[settings]), repeat)
+    stats, numpy_elapsed = timed(lambda: compute_metrics(data, **settings), repeat)
+
+    def sql_engine():
+        return sql_stats(cur, fetch_meals(cur, settings["time_window"]), settings)
+
+    expected, sql_elapsed = timed(sql_engine, repeat)
+    cur.close()
+    conn.close()
+    if as_plain(expected) != as_plain(stats):
+        raise SystemExit(f"{url}: the SQL and NumPy engines disagree")
+    return {"load": load_elapsed, "numpy": numpy_elapsed, "sql": sql_elapsed, "meals": len(data["meals"])}, stats
+
+
+def seconds(value):
+    return "-" if value is None else f"{value:.2f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the star-schema build and metrics per backend")
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        choices=["mysql", "sqlite", "duckdb"],
+        default=["mysql", "sqlite", "duckdb"],
+        help="Backends to compare (default: all)",
+    )
+    parser.add_argument(
+        "--dir",
+        default=DEFAULT_DIR,
+        help=f"Directory for the embedded database files (default: {DEFAULT_DIR})",
+    )
+    parser.add_argument(
+        "--source",
+        default="mysql",
+        help="Database the raw tables are copied from (default: mysql)",
+    )
+    parser.add_argument(
+        "--rebuild-mysql",
+        action="store_true",
+        help="Also time a full star-schema build in MySQL (rewrites its fact tables)",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=DEFAULT_REPEAT,
+        help=f"Runs per metrics timing, best one reported (default: {DEFAULT_REPEAT})",
+    )
+    args = parser.parse_args()
+
+    os.makedirs(args.dir, exist_ok=True)
+    rows = []
+    reference = None
+    for name in args.backends:
+        url = db_url(name, args.dir)
+        copy_elapsed = build_elapsed = None
+        if name != "mysql" or args.rebuild_mysql:
+            copy_elapsed, build_elapsed = build(url, args.source)
+        timings, stats = run_metrics(url, args.repeat)
+        if reference is None:
+            reference = (name, as_plain(stats))
+        elif as_plain(stats) != reference[1]:
+            print(f"warning: {name} metrics differ from {reference[0]}")
+        size = os.path.getsize(backend_for(url).path) if name != "mysql" else None
+        rows.append((name, copy_elapsed, build_elapsed, timings, size))
+
+    print(f"{'backend':<8} {'copy s':>8} {'build s':>8} {'load s':>8} {'numpy s':>8} {'sql s':>8} {'meals':>7} {'size MB':>8}")
+    for name, copy_elapsed, build_elapsed, timings, size in rows:
+        print(
+            f"{name:<8} {seconds(copy_elapsed):>8} {seconds(build_elapsed):>8} "
+            f"{seconds(timings['load']):>8} {seconds(timings['numpy']):>8} {seconds(timings['sql']):>8} "
+            f"{timings['meals']:>7} {'-' if size is None else f'{size / 1e6:.1f}':>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
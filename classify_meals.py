@@ -1,5 +1,8 @@
 import os
+import argparse
+from bisect import bisect_left
 import pymysql
+from migrations import bump_data_version, migrate
 
 MYSQL_HOST = os.environ.get("MYSQLHOST", "localhost")
 MYSQL_USER = os.environ.get("MYSQLUSER", "root")
@@ -24,35 +27,99 @@ def ensure_column():
             "ALTER TABLE fact_meal ADD COLUMN classification ENUM('hypo','snack','meal')"
         )
 
-def classify(carbs, protein, fat, ts):
+# Insulin within this many seconds either side of a meal counts as covering it
+INSULIN_WINDOW = 2700
+
+
+def classify(carbs, protein, fat, has_insulin):
     """Return meal classification based on macros and insulin timing."""
 
     c = carbs or 0
     p = protein or 0
     f = fat or 0
 
-    # Check for insulin injections within 30 minutes of the meal
-    cur.execute(
-        "SELECT 1 FROM fact_insulin WHERE ts BETWEEN %s AND %s LIMIT 1",
-        (ts - 2700, ts + 2700),
-    )
-    has_insulin = cur.fetchone() is not None
-
     if (c < 4 and p == 0 and f == 0) or (c > 0 and not has_insulin):
         return "hypo"
     if 4 < c < 7:
         return "snack"
     return "meal"
 
-def main():
-    ensure_column()
-    cur.execute("SELECT treatment_id, carbs, protein, fat, ts FROM fact_meal")
-    for tid, carbs, protein, fat, ts in cur.fetchall():
-        category = classify(carbs, protein, fat, ts)
+
+def insulin_times(start=None, end=None):
+    """Return sorted fact_insulin timestamps, optionally within [start, end]."""
+    query = "SELECT ts FROM fact_insulin WHERE ts IS NOT NULL"
+    params = ()
+    if start is not None:
+        query += " AND ts BETWEEN %s AND %s"
+        params = (start, end)
+    cur.execute(query + " ORDER BY ts", params)
+    return [row[0] for row in cur.fetchall()]
+
+
+def classify_all(meals, insulin_ts):
+    """Label every ``(treatment_id, carbs, protein, fat, ts)`` meal in one pass."""
+    labels = []
+    for tid, carbs, protein, fat, ts in meals:
+        has_insulin = False
+        if ts is not None:
+            i = bisect_left(insulin_ts, ts - INSULIN_WINDOW)
+            has_insulin = i < len(insulin_ts) and insulin_ts[i] <= ts + INSULIN_WINDOW
+        labels.append((tid, classify(carbs, protein, fat, has_insulin)))
+    return labels
+
+
+def write_labels(labels):
+    """Apply all labels with a single UPDATE joined to a temporary table."""
+    cur.execute(
+        """
+        CREATE TEMPORARY TABLE meal_labels (
+            treatment_id INT PRIMARY KEY,
+            classification ENUM('hypo','snack','meal')
+        )
+        """
+    )
+    try:
+        cur.executemany(
+            "INSERT INTO meal_labels (treatment_id, classification) VALUES (%s,%s)",
+            labels,
+        )
         cur.execute(
-            "UPDATE fact_meal SET classification=%s WHERE treatment_id=%s",
-            (category, tid),
+            """
+            UPDATE fact_meal fm
+            JOIN meal_labels ml ON fm.treatment_id = ml.treatment_id
+            SET fm.classification = ml.classification
+            """
         )
+    finally:
+        cur.execute("DROP TEMPORARY TABLE meal_labels")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Classify fact_meal rows")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only classify meals whose classification is still NULL",
+    )
+    args = parser.parse_args()
+
+    migrate(cur)
+    ensure_column()
+    query = "SELECT treatment_id, carbs, protein, fat, ts FROM fact_meal"
+    if args.incremental:
+        query += " WHERE classification IS NULL"
+    cur.execute(query)
+    meals = cur.fetchall()
+
+    if meals:
+        stamps = [row[4] for row in meals if row[4] is not None]
+        if args.incremental and stamps:
+            insulin_ts = insulin_times(min(stamps) - INSULIN_WINDOW, max(stamps) + INSULIN_WINDOW)
+        else:
+            insulin_ts = insulin_times()
+        write_labels(classify_all(meals, insulin_ts))
+        bump_data_version(cur, min(stamps) if args.incremental and stamps else None)
+    print(f"Classified {len(meals)} meals")
 
     cur.close()
     mysql_conn.close()
@@ -1,21 +1,31 @@
-import os
-import pymysql
-
 """Remove insulin entries of 1 unit or less within 5 minutes of another dose.
 
 Usage::
 
-    python cleanup_insulin.py
+    python cleanup_insulin.py [--dry-run] [--max-units 1] [--window 5] [--since YYYY-MM-DD]
+
+Doses are scanned once in time order: a small dose is a duplicate when its
+previous or next dose lies within the window. ``--since`` restricts the scan
+to recent doses, e.g. after an incremental load.
 
 The script uses MYSQLHOST, MYSQLUSER, MYSQLPW, and MYSQLDB environment
 variables to connect to the database.
 """
 
+import os
+import argparse
+from datetime import datetime, timezone
+import pymysql
+from migrations import bump_data_version, migrate
+
 MYSQL_HOST = os.environ.get("MYSQLHOST", "localhost")
 MYSQL_USER = os.environ.get("MYSQLUSER", "root")
 MYSQL_PASSWORD = os.environ.get("MYSQLPW", "")
 MYSQL_DB = os.environ.get("MYSQLDB", "test")
 
+# fact_ids per DELETE statement
+DELETE_BATCH = 1000
+
 mysql_conn = pymysql.connect(
     host=MYSQL_HOST,
     user=MYSQL_USER,
@@ -26,19 +36,96 @@ mysql_conn = pymysql.connect(
 )
 cur = mysql_conn.cursor()
 
-cur.execute(
-    """
-    DELETE fi1
-    FROM fact_insulin fi1
-    WHERE fi1.units <= 1
-      AND EXISTS (
-          SELECT 1
-          FROM fact_insulin fi2
-          WHERE fi2.fact_id <> fi1.fact_id
-            AND ABS(fi2.ts - fi1.ts) <= 300
-      );
+
+def parse_since(value: str) -> int:
+    try:
+        day = datetime.fromisoformat(value).date()
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(f"Invalid date: {value}") from exc
+    return int(datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp())
+
+
+def find_duplicates(max_units=1.0, window=300, since=None):
+    """Return ``(fact_id, ts, units, neighbour_gap)`` for every small dose with
+    another dose at most *window* seconds away.
+
+    All candidates are judged against the table as it is now, so two small
+    doses close together are both reported, as the old correlated DELETE did.
     """
-)
+    query = "SELECT fact_id, ts, units FROM fact_insulin WHERE ts IS NOT NULL"
+    params = ()
+    if since is not None:
+        # Doses just before the range still count as neighbours.
+        query += " AND ts >= %s"
+        params = (since - window,)
+    cur.execute(query + " ORDER BY ts, fact_id", params)
+    rows = cur.fetchall()
+
+    candidates = []
+    for i, (fact_id, ts, units) in enumerate(rows):
+        if units is None or units > max_units:
+            continue
+        if since is not None and ts < since:
+            continue
+        gaps = []
+        if i > 0:
+            gaps.append(ts - rows[i - 1][1])
+        if i + 1 < len(rows):
+            gaps.append(rows[i + 1][1] - ts)
+        if gaps and min(gaps) <= window:
+            candidates.append((fact_id, ts, units, min(gaps)))
+    return candidates
+
+
+def delete_facts(fact_ids):
+    for start in range(0, len(fact_ids), DELETE_BATCH):
+        batch = fact_ids[start:start + DELETE_BATCH]
+        placeholders = ", ".join(["%s"] * len(batch))
+        cur.execute(f"DELETE FROM fact_insulin WHERE fact_id IN ({placeholders})", batch)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Remove duplicate small insulin doses")
+    parser.add_argument(
+        "--max-units",
+        type=float,
+        default=1.0,
+        help="Doses of at most this many units are candidates (default: 1)",
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=5,
+        help="Minutes to another dose for a candidate to be removed (default: 5)",
+    )
+    parser.add_argument(
+        "--since",
+        type=parse_since,
+        help="Only check doses from this date (YYYY-MM-DD, UTC) onwards",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="List the doses that would be removed without deleting them",
+    )
+    args = parser.parse_args()
+
+    migrate(cur)
+    candidates = find_duplicates(args.max_units, args.window * 60, args.since)
+    if args.dry_run:
+        for fact_id, ts, units, gap in candidates:
+            when = datetime.fromtimestamp(ts, tz=timezone.utc).strftime("%Y-%m-%d %H:%M")
+            print(f"fact_id={fact_id} {when} {units} U ({gap}s from the nearest dose)")
+        print(f"{len(candidates)} doses would be removed")
+    else:
+        delete_facts([row[0] for row in candidates])
+        if candidates:
+            bump_data_version(cur, min(row[1] for row in candidates))
+        print(f"Removed {len(candidates)} doses")
+
+    cur.close()
+    mysql_conn.close()
+
 
-cur.close()
-mysql_conn.close()
+if __name__ == "__main__":
+    main()
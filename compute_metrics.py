@@ -1,25 +1,13 @@
-import os
+import time
+import itertools
+import multiprocessing
 from collections import defaultdict
-from datetime import datetime
+from datetime import datetime, timezone
 from statistics import median, stdev
 from typing import Optional
 import argparse
-import pymysql
-
-MYSQL_HOST = os.environ.get("MYSQLHOST", "localhost")
-MYSQL_USER = os.environ.get("MYSQLUSER", "root")
-MYSQL_PASSWORD = os.environ.get("MYSQLPW", "")
-MYSQL_DB = os.environ.get("MYSQLDB", "test")
-
-mysql_conn = pymysql.connect(
-    host=MYSQL_HOST,
-    user=MYSQL_USER,
-    password=MYSQL_PASSWORD,
-    database=MYSQL_DB,
-    charset="utf8mb4",
-    autocommit=True,
-)
-cur = mysql_conn.cursor()
+from backends import connect
+from migrations import migrate
 
 # Default settings (seconds)
 DEFAULT_TIME_WINDOW = 50 * 60  # 50 minutes
@@ -28,6 +16,16 @@ DEFAULT_GLUCOSE_WINDOW = 15 * 60  # 15 minutes
 DEFAULT_NO_CORRECTION_BEFORE = 2 * 3600  # 2 hours
 DEFAULT_NO_CORRECTION_AFTER = 3 * 3600  # 3 hours
 
+# Window settings accepted by compute_metrics(), all in seconds.
+DEFAULT_SETTINGS = {
+    "time_window": DEFAULT_TIME_WINDOW,
+    "post_offset": DEFAULT_POST_OFFSET,
+    "pre_window": DEFAULT_GLUCOSE_WINDOW,
+    "post_window": DEFAULT_GLUCOSE_WINDOW,
+    "nocorr_before": DEFAULT_NO_CORRECTION_BEFORE,
+    "nocorr_after": DEFAULT_NO_CORRECTION_AFTER,
+}
+
 # Acceptable pre-meal glucose range (mg/dL).
 # Corresponds to 5 – 1.5 mmol/L = 63 mg/dL and 5 + 1.5 mmol/L = 117 mg/dL.
 PRE_MEAL_MIN = 63
@@ -36,6 +34,8 @@ PRE_MEAL_MAX = 117
 # Conversion factor from mg/dL to mmol/L.
 MGDL_TO_MMOLL = 1 / 18
 
+BUCKETS = ["morning", "afternoon", "evening"]
+
 
 def parse_date(value: str):
     if not value:
@@ -46,55 +46,6 @@ def parse_date(value: str):
         raise argparse.ArgumentTypeError(f"Invalid date: {value}") from exc
 
 
-parser = argparse.ArgumentParser(description="Compute insulin/meal metrics")
-parser.add_argument("--start", type=parse_date, help="Start date YYYY-MM-DD")
-parser.add_argument("--end", type=parse_date, help="End date YYYY-MM-DD")
-parser.add_argument(
-    "--time-window",
-    type=int,
-    default=50,
-    help="Meal-insulin association window in minutes (default: 50)",
-)
-parser.add_argument(
-    "--post-offset",
-    type=int,
-    default=120,
-    help="Minutes after meal for post-meal glucose (default: 120)",
-)
-parser.add_argument(
-    "--pre-window",
-    type=int,
-    default=15,
-    help="Minutes to average glucose before meal (default: 15)",
-)
-parser.add_argument(
-    "--post-window",
-    type=int,
-    default=15,
-    help="Minutes to average glucose after meal offset (default: 15)",
-)
-parser.add_argument(
-    "--nocorr-before",
-    type=int,
-    default=120,
-    help="Minutes before meal that must be correction-bolus free (default: 120)",
-)
-parser.add_argument(
-    "--nocorr-after",
-    type=int,
-    default=180,
-    help="Minutes after meal that must be correction-bolus free (default: 180)",
-)
-args = parser.parse_args()
-
-TIME_WINDOW = args.time_window * 60
-POST_OFFSET = args.post_offset * 60
-PRE_WINDOW = args.pre_window * 60
-POST_WINDOW = args.post_window * 60
-NO_CORRECTION_BEFORE = args.nocorr_before * 60
-NO_CORRECTION_AFTER = args.nocorr_after * 60
-
-
 # Map an hour in dim_time to a time bucket.
 # Expected time ranges: 04-12 = morning, 12-18 = afternoon, else evening.
 def time_bucket(hour: int) -> str:
@@ -106,6 +57,7 @@ def time_bucket(hour: int) -> str:
 
 
 def avg_glucose(
+    cur,
     ts: int,
     *,
     before: bool = True,
@@ -125,8 +77,10 @@ def avg_glucose(
         start = ts + offset
         end = ts + offset + window
 
+    # MySQL's AVG of an INT column has four decimals; ROUND gives the other
+    # backends the same (and MetricsEngine matches it).
     cur.execute(
-        "SELECT AVG(sgv) FROM fact_glucose WHERE ts BETWEEN %s AND %s",
+        "SELECT ROUND(AVG(sgv), 4) FROM fact_glucose WHERE ts BETWEEN %s AND %s",
         (start, end),
     )
     row = cur.fetchone()
@@ -135,12 +89,8 @@ def avg_glucose(
     return None
 
 
-def correction_bolus_before(ts: int) -> bool:
-    """Return True if a bolus injection occurred in the NO_CORRECTION_BEFORE
-    window prior to *ts* (excluding the TIME_WINDOW immediately preceding the
-    meal)."""
-    start = ts - NO_CORRECTION_BEFORE
-    end = ts - TIME_WINDOW
+def bolus_between(cur, start: int, end: int) -> bool:
+    """Return True if a bolus injection occurred between *start* and *end*."""
     if end <= start:
         return False
 
@@ -158,96 +108,503 @@ def correction_bolus_before(ts: int) -> bool:
     return cur.fetchone() is not None
 
 
-def correction_bolus_after(ts: int) -> bool:
-    """Return True if a bolus injection occurred within NO_CORRECTION_AFTER
-    seconds after *ts* (excluding the TIME_WINDOW immediately following the meal)."""
+def correction_bolus_before(cur, ts: int, settings) -> bool:
+    """Return True if a bolus injection occurred in the nocorr_before window
+    prior to *ts* (excluding the time_window immediately preceding the meal)."""
+    return bolus_between(cur, ts - settings["nocorr_before"], ts - settings["time_window"])
+
+
+def correction_bolus_after(cur, ts: int, settings) -> bool:
+    """Return True if a bolus injection occurred within nocorr_after seconds
+    after *ts* (excluding the time_window immediately following the meal)."""
+    return bolus_between(cur, ts + settings["time_window"], ts + settings["nocorr_after"])
+
+
+def fetch_meals(cur, time_window, start=None, end=None):
+    """Return ``(treatment_id, ts, carbs, units, hour)`` for every meal with
+    bolus insulin within *time_window* seconds."""
+    # Query meals paired with insulin doses based on temporal proximity
+    # Each meal can have multiple associated insulin doses. Sum the units so that
+    # each meal contributes a single data point with the total bolus amount.
+    query = """
+        SELECT m.treatment_id,
+               m.ts,
+               m.carbs,
+               SUM(fi.units) AS units,
+               dt.hour
+        FROM fact_meal m
+        JOIN fact_insulin fi ON fi.ts BETWEEN m.ts - %s AND m.ts + %s
+        JOIN dim_insulin_type dit ON fi.insulin_type_id = dit.insulin_type_id
+        JOIN dim_time dt ON m.time_id = dt.time_id
+    """
+    params = [time_window, time_window]
+    conditions = ["dit.insulin_class = 'bolus'"]
+    if start:
+        conditions.append("dt.date >= %s")
+        params.append(start.isoformat())
+    if end:
+        conditions.append("dt.date <= %s")
+        params.append(end.isoformat())
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+
+    # Aggregate insulin units for each meal
+    query += " GROUP BY m.treatment_id, m.ts, m.carbs, dt.hour ORDER BY m.treatment_id"
+
+    cur.execute(query, params)
+    return cur.fetchall()
+
+
+def collect_stats(meals, correction_before, pre_glucose, correction_after, post_glucose):
+    """Bucket per-meal metrics. Each lookup is called as ``f(index, ts)`` so
+    the engines can answer from SQL or from precomputed arrays."""
+    stats = defaultdict(lambda: defaultdict(list))
+
+    for i, (tid, ts, carbs, units, hour) in enumerate(meals):
+        if units is None or units == 0:
+            continue
+        if correction_before(i, ts):
+            continue
+        pre = pre_glucose(i, ts)
+        if pre is None or not (PRE_MEAL_MIN <= pre <= PRE_MEAL_MAX):
+            continue
+        if correction_after(i, ts):
+            continue
+        post = post_glucose(i, ts)
+        bucket = time_bucket(hour)
+
+        if carbs:
+            stats[bucket]["carb_ratio"].append(carbs / units)
+            if pre is not None and post is not None:
+                stats[bucket]["carb_absorption"].append((post - pre) * MGDL_TO_MMOLL / carbs)
+        if pre is not None and post is not None:
+            stats[bucket]["insulin_sensitivity"].append((pre - post) * MGDL_TO_MMOLL / units)
+    return stats
+
+
+def sql_stats(cur, meals, settings=DEFAULT_SETTINGS):
+    return collect_stats(
+        meals,
+        lambda i, ts: correction_bolus_before(cur, ts, settings),
+        lambda i, ts: avg_glucose(cur, ts, before=True, window=settings["pre_window"]),
+        lambda i, ts: correction_bolus_after(cur, ts, settings),
+        lambda i, ts: avg_glucose(
+            cur, ts, before=False, offset=settings["post_offset"], window=settings["post_window"]
+        ),
+    )
 
-    start = ts + TIME_WINDOW
-    end = ts + NO_CORRECTION_AFTER
-    if end <= start:
-        return False
 
-    cur.execute(
-        """
-        SELECT 1
-        FROM fact_insulin fi
-        JOIN dim_insulin_type dit ON fi.insulin_type_id = dit.insulin_type_id
-        WHERE dit.insulin_class = 'bolus'
-          AND fi.ts BETWEEN %s AND %s
-        LIMIT 1
-        """,
-        (start, end),
+def reach(settings):
+    """Seconds around a meal that any window of *settings* can touch."""
+    return max(
+        settings["time_window"],
+        settings["nocorr_before"],
+        settings["pre_window"],
+        settings["nocorr_after"],
+        settings["post_offset"] + settings["post_window"],
     )
-    return cur.fetchone() is not None
 
 
-# Query meals paired with insulin doses based on temporal proximity
-# Each meal can have multiple associated insulin doses. Sum the units so that
-# each meal contributes a single data point with the total bolus amount.
-query = """
-    SELECT m.treatment_id,
-           m.ts,
-           m.carbs,
-           SUM(fi.units) AS units,
-           dt.hour
-    FROM fact_meal m
-    JOIN fact_insulin fi ON fi.ts BETWEEN m.ts - %s AND m.ts + %s
-    JOIN dim_insulin_type dit ON fi.insulin_type_id = dit.insulin_type_id
-    JOIN dim_time dt ON m.time_id = dt.time_id
-"""
-params = [TIME_WINDOW, TIME_WINDOW]
-conditions = ["dit.insulin_class = 'bolus'"]
-if args.start:
-    conditions.append("dt.date >= %s")
-    params.append(args.start.isoformat())
-if args.end:
-    conditions.append("dt.date <= %s")
-    params.append(args.end.isoformat())
-if conditions:
-    query += " WHERE " + " AND ".join(conditions)
-
-# Aggregate insulin units for each meal
-query += " GROUP BY m.treatment_id, m.ts, m.carbs, dt.hour"
-
-cur.execute(query, params)
-
-stats = defaultdict(lambda: defaultdict(list))
-
-for tid, ts, carbs, units, hour in cur.fetchall():
-    if units is None or units == 0:
-        continue
-    if correction_bolus_before(ts):
-        continue
-    pre = avg_glucose(ts, before=True, window=PRE_WINDOW)
-    if pre is None or not (PRE_MEAL_MIN <= pre <= PRE_MEAL_MAX):
-        continue
-    if correction_bolus_after(ts):
-        continue
-    post = avg_glucose(ts, before=False, offset=POST_OFFSET, window=POST_WINDOW)
-    bucket = time_bucket(hour)
-
-    if carbs:
-        stats[bucket]["carb_ratio"].append(carbs / units)
-        if pre is not None and post is not None:
-            stats[bucket]["carb_absorption"].append((post - pre) * MGDL_TO_MMOLL / carbs)
-    if pre is not None and post is not None:
-        stats[bucket]["insulin_sensitivity"].append((pre - post) * MGDL_TO_MMOLL / units)
-
-
-for bucket in ["morning", "afternoon", "evening"]:
-    print(f"\n=== {bucket.capitalize()} ===")
-    data = stats.get(bucket, {})
-    if not data:
-        print("No records")
-        continue
-    for metric, values in data.items():
-        avg_val = sum(values) / len(values)
-        med_val = median(values)
-        sd_val = stdev(values) if len(values) > 1 else 0.0
-        unit = " mmol/L per U" if metric == "insulin_sensitivity" else ""
+def load_data(cur, start=None, end=None, settings=(DEFAULT_SETTINGS,)):
+    """Load everything compute_metrics() needs once.
+
+    Returns meals as ``(treatment_id, ts, carbs, hour)`` plus a MetricsEngine
+    with readings and bolus doses covering every window of *settings*.
+    """
+    from metrics_engine import MetricsEngine
+
+    query = """
+        SELECT m.treatment_id, m.ts, m.carbs, dt.hour
+        FROM fact_meal m
+        JOIN dim_time dt ON m.time_id = dt.time_id
+        WHERE m.ts IS NOT NULL
+    """
+    params = []
+    if start:
+        query += " AND dt.date >= %s"
+        params.append(start.isoformat())
+    if end:
+        query += " AND dt.date <= %s"
+        params.append(end.isoformat())
+    cur.execute(query + " ORDER BY m.treatment_id", params)
+    meals = cur.fetchall()
+    if not meals:
+        return {"meals": [], "engine": MetricsEngine([], [], [], [])}
+    margin = max(reach(s) for s in settings)
+    first = min(row[1] for row in meals)
+    last = max(row[1] for row in meals)
+    engine = MetricsEngine.from_db(cur, first - margin, last + margin)
+    return {"meals": meals, "engine": engine}
+
+
+def load_parquet(root, start=None, end=None, settings=(DEFAULT_SETTINGS,)):
+    """load_data() from a dataset written by export_parquet.py.
+
+    Only the columns used here are read, and months outside *start*/*end*
+    (widened by the windows of *settings*) are never opened.
+    """
+    import pyarrow.compute as pc
+    from export_parquet import read_dimension, read_facts
+    from metrics_engine import MetricsEngine
+
+    low = high = None
+    if start:
+        low = int(datetime(start.year, start.month, start.day, tzinfo=timezone.utc).timestamp())
+    if end:
+        high = int(datetime(end.year, end.month, end.day, tzinfo=timezone.utc).timestamp()) + 86399
+    meals = read_facts(root, "fact_meal", ["treatment_id", "ts", "carbs"], low, high)
+    meals = meals.filter(pc.is_valid(meals["ts"])).sort_by("treatment_id")
+    if not meals.num_rows:
+        return {"meals": [], "engine": MetricsEngine([], [], [], [])}
+    ts = meals["ts"].to_pylist()
+    # dim_time.hour is the UTC hour of the fact's minute.
+    meals = list(zip(meals["treatment_id"].to_pylist(), ts, meals["carbs"].to_pylist(), [t // 3600 % 24 for t in ts]))
+
+    margin = max(reach(s) for s in settings)
+    first, last = min(ts) - margin, max(ts) + margin
+    glucose = read_facts(root, "fact_glucose", ["ts", "sgv"], first, last)
+    glucose = glucose.filter(pc.is_valid(glucose["sgv"]))
+    types = read_dimension(root, "dim_insulin_type", ["insulin_type_id", "insulin_class"])
+    bolus_ids = types.filter(pc.equal(types["insulin_class"], "bolus"))["insulin_type_id"]
+    insulin = read_facts(root, "fact_insulin", ["ts", "units", "insulin_type_id"], first, last)
+    insulin = insulin.filter(pc.is_in(insulin["insulin_type_id"], value_set=bolus_ids))
+    engine = MetricsEngine(
+        glucose["ts"].to_numpy(),
+        glucose["sgv"].to_numpy(),
+        insulin["ts"].to_numpy(),
+        insulin["units"].to_pylist(),
+    )
+    return {"meals": meals, "engine": engine}
+
+
+def compute_metrics(data, **settings):
+    """Return per-bucket metric lists for *data* from load_data().
+
+    Keyword arguments override DEFAULT_SETTINGS (all in seconds).
+    """
+    settings = {**DEFAULT_SETTINGS, **settings}
+    engine = data["engine"]
+    units = engine.bolus_units(
+        [row[1] for row in data["meals"]], settings["time_window"]
+    )
+    # Like the SQL join, meals without a bolus in the window are dropped.
+    meals = [
+        (tid, ts, carbs, total, hour)
+        for (tid, ts, carbs, hour), total in zip(data["meals"], units)
+        if total is not None
+    ]
+    return numpy_stats(engine, meals, settings)
+
+
+def numpy_stats(engine, meals, settings):
+    import numpy as np
+
+    if not meals:
+        return collect_stats(meals, None, None, None, None)
+    ts = np.array([row[1] for row in meals], dtype=np.int64)
+    time_window = settings["time_window"]
+    post_offset = settings["post_offset"]
+
+    before = engine.has_bolus(ts - settings["nocorr_before"], ts - time_window)
+    after = engine.has_bolus(ts + time_window, ts + settings["nocorr_after"])
+    pre = engine.avg_glucose(ts - settings["pre_window"], ts)
+    post = engine.avg_glucose(ts + post_offset, ts + post_offset + settings["post_window"])
+
+    def value(values, i):
+        return None if np.isnan(values[i]) else float(values[i])
+
+    return collect_stats(
+        meals,
+        lambda i, _: bool(before[i]),
+        lambda i, _: value(pre, i),
+        lambda i, _: bool(after[i]),
+        lambda i, _: value(post, i),
+    )
+
+
+def summarize(stats):
+    """Return ``{bucket: {metric: (mean, sd, median, n)}}``."""
+    summary = {}
+    for bucket in BUCKETS:
+        summary[bucket] = {}
+        for metric, values in stats.get(bucket, {}).items():
+            summary[bucket][metric] = (
+                sum(values) / len(values),
+                stdev(values) if len(values) > 1 else 0.0,
+                median(values),
+                len(values),
+            )
+    return summary
+
+
+# Upper bound on resample draws held in memory at once by bootstrap_ci().
+BOOTSTRAP_BATCH_DRAWS = 4_000_000
+
+
+def bootstrap_ci(stats, resamples, seed=0, confidence=95.0):
+    """Percentile confidence intervals of each bucket/metric mean.
+
+    Resamples are drawn as one ``(resamples, n)`` index matrix per metric
+    (split into batches for large *n*) with a seeded generator, so reruns
+    give the same intervals. Returns ``{bucket: {metric: (low, high)}}``.
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    tail = (100.0 - confidence) / 2
+    intervals = {}
+    for bucket in BUCKETS:
+        intervals[bucket] = {}
+        for metric, values in stats.get(bucket, {}).items():
+            values = np.asarray(values, dtype=float)
+            n = len(values)
+            batch = max(1, BOOTSTRAP_BATCH_DRAWS // n)
+            means = np.empty(resamples)
+            for start in range(0, resamples, batch):
+                size = min(batch, resamples - start)
+                idx = rng.integers(0, n, size=(size, n))
+                means[start:start + size] = values[idx].mean(axis=1)
+            low, high = np.percentile(means, [tail, 100.0 - tail])
+            intervals[bucket][metric] = (float(low), float(high))
+    return intervals
+
+
+def print_stats(stats, intervals=None, confidence=95.0):
+    for bucket, data in summarize(stats).items():
+        print(f"\n=== {bucket.capitalize()} ===")
+        if not data:
+            print("No records")
+            continue
+        for metric, (avg_val, sd_val, med_val, n) in data.items():
+            unit = " mmol/L per U" if metric == "insulin_sensitivity" else ""
+            ci = ""
+            if intervals:
+                low, high = intervals[bucket][metric]
+                ci = f", {confidence:g}% CI {low:.2f}–{high:.2f}"
+            print(
+                f"{metric}: {avg_val:.2f}{unit} ±{sd_val:.2f} (median {med_val:.2f}, n={n}{ci})"
+            )
+
+
+def as_plain(stats):
+    return {bucket: dict(metrics) for bucket, metrics in stats.items()}
+
+
+_sweep_data = None
+
+
+def _init_sweep(data):
+    global _sweep_data
+    _sweep_data = data
+
+
+def _sweep_one(settings):
+    return settings, summarize(compute_metrics(_sweep_data, **settings))
+
+
+def grid_settings(grid):
+    """Expand ``{name: [values]}`` into one settings dict per combination."""
+    return [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+
+
+def sweep(data, combos, workers=None):
+    """Evaluate compute_metrics() for every settings dict in *combos*.
+
+    Returns a list of ``(settings, summary)`` in the same order.
+    """
+    with multiprocessing.Pool(workers, initializer=_init_sweep, initargs=(data,)) as pool:
+        return pool.map(_sweep_one, combos)
+
+
+def print_sweep(results):
+    """Print one whitespace-separated row per combination, bucket and metric."""
+    print(" ".join(DEFAULT_SETTINGS) + " bucket metric mean sd median n")
+    for settings, summary in results:
+        minutes = " ".join(str(settings[name] // 60) for name in DEFAULT_SETTINGS)
+        for bucket, data in summary.items():
+            for metric, (avg_val, sd_val, med_val, n) in data.items():
+                print(f"{minutes} {bucket} {metric} {avg_val:.3f} {sd_val:.3f} {med_val:.3f} {n}")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Compute insulin/meal metrics")
+    parser.add_argument("--start", type=parse_date, help="Start date YYYY-MM-DD")
+    parser.add_argument("--end", type=parse_date, help="End date YYYY-MM-DD")
+    parser.add_argument(
+        "--time-window",
+        type=int,
+        nargs="+",
+        default=[50],
+        help="Meal-insulin association window in minutes (default: 50)",
+    )
+    parser.add_argument(
+        "--post-offset",
+        type=int,
+        nargs="+",
+        default=[120],
+        help="Minutes after meal for post-meal glucose (default: 120)",
+    )
+    parser.add_argument(
+        "--pre-window",
+        type=int,
+        nargs="+",
+        default=[15],
+        help="Minutes to average glucose before meal (default: 15)",
+    )
+    parser.add_argument(
+        "--post-window",
+        type=int,
+        nargs="+",
+        default=[15],
+        help="Minutes to average glucose after meal offset (default: 15)",
+    )
+    parser.add_argument(
+        "--nocorr-before",
+        type=int,
+        nargs="+",
+        default=[120],
+        help="Minutes before meal that must be correction-bolus free (default: 120)",
+    )
+    parser.add_argument(
+        "--nocorr-after",
+        type=int,
+        nargs="+",
+        default=[180],
+        help="Minutes after meal that must be correction-bolus free (default: 180)",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["sql", "numpy"],
+        default="sql",
+        help="Query each meal window in SQL or answer them from in-memory NumPy arrays (default: sql)",
+    )
+    parser.add_argument(
+        "--parquet",
+        metavar="DIR",
+        help="Read a dataset written by export_parquet.py instead of MySQL (numpy engine)",
+    )
+    parser.add_argument(
+        "--db",
+        help="Database: mysql, sqlite:PATH or duckdb:PATH (default: $CGM_DB, else mysql)",
+    )
+    parser.add_argument(
+        "--check-parity",
+        action="store_true",
+        help="Run both engines and report whether their results are identical",
+    )
+    parser.add_argument(
+        "--sweep",
+        action="store_true",
+        help="Evaluate every combination of the window values given (several per option allowed)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Processes used by --sweep (default: one per CPU)",
+    )
+    parser.add_argument(
+        "--bootstrap",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Add percentile confidence intervals of each mean from N resamples",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Random seed for --bootstrap (default: 0)",
+    )
+    parser.add_argument(
+        "--confidence",
+        type=float,
+        default=95.0,
+        help="Confidence level in percent for --bootstrap (default: 95)",
+    )
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    # Window options in minutes, keyed like DEFAULT_SETTINGS
+    grid = {
+        "time_window": args.time_window,
+        "post_offset": args.post_offset,
+        "pre_window": args.pre_window,
+        "post_window": args.post_window,
+        "nocorr_before": args.nocorr_before,
+        "nocorr_after": args.nocorr_after,
+    }
+    grid = {name: [value * 60 for value in values] for name, values in grid.items()}
+    if not args.sweep and any(len(values) > 1 for values in grid.values()):
+        parser.error("several values for a window option need --sweep")
+    if args.sweep and args.bootstrap:
+        parser.error("--bootstrap cannot be combined with --sweep")
+    if args.parquet and args.check_parity:
+        parser.error("--check-parity compares against MySQL and cannot use --parquet")
+
+    if args.parquet:
+        # The per-meal SQL queries need MySQL; the dataset feeds the NumPy engine.
+        args.engine = "numpy"
+        conn = cur = None
+        load = lambda combos: load_parquet(args.parquet, args.start, args.end, combos)
+    else:
+        try:
+            conn = connect(args.db)
+        except ValueError as exc:
+            parser.error(str(exc))
+        cur = conn.cursor()
+        migrate(cur)
+        load = lambda combos: load_data(cur, args.start, args.end, combos)
+
+    def close():
+        if conn is not None:
+            cur.close()
+            conn.close()
+
+    if args.sweep:
+        combos = grid_settings(grid)
+        data = load(combos)
+        close()
+        print_sweep(sweep(data, combos, args.workers))
+        return
+
+    settings = {name: values[0] for name, values in grid.items()}
+    if args.engine == "numpy" or args.check_parity:
+        data = load([settings])
+
+    if args.check_parity:
+        meals = fetch_meals(cur, settings["time_window"], args.start, args.end)
+        started = time.perf_counter()
+        expected = sql_stats(cur, meals, settings)
+        sql_elapsed = time.perf_counter() - started
+        started = time.perf_counter()
+        stats = compute_metrics(data, **settings)
+        numpy_elapsed = time.perf_counter() - started
+        match = as_plain(expected) == as_plain(stats)
         print(
-            f"{metric}: {avg_val:.2f}{unit} ±{sd_val:.2f} (median {med_val:.2f}, n={len(values)})"
+            f"Parity {'OK' if match else 'MISMATCH'}: sql {sql_elapsed:.3f}s, "
+            f"numpy {numpy_elapsed:.3f}s over {len(meals)} meals"
         )
+        if not match:
+            close()
+            raise SystemExit(1)
+    elif args.engine == "numpy":
+        stats = compute_metrics(data, **settings)
+    else:
+        meals = fetch_meals(cur, settings["time_window"], args.start, args.end)
+        stats = sql_stats(cur, meals, settings)
+
+    intervals = None
+    if args.bootstrap:
+        intervals = bootstrap_ci(stats, args.bootstrap, args.seed, args.confidence)
+    print_stats(stats, intervals, args.confidence)
+
+    close()
+
 
-cur.close()
-mysql_conn.close()
+if __name__ == "__main__":
+    main()
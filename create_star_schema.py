@@ -1,26 +1,75 @@
-import os
 import json
-from datetime import datetime, timedelta, timezone
-import pymysql
+import math
+import time
+import argparse
+import multiprocessing
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timezone
+from backends import backend_of, connect, run_ddl
+from migrations import bump_data_version, migrate
+from timeutil import GLUCOSE_TS_SQL, OFFSET_MINUTES, TREATMENT_TS_SQL, epoch_seconds
 
-MYSQL_HOST = os.environ.get("MYSQLHOST", "localhost")
-MYSQL_USER = os.environ.get("MYSQLUSER", "root")
-MYSQL_PASSWORD = os.environ.get("MYSQLPW", "")
-MYSQL_DB = os.environ.get("MYSQLDB", "test")
+# Source rows transformed and written per batch
+DEFAULT_CHUNK_SIZE = 5000
 
-mysql_conn = pymysql.connect(
-    host=MYSQL_HOST,
-    user=MYSQL_USER,
-    password=MYSQL_PASSWORD,
-    database=MYSQL_DB,
-    charset="utf8mb4",
-    autocommit=True,
-)
-cur = mysql_conn.cursor()
+# Rules seeded into insulin_rules on first run. Further brands are added as
+# rows in that table rather than here.
+DEFAULT_INSULIN_RULES = [
+    ("novorapid", "bolus", 0.03, 0.008, 300),
+    ("novarap", "bolus", 0.03, 0.008, 300),
+    ("tresiba", "basal", None, None, None),
+]
+
+# dim_time ids resolved in memory. Preloaded minutes live in two sorted
+# parallel arrays searched with bisect; any other minute (e.g. new readings
+# seen by the sync daemon) falls back to a dict.
+_minute_ts = array("q")
+_minute_ids = array("q")
+_extra_time_ids = {}
+
+# insulin_rules rows and dim_insulin_type ids, loaded once per process.
+_insulin_rules = None
+_insulin_type_ids = None
+_new_insulin_names = set()
+
+# The database opened by open_db(): its URL, Backend, connection and cursor.
+db_url = None
+backend = None
+db_conn = None
+cur = None
+
+# Fact statements, written for the backend by open_db()
+GLUCOSE_REPLACE = None
+MEAL_REPLACE = None
+INSULIN_INSERT = None
+DIM_TIME_INSERT = None
+
+
+def open_db(url=None):
+    """Connect to *url* (see backends.py; default MySQL) for the loaders."""
+    global db_url, backend, db_conn, cur, GLUCOSE_REPLACE, MEAL_REPLACE, INSULIN_INSERT, DIM_TIME_INSERT
+    db_url = url
+    db_conn = connect(url)
+    cur = db_conn.cursor()
+    backend = backend_of(cur)
+    GLUCOSE_REPLACE = backend.replace_into(
+        "fact_glucose", ["entry_id", "time_id", "ts", "sgv", "delta", "direction"]
+    )
+    MEAL_REPLACE = backend.replace_into("fact_meal", ["treatment_id", "time_id", "ts", "carbs", "protein", "fat"])
+    INSULIN_INSERT = backend.upsert(
+        "fact_insulin",
+        ["treatment_id", "injection_idx", "time_id", "ts", "insulin_type_id", "units"],
+        ["treatment_id", "injection_idx"],
+    )
+    DIM_TIME_INSERT = backend.insert_ignore(
+        "dim_time", ["ts", "date", "hour", "minute", "dow", "month", "year"], ["ts"]
+    )
 
 
 def create_dimension_tables():
-    cur.execute(
+    run_ddl(
+        cur,
         """
         CREATE TABLE IF NOT EXISTS dim_time (
             time_id INT AUTO_INCREMENT PRIMARY KEY,
@@ -36,7 +85,8 @@ def create_dimension_tables():
         """
     )
 
-    cur.execute(
+    run_ddl(
+        cur,
         """
         CREATE TABLE IF NOT EXISTS dim_insulin_type (
             insulin_type_id INT AUTO_INCREMENT PRIMARY KEY,
@@ -46,9 +96,31 @@ def create_dimension_tables():
         """
     )
 
+    # Case-insensitive substring patterns used to classify insulin names.
+    # ka/ke (per minute) and duration (minutes) describe the action curve.
+    run_ddl(
+        cur,
+        """
+        CREATE TABLE IF NOT EXISTS insulin_rules (
+            rule_id INT AUTO_INCREMENT PRIMARY KEY,
+            pattern VARCHAR(255) NOT NULL UNIQUE,
+            insulin_class ENUM('bolus','basal','unknown') NOT NULL DEFAULT 'unknown',
+            ka DOUBLE DEFAULT NULL,
+            ke DOUBLE DEFAULT NULL,
+            duration INT DEFAULT NULL,
+            priority INT NOT NULL DEFAULT 0
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+        """
+    )
+    cur.executemany(
+        backend.insert_ignore("insulin_rules", ["pattern", "insulin_class", "ka", "ke", "duration"], ["pattern"]),
+        DEFAULT_INSULIN_RULES,
+    )
+
 
 def create_fact_tables():
-    cur.execute(
+    run_ddl(
+        cur,
         """
         CREATE TABLE IF NOT EXISTS fact_glucose (
             entry_id INT PRIMARY KEY,
@@ -62,7 +134,8 @@ def create_fact_tables():
         """
     )
 
-    cur.execute(
+    run_ddl(
+        cur,
         """
         CREATE TABLE IF NOT EXISTS fact_meal (
             treatment_id INT PRIMARY KEY,
@@ -76,114 +149,345 @@ def create_fact_tables():
         """
     )
 
-    cur.execute(
+    run_ddl(
+        cur,
         """
         CREATE TABLE IF NOT EXISTS fact_insulin (
             fact_id INT AUTO_INCREMENT PRIMARY KEY,
             treatment_id INT,
+            injection_idx INT NOT NULL DEFAULT 0,
             time_id INT,
             ts BIGINT,
             insulin_type_id INT,
             units DOUBLE,
+            UNIQUE KEY u_treatment_injection (treatment_id, injection_idx),
             FOREIGN KEY (time_id) REFERENCES dim_time(time_id),
             FOREIGN KEY (insulin_type_id) REFERENCES dim_insulin_type(insulin_type_id)
         ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
         """
     )
 
+    # Last source rows turned into facts, for --incremental refreshes.
+    run_ddl(
+        cur,
+        """
+        CREATE TABLE IF NOT EXISTS star_state (
+            source VARCHAR(64) PRIMARY KEY,
+            last_id INT DEFAULT NULL,
+            last_modified DATETIME DEFAULT NULL
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+        """
+    )
+
+    ensure_change_tracking()
+
+
+def insulin_key_missing():
+    """True for a fact_insulin table from before the (treatment_id, injection_idx) key."""
+    return not backend.has_column(cur, "fact_insulin", "injection_idx")
+
+
+def rebuild_insulin_key():
+    """Give an old fact_insulin table its (treatment_id, injection_idx) key.
+
+    Earlier loads appended duplicate doses on every rerun and cannot be
+    de-duplicated reliably, so the facts are cleared and the treatments
+    state reset. Only call this right before every treatment is reloaded.
+    """
+    cur.execute("DELETE FROM fact_insulin")
+    run_ddl(
+        cur,
+        "ALTER TABLE fact_insulin ADD COLUMN injection_idx INT NOT NULL DEFAULT 0 AFTER treatment_id, "
+        "ADD UNIQUE KEY u_treatment_injection (treatment_id, injection_idx)"
+    )
+    cur.execute("DELETE FROM star_state WHERE source='treatments'")
+    print("fact_insulin rebuilt with a natural key; rerun cleanup_insulin.py afterwards")
+
+
+def ensure_change_tracking():
+    """Add an auto-maintained ``modified_at`` column to the raw tables.
+
+    MySQL bumps it whenever a sync changes a row, which lets --incremental
+    pick up edited as well as new source rows.
+    """
+    for table in ("entries", "treatments"):
+        if backend.has_column(cur, table, "modified_at"):
+            continue
+        run_ddl(
+            cur,
+            f"ALTER TABLE {table} ADD COLUMN modified_at TIMESTAMP NOT NULL "
+            "DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP, "
+            "ADD KEY k_modified_at (modified_at)"
+        )
 
-def get_time_id(dt):
-    if dt.tzinfo is None:
-        dt = dt.replace(tzinfo=timezone.utc)
-    minute_dt = dt.replace(second=0, microsecond=0)
-    ts_epoch = int(minute_dt.timestamp())
+
+def get_state(source):
+    """Return ``(last_id, last_modified)`` for *source*, or None before the first run."""
+    cur.execute("SELECT last_id, last_modified FROM star_state WHERE source=%s", (source,))
+    return cur.fetchone()
+
+
+def save_state(source, last_id, last_modified):
+    cur.execute(
+        backend.upsert("star_state", ["source", "last_id", "last_modified"], ["source"]),
+        (source, last_id, last_modified),
+    )
+
+
+def source_marks(table):
+    """Current ``(MAX(mysqlid), NOW())`` of *table*, taken before a load starts."""
+    cur.execute(f"SELECT MAX(mysqlid), {backend.now} FROM {table}")
+    return cur.fetchone()
+
+
+def since_clause(state):
+    """Condition and params selecting rows added or changed after *state*."""
+    if not state:
+        return None, ()
+    last_id, last_modified = state
+    return "(mysqlid > %s OR modified_at >= %s)", (last_id or 0, last_modified)
+
+
+def where_sql(conditions):
+    conditions = [c for c in conditions if c]
+    return " WHERE " + " AND ".join(conditions) if conditions else ""
+
+
+def earliest_change(entries_state, treatments_state):
+    """Earliest fact time (epoch seconds) of the source rows an incremental
+    load will transform, or None when nothing changed."""
+    stamps = []
+    for table, expression, state in (
+        ("entries e", GLUCOSE_TS_SQL, entries_state),
+        ("treatments t", TREATMENT_TS_SQL, treatments_state),
+    ):
+        condition, params = since_clause(state)
+        cur.execute(f"SELECT MIN({expression}) FROM {table}{where_sql([condition])}", params)
+        stamps.append(cur.fetchone()[0])
+    stamps = [ts for ts in stamps if ts is not None]
+    return min(stamps) if stamps else None
+
+
+def dim_time_row(ts_epoch):
+    minute_dt = datetime.fromtimestamp(ts_epoch, tz=timezone.utc)
+    return (
+        ts_epoch,
+        minute_dt.date(),
+        minute_dt.hour,
+        minute_dt.minute,
+        minute_dt.weekday(),
+        minute_dt.month,
+        minute_dt.year,
+    )
+
+
+def data_minutes(chunk_size=DEFAULT_CHUNK_SIZE):
+    """Return the sorted distinct minutes (epoch seconds, NumPy int64) that
+    hold an entry or treatment."""
+    import numpy as np
+
+    minutes = [np.empty(0, dtype=np.int64)]
+    for query, offset in (
+        ("SELECT date FROM entries WHERE date > 0", OFFSET_MINUTES),
+        ("SELECT epocdate FROM treatments WHERE epocdate > 0", 0),
+    ):
+        for rows in stream_rows(query, chunk_size):
+            seconds = epoch_seconds([row[0] for row in rows], offset)
+            seconds = seconds[~np.isnan(seconds)].astype(np.int64)
+            minutes.append(np.unique(seconds // 60 * 60))
+    return np.unique(np.concatenate(minutes))
+
+
+def preload_time_ids(chunk_size=DEFAULT_CHUNK_SIZE, generate=True):
+    """Create the missing dim_time rows of every minute holding data and load
+    their time ids.
+
+    Only minutes that occur are created, so a stray far-future or far-past
+    timestamp adds one row rather than every minute up to it. After this,
+    get_time_id resolves facts without touching the database. With
+    *generate* False only the existing minutes are loaded.
+    """
+    global _minute_ts, _minute_ids
+    import numpy as np
+
+    minutes = data_minutes(chunk_size)
+    if not len(minutes):
+        return
+    start, end = int(minutes[0]), int(minutes[-1])
+
+    cur.execute("SELECT ts, time_id FROM dim_time WHERE ts BETWEEN %s AND %s", (start, end))
+    known = np.array(cur.fetchall(), dtype=np.int64).reshape(-1, 2)
+    if generate:
+        missing = np.setdiff1d(minutes, known[:, 0], assume_unique=True).tolist()
+        for i in range(0, len(missing), chunk_size):
+            cur.executemany(DIM_TIME_INSERT, [dim_time_row(ts_epoch) for ts_epoch in missing[i:i + chunk_size]])
+        if missing:
+            cur.execute("SELECT ts, time_id FROM dim_time WHERE ts BETWEEN %s AND %s", (start, end))
+            known = np.array(cur.fetchall(), dtype=np.int64).reshape(-1, 2)
+
+    known = known[np.isin(known[:, 0], minutes)]
+    known = known[np.argsort(known[:, 0])]
+    _minute_ts = array("q", known[:, 0].tolist())
+    _minute_ids = array("q", known[:, 1].tolist())
+
+
+def get_time_id(ts_epoch):
+    """Return the dim_time id of the minute containing *ts_epoch*."""
+    ts_epoch = ts_epoch // 60 * 60
+    index = bisect_left(_minute_ts, ts_epoch)
+    if index < len(_minute_ts) and _minute_ts[index] == ts_epoch:
+        return _minute_ids[index]
+    time_id = _extra_time_ids.get(ts_epoch)
+    if time_id is not None:
+        return time_id
     cur.execute("SELECT time_id FROM dim_time WHERE ts=%s", (ts_epoch,))
     res = cur.fetchone()
     if res:
-        return res[0]
-    cur.execute(
-        "INSERT INTO dim_time (ts, date, hour, minute, dow, month, year) VALUES (%s,%s,%s,%s,%s,%s,%s)",
-        (
-            ts_epoch,
-            minute_dt.date(),
-            minute_dt.hour,
-            minute_dt.minute,
-            minute_dt.weekday(),
-            minute_dt.month,
-            minute_dt.year,
-        ),
-    )
-    return cur.lastrowid
+        time_id = res[0]
+    else:
+        cur.execute(DIM_TIME_INSERT, dim_time_row(ts_epoch))
+        time_id = cur.lastrowid
+        if not time_id:
+            # Another loader inserted the same minute in the meantime.
+            cur.execute("SELECT time_id FROM dim_time WHERE ts=%s", (ts_epoch,))
+            time_id = cur.fetchone()[0]
+    _extra_time_ids[ts_epoch] = time_id
+    return time_id
 
 
-def classify_insulin(name: str) -> str:
+def load_insulin_rules():
+    """Return the classification rules, most specific first."""
+    global _insulin_rules
+    if _insulin_rules is None:
+        cur.execute("SELECT pattern, insulin_class, ka, ke, duration, priority FROM insulin_rules")
+        rows = sorted(cur.fetchall(), key=lambda row: (-row[5], -len(row[0])))
+        _insulin_rules = [
+            {"pattern": pattern.lower(), "insulin_class": insulin_class, "ka": ka, "ke": ke, "duration": duration}
+            for pattern, insulin_class, ka, ke, duration, _ in rows
+        ]
+    return _insulin_rules
+
+
+def insulin_rule(name):
+    """Return the first rule matching *name*, or None."""
     if not name:
-        return "unknown"
+        return None
     n = name.lower()
-    if "novarap" in n or "novorapid" in n:
-        return "bolus"
-    if "tresiba" in n:
-        return "basal"
-    return "unknown"
+    for rule in load_insulin_rules():
+        if rule["pattern"] in n:
+            return rule
+    return None
+
+
+def classify_insulin(name: str) -> str:
+    rule = insulin_rule(name)
+    return rule["insulin_class"] if rule else "unknown"
+
 
+def load_insulin_types():
+    """Load dim_insulin_type into memory, reclassifying names a new rule now matches."""
+    global _insulin_type_ids
+    if _insulin_type_ids is None:
+        cur.execute("SELECT insulin_type_id, insulin_name, insulin_class FROM dim_insulin_type")
+        _insulin_type_ids = {}
+        updates = []
+        for type_id, name, insulin_class in cur.fetchall():
+            _insulin_type_ids[name] = type_id
+            if insulin_class == "unknown" and classify_insulin(name) != "unknown":
+                updates.append((classify_insulin(name), type_id))
+        if updates:
+            cur.executemany(
+                "UPDATE dim_insulin_type SET insulin_class=%s WHERE insulin_type_id=%s",
+                updates,
+            )
+    return _insulin_type_ids
 
-def get_insulin_type_id(name: str) -> int:
+
+def flush_insulin_types():
+    """Insert every queued new insulin name in one batch and refresh the cache."""
+    global _insulin_type_ids
+    if not _new_insulin_names:
+        return
+    cur.executemany(
+        backend.insert_ignore("dim_insulin_type", ["insulin_name", "insulin_class"], ["insulin_name"]),
+        [(name, classify_insulin(name)) for name in sorted(_new_insulin_names)],
+    )
+    _new_insulin_names.clear()
+    _insulin_type_ids = None
+    load_insulin_types()
+
+
+def get_insulin_type_id(name: str):
+    """Return the cached id for *name*, queueing unseen names.
+
+    Returns None for a queued name; flush_insulin_types() assigns its id.
+    """
     if name is None:
         name = "Unknown"
-    cur.execute("SELECT insulin_type_id FROM dim_insulin_type WHERE insulin_name=%s", (name,))
-    res = cur.fetchone()
-    if res:
-        return res[0]
-    insulin_class = classify_insulin(name)
-    cur.execute(
-        "INSERT INTO dim_insulin_type (insulin_name, insulin_class) VALUES (%s,%s)",
-        (name, insulin_class),
-    )
-    return cur.lastrowid
+    type_id = load_insulin_types().get(name)
+    if type_id is None:
+        _new_insulin_names.add(name)
+    return type_id
 
 
-def parse_time(value, offset_minutes=0):
-    """Parse various timestamp formats and apply an optional offset."""
-    if value is None:
-        return None
-    try:
-        # Numeric values are epoch based
-        if isinstance(value, (int, float)):
-            if value > 1e14:  # microseconds
-                value = value / 1_000_000.0
-            elif value > 1e11:  # milliseconds
-                value = value / 1000.0
-            dt = datetime.fromtimestamp(value, tz=timezone.utc)
+def resolve_insulin_facts(facts):
+    """Split ``(treatment_id, injection_idx, time_id, ts, name, units)`` facts by
+    whether the insulin type id is already known. Returns ``(rows, waiting)``."""
+    rows = []
+    waiting = []
+    for mysqlid, idx, time_id, ts_epoch, name, units in facts:
+        type_id = get_insulin_type_id(name)
+        if type_id is None:
+            waiting.append((mysqlid, idx, time_id, ts_epoch, name, units))
         else:
-            string_value = str(value)
-            if string_value.endswith("Z"):
-                string_value = string_value[:-1] + "+00:00"
-            dt = datetime.fromisoformat(string_value)
-            if dt.tzinfo is None:
-                dt = dt.replace(tzinfo=timezone.utc)
-    except Exception:
-        return None
+            rows.append((mysqlid, idx, time_id, ts_epoch, type_id, units))
+    return rows, waiting
 
-    if offset_minutes:
-        dt += timedelta(minutes=offset_minutes)
-    return dt
 
+def stream_rows(query, chunk_size, params=()):
+    """Yield lists of at most *chunk_size* rows, see Backend.stream().
+
+    The rows never have to be held in memory at once while ``cur`` keeps
+    writing facts.
+    """
+    yield from backend.stream(db_conn, query, params, chunk_size)
+
+
+def fact_times(values, offset_minutes=0):
+    """Return ``(time_id, ts)`` for each raw timestamp, None where undated."""
+    return [
+        None if math.isnan(ts) else (get_time_id(int(ts)), int(ts))
+        for ts in epoch_seconds(values, offset_minutes).tolist()
+    ]
+
+
+def glucose_facts(rows):
+    """Return the fact_glucose rows for entries rows, skipping undated ones."""
+    times = fact_times([row[1] for row in rows], offset_minutes=OFFSET_MINUTES)
+    return [
+        (mysqlid, *when, sgv, delta, direction)
+        for (mysqlid, _, sgv, delta, direction), when in zip(rows, times)
+        if when
+    ]
+
+
+def load_glucose_row(*row):
+    for fact in glucose_facts([row]):
+        cur.execute(GLUCOSE_REPLACE, fact)
 
-def load_glucose():
-    cur.execute(
-        "SELECT mysqlid, date, sgv, delta, direction FROM entries"
-    )
-    for row in cur.fetchall():
-        mysqlid, date_val, sgv, delta, direction = row
-        dt = parse_time(date_val, offset_minutes=120)
-        if not dt:
-            continue
-        time_id = get_time_id(dt)
-        ts_epoch = int(dt.timestamp())
-        cur.execute(
-            "REPLACE INTO fact_glucose (entry_id, time_id, ts, sgv, delta, direction) VALUES (%s,%s,%s,%s,%s,%s)",
-            (mysqlid, time_id, ts_epoch, sgv, delta, direction),
-        )
+
+def load_glucose(chunk_size=DEFAULT_CHUNK_SIZE, since=None, where=None, params=()):
+    """Load fact_glucose.
+
+    *since* limits it to entries changed after that state and *where*/*params*
+    to an extra condition such as a partition range.
+    """
+    since_sql, since_params = since_clause(since)
+    query = "SELECT mysqlid, date, sgv, delta, direction FROM entries" + where_sql([since_sql, where])
+    for rows in stream_rows(query, chunk_size, since_params + tuple(params)):
+        facts = glucose_facts(rows)
+        if facts:
+            cur.executemany(GLUCOSE_REPLACE, facts)
 
 
 def parse_insulin_json(text):
@@ -218,49 +522,286 @@ def parse_insulin_json(text):
     return result
 
 
-def load_treatments():
-    cur.execute(
-        "SELECT mysqlid, epocdate, eventType, carbs, protein, fat, insulinInjections, notes FROM treatments"
-    )
-    for (
-        mysqlid,
-        epocdate,
-        event_type,
-        carbs,
-        protein,
-        fat,
-        injections_text,
-        notes,
-    ) in cur.fetchall():
-        dt = parse_time(epocdate)
-        if not dt:
+def treatment_facts(rows):
+    """Return ``(meal_facts, insulin_facts)`` for treatments rows.
+
+    Insulin facts carry the insulin name; resolve_insulin_facts() maps it to
+    the dimension id.
+    """
+    meals = []
+    insulin = []
+    times = fact_times([row[1] for row in rows])
+    for (mysqlid, _, event_type, carbs, protein, fat, injections_text, notes), when in zip(rows, times):
+        if not when:
             continue
-        time_id = get_time_id(dt)
-        ts_epoch = int(dt.timestamp())
+        time_id, ts_epoch = when
         if event_type and "meal" in event_type.lower():
-            cur.execute(
-                "REPLACE INTO fact_meal (treatment_id, time_id, ts, carbs, protein, fat) VALUES (%s,%s,%s,%s,%s,%s)",
-                (mysqlid, time_id, ts_epoch, carbs, protein, fat),
-            )
+            meals.append((mysqlid, time_id, ts_epoch, carbs, protein, fat))
         skip_insulin = notes and "priming" in notes.lower()
         injections = [] if skip_insulin else parse_insulin_json(injections_text)
-        for inj in injections:
+        for idx, inj in enumerate(injections):
             name = inj.get("name") or "Unknown"
             units = inj.get("units")
-            insulin_type_id = get_insulin_type_id(name)
-            cur.execute(
-                "INSERT INTO fact_insulin (treatment_id, time_id, ts, insulin_type_id, units) VALUES (%s,%s,%s,%s,%s)",
-                (mysqlid, time_id, ts_epoch, insulin_type_id, units),
+            insulin.append((mysqlid, idx, time_id, ts_epoch, name, units))
+    return meals, insulin
+
+
+def delete_insulin_facts(treatment_ids):
+    """Drop the insulin facts of treatments about to be reloaded, so doses
+    removed from an edited treatment do not linger."""
+    if treatment_ids:
+        placeholders = ", ".join(["%s"] * len(treatment_ids))
+        cur.execute(f"DELETE FROM fact_insulin WHERE treatment_id IN ({placeholders})", treatment_ids)
+
+
+def load_treatment_row(*row):
+    meals, insulin = treatment_facts([row])
+    delete_insulin_facts([row[0]])
+    for meal in meals:
+        cur.execute(MEAL_REPLACE, meal)
+    rows, waiting = resolve_insulin_facts(insulin)
+    if waiting:
+        flush_insulin_types()
+        rows += resolve_insulin_facts(waiting)[0]
+    if rows:
+        cur.executemany(INSULIN_INSERT, rows)
+
+
+def load_treatments(chunk_size=DEFAULT_CHUNK_SIZE, meals=True, since=None, where=None, params=()):
+    """Load fact_meal and fact_insulin; with *meals* False only insulin.
+
+    *since* and *where*/*params* narrow the source rows as for load_glucose().
+    """
+    since_sql, since_params = since_clause(since)
+    conditions = [since_sql, where]
+    if not meals:
+        conditions.append("insulinInjections IS NOT NULL AND insulinInjections <> ''")
+    query = (
+        "SELECT mysqlid, epocdate, eventType, carbs, protein, fat, insulinInjections, notes "
+        "FROM treatments" + where_sql(conditions)
+    )
+    params = since_params + tuple(params)
+    # Doses of insulin names not yet in dim_insulin_type wait until the new
+    # names have been inserted together at the end of the load.
+    waiting = []
+    for rows in stream_rows(query, chunk_size, params):
+        meal_rows, insulin = treatment_facts(rows)
+        if meal_rows and meals:
+            cur.executemany(MEAL_REPLACE, meal_rows)
+        delete_insulin_facts([row[0] for row in rows])
+        ready, pending = resolve_insulin_facts(insulin)
+        waiting.extend(pending)
+        if ready:
+            cur.executemany(INSULIN_INSERT, ready)
+    if waiting:
+        flush_insulin_types()
+        ready = resolve_insulin_facts(waiting)[0]
+        cur.executemany(INSULIN_INSERT, ready)
+
+
+def month_partitions(table, column):
+    """Split *table* into disjoint ``(label, where, params)`` ranges of *column*.
+
+    Millisecond timestamps are cut at UTC month starts; values in other units
+    or missing ones go into one final catch-all range so no row is skipped.
+    """
+    ms_range = f"{column} > 1e11 AND {column} <= 1e14"
+    cur.execute(f"SELECT MIN({column}), MAX({column}) FROM {table} WHERE {ms_range}")
+    low, high = cur.fetchone()
+    partitions = []
+    if low is not None:
+        first = datetime.fromtimestamp(low / 1000, tz=timezone.utc)
+        month = datetime(first.year, first.month, 1, tzinfo=timezone.utc)
+        while month.timestamp() * 1000 <= high:
+            if month.month == 12:
+                following = month.replace(year=month.year + 1, month=1)
+            else:
+                following = month.replace(month=month.month + 1)
+            partitions.append(
+                (
+                    f"{table} {month:%Y-%m}",
+                    f"{column} >= %s AND {column} < %s",
+                    (int(month.timestamp() * 1000), int(following.timestamp() * 1000)),
+                )
             )
+            month = following
+    partitions.append((f"{table} other", f"NOT ({ms_range}) OR {column} IS NULL", ()))
+    return partitions
+
+
+def prepare_dimensions(chunk_size=DEFAULT_CHUNK_SIZE):
+    """Create every dim_time minute and dim_insulin_type name up front so
+    parallel workers only ever read the dimensions."""
+    preload_time_ids(chunk_size)
+    query = "SELECT insulinInjections FROM treatments WHERE insulinInjections IS NOT NULL"
+    for rows in stream_rows(query, chunk_size):
+        for (text,) in rows:
+            for inj in parse_insulin_json(text):
+                get_insulin_type_id(inj.get("name") or "Unknown")
+    flush_insulin_types()
+
+
+def init_worker(url):
+    """Give each worker process its own connection and dimension caches."""
+    open_db(url)
+    # Forked workers inherit the coordinator's caches; spawned ones reload.
+    if not _minute_ts:
+        preload_time_ids(generate=False)
+    load_insulin_types()
+
+
+def load_partition(task):
+    table, label, where, params, chunk_size = task
+    start = time.monotonic()
+    if table == "entries":
+        load_glucose(chunk_size, where=f"({where})", params=params)
+    else:
+        load_treatments(chunk_size, where=f"({where})", params=params)
+    return label, time.monotonic() - start
+
+
+def load_parallel(workers, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Transform month ranges of entries and treatments in *workers* processes."""
+    prepare_dimensions(chunk_size)
+    tasks = [
+        ("entries", label, where, params, chunk_size)
+        for label, where, params in month_partitions("entries", "date")
+    ]
+    tasks += [
+        ("treatments", label, where, params, chunk_size)
+        for label, where, params in month_partitions("treatments", "epocdate")
+    ]
+    start = time.monotonic()
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=(db_url,)) as pool:
+        for label, elapsed in pool.imap_unordered(load_partition, tasks):
+            print(f"[{label}] {elapsed:.1f}s")
+    print(f"Loaded {len(tasks)} partitions in {time.monotonic() - start:.1f}s")
+
+
+def build_with_sql(chunk_size=DEFAULT_CHUNK_SIZE):
+    """Build dim_time, fact_glucose and fact_meal inside MySQL.
+
+    Only fact_insulin, which needs the insulinInjections JSON parsed, is
+    loaded through Python.
+    """
+    # dim_time stores UTC calendar fields, as get_time_id() does.
+    cur.execute("SET time_zone = '+00:00'")
+    cur.execute(
+        f"""
+        INSERT IGNORE INTO dim_time (ts, date, hour, minute, dow, month, year)
+        SELECT m, DATE(FROM_UNIXTIME(m)), HOUR(FROM_UNIXTIME(m)), MINUTE(FROM_UNIXTIME(m)),
+               WEEKDAY(FROM_UNIXTIME(m)), MONTH(FROM_UNIXTIME(m)), YEAR(FROM_UNIXTIME(m))
+        FROM (
+            SELECT FLOOR({GLUCOSE_TS_SQL} / 60) * 60 AS m
+            FROM entries e WHERE e.date IS NOT NULL
+            UNION
+            SELECT FLOOR({TREATMENT_TS_SQL} / 60) * 60
+            FROM treatments t WHERE t.epocdate IS NOT NULL
+        ) minutes
+        """
+    )
+    cur.execute(
+        f"""
+        REPLACE INTO fact_glucose (entry_id, time_id, ts, sgv, delta, direction)
+        SELECT g.mysqlid, d.time_id, g.ts, g.sgv, g.delta, g.direction
+        FROM (
+            SELECT e.mysqlid, {GLUCOSE_TS_SQL} AS ts, e.sgv, e.delta, e.direction
+            FROM entries e WHERE e.date IS NOT NULL
+        ) g
+        JOIN dim_time d ON d.ts = FLOOR(g.ts / 60) * 60
+        """
+    )
+    cur.execute(
+        f"""
+        REPLACE INTO fact_meal (treatment_id, time_id, ts, carbs, protein, fat)
+        SELECT m.mysqlid, d.time_id, m.ts, m.carbs, m.protein, m.fat
+        FROM (
+            SELECT t.mysqlid, {TREATMENT_TS_SQL} AS ts, t.carbs, t.protein, t.fat
+            FROM treatments t
+            WHERE t.epocdate IS NOT NULL AND LOWER(t.eventType) LIKE '%meal%'
+        ) m
+        JOIN dim_time d ON d.ts = FLOOR(m.ts / 60) * 60
+        """
+    )
+    preload_time_ids(chunk_size, generate=False)
+    load_treatments(chunk_size, meals=False)
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Build the star schema from the raw tables")
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help=f"Source rows processed per batch (default: {DEFAULT_CHUNK_SIZE})",
+    )
+    parser.add_argument(
+        "--sql-pushdown",
+        action="store_true",
+        help="Build dim_time, fact_glucose and fact_meal with INSERT ... SELECT in MySQL",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only transform entries/treatments added or changed since the last run",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Worker processes for a full build, one month of data per task (default: 1)",
+    )
+    parser.add_argument(
+        "--db",
+        help="Database: mysql, sqlite:PATH or duckdb:PATH (default: $CGM_DB, else mysql)",
+    )
+    args = parser.parse_args()
+    if args.incremental and (args.sql_pushdown or args.workers > 1):
+        parser.error("--incremental cannot be combined with --sql-pushdown or --workers")
+
+    try:
+        open_db(args.db)
+    except ValueError as exc:
+        parser.error(str(exc))
+    if backend.name != "mysql" and (args.sql_pushdown or args.workers > 1):
+        parser.error("--sql-pushdown and --workers need the MySQL database")
     create_dimension_tables()
     create_fact_tables()
-    load_glucose()
-    load_treatments()
+    if insulin_key_missing():
+        # Every mode below reloads all treatments once their state is reset.
+        rebuild_insulin_key()
+    migrate(cur)
+    entries_marks = source_marks("entries")
+    treatments_marks = source_marks("treatments")
+    # First day whose facts change (None: any day), for bump_data_version()
+    changed_from, changed = None, True
+    if args.incremental:
+        entries_state = get_state("entries")
+        treatments_state = get_state("treatments")
+        # After a short sync only a handful of minutes are needed, which is
+        # cheaper than preloading the whole dimension; the first run is full.
+        if entries_state is None or treatments_state is None:
+            preload_time_ids(args.chunk_size)
+        elif backend.name == "mysql":
+            # earliest_change() uses MySQL expressions; elsewhere any day may change.
+            changed_from = earliest_change(entries_state, treatments_state)
+            changed = changed_from is not None
+        load_glucose(args.chunk_size, since=entries_state)
+        load_treatments(args.chunk_size, since=treatments_state)
+    elif args.sql_pushdown:
+        build_with_sql(args.chunk_size)
+    elif args.workers > 1:
+        load_parallel(args.workers, args.chunk_size)
+    else:
+        preload_time_ids(args.chunk_size)
+        load_glucose(args.chunk_size)
+        load_treatments(args.chunk_size)
+    save_state("entries", *entries_marks)
+    save_state("treatments", *treatments_marks)
+    if changed:
+        bump_data_version(cur, changed_from)
     cur.close()
-    mysql_conn.close()
+    db_conn.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,217 @@
+"""Maintain the ``fact_daily_summary`` rollup of the star schema.
+
+Usage::
+
+    python daily_summary.py [--full | --since YYYY-MM-DD]
+
+One row per ``dim_time.date`` holds the glucose mean, SD and CV, the share
+of readings in each consensus range band, the glucose management indicator
+(GMI), the number of readings at or above SPIKE_THRESHOLD, total carbs and
+total bolus/basal units. Readings of 39 mg/dL or less are sensor errors and
+left out, as on the day views.
+
+The fact tables carry an auto-updated ``modified_at`` column, so by default
+only the days with facts added or changed since the previous run (tracked
+in ``star_state``) are rebuilt. Deleted facts leave no trace there; run with
+``--since`` or ``--full`` after e.g. cleanup_insulin.py.
+"""
+
+import os
+import argparse
+from datetime import datetime
+import pymysql
+from migrations import bump_data_version, migrate
+
+MYSQL_HOST = os.environ.get("MYSQLHOST", "localhost")
+MYSQL_USER = os.environ.get("MYSQLUSER", "root")
+MYSQL_PASSWORD = os.environ.get("MYSQLPW", "")
+MYSQL_DB = os.environ.get("MYSQLDB", "test")
+
+# Readings at or above this count as spikes (mg/dL), as on the day views
+SPIKE_THRESHOLD = 180
+
+# Days rebuilt per statement
+DAY_BATCH = 200
+
+STATE_SOURCE = "fact_daily_summary"
+
+# {days} is replaced by a date filter on dt.date (or nothing for all days).
+GLUCOSE_SUMMARY = f"""
+    INSERT INTO fact_daily_summary (
+        date, readings, mean_sgv, sd_sgv, cv,
+        pct_very_low, pct_low, pct_in_range, pct_high, pct_very_high,
+        gmi, spike_count
+    )
+    SELECT g.date, g.readings, g.mean_sgv, g.sd_sgv, 100 * g.sd_sgv / g.mean_sgv,
+           100 * g.very_low / g.readings, 100 * g.low / g.readings,
+           100 * g.in_range / g.readings, 100 * g.high / g.readings,
+           100 * g.very_high / g.readings,
+           3.31 + 0.02392 * g.mean_sgv, g.spikes
+    FROM (
+        SELECT dt.date, COUNT(*) AS readings, AVG(fg.sgv) AS mean_sgv,
+               STDDEV_SAMP(fg.sgv) AS sd_sgv,
+               SUM(fg.sgv < 54) AS very_low,
+               SUM(fg.sgv BETWEEN 54 AND 69) AS low,
+               SUM(fg.sgv BETWEEN 70 AND 180) AS in_range,
+               SUM(fg.sgv BETWEEN 181 AND 250) AS high,
+               SUM(fg.sgv > 250) AS very_high,
+               SUM(fg.sgv >= {SPIKE_THRESHOLD}) AS spikes
+        FROM fact_glucose fg
+        JOIN dim_time dt ON fg.time_id = dt.time_id
+        WHERE fg.sgv > 39 {{days}}
+        GROUP BY dt.date
+    ) g
+"""
+
+CARBS_SUMMARY = """
+    INSERT INTO fact_daily_summary (date, total_carbs)
+    SELECT dt.date, COALESCE(SUM(fm.carbs), 0)
+    FROM fact_meal fm
+    JOIN dim_time dt ON fm.time_id = dt.time_id
+    WHERE 1=1 {days}
+    GROUP BY dt.date
+    ON DUPLICATE KEY UPDATE total_carbs = VALUES(total_carbs)
+"""
+
+INSULIN_SUMMARY = """
+    INSERT INTO fact_daily_summary (date, bolus_units, basal_units)
+    SELECT dt.date,
+           COALESCE(SUM(CASE WHEN dit.insulin_class = 'bolus' THEN fi.units END), 0),
+           COALESCE(SUM(CASE WHEN dit.insulin_class = 'basal' THEN fi.units END), 0)
+    FROM fact_insulin fi
+    JOIN dim_time dt ON fi.time_id = dt.time_id
+    JOIN dim_insulin_type dit ON fi.insulin_type_id = dit.insulin_type_id
+    WHERE 1=1 {days}
+    GROUP BY dt.date
+    ON DUPLICATE KEY UPDATE bolus_units = VALUES(bolus_units), basal_units = VALUES(basal_units)
+"""
+
+
+def connect_mysql():
+    return pymysql.connect(
+        host=MYSQL_HOST,
+        user=MYSQL_USER,
+        password=MYSQL_PASSWORD,
+        database=MYSQL_DB,
+        charset="utf8mb4",
+        autocommit=True,
+    )
+
+
+def parse_date(value: str):
+    try:
+        return datetime.fromisoformat(value).date()
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(f"Invalid date: {value}") from exc
+
+
+def get_state(cur):
+    cur.execute("SELECT last_modified FROM star_state WHERE source=%s", (STATE_SOURCE,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def save_state(cur, last_modified):
+    cur.execute(
+        "INSERT INTO star_state (source, last_modified) VALUES (%s,%s) "
+        "ON DUPLICATE KEY UPDATE last_modified=VALUES(last_modified)",
+        (STATE_SOURCE, last_modified),
+    )
+
+
+def changed_days(cur, since):
+    """Dates with facts added or changed at or after *since* (a DATETIME)."""
+    days = set()
+    for table in ("fact_glucose", "fact_meal", "fact_insulin"):
+        cur.execute(
+            f"SELECT DISTINCT dt.date FROM {table} f "
+            "JOIN dim_time dt ON f.time_id = dt.time_id WHERE f.modified_at >= %s",
+            (since,),
+        )
+        days.update(row[0] for row in cur.fetchall())
+    return sorted(days)
+
+
+def days_from(cur, start):
+    """Dates on or after *start* with facts or an existing summary row."""
+    cur.execute("SELECT date FROM fact_daily_summary WHERE date >= %s", (start,))
+    days = {row[0] for row in cur.fetchall()}
+    for table in ("fact_glucose", "fact_meal", "fact_insulin"):
+        cur.execute(
+            f"SELECT DISTINCT dt.date FROM {table} f "
+            "JOIN dim_time dt ON f.time_id = dt.time_id WHERE dt.date >= %s",
+            (start,),
+        )
+        days.update(row[0] for row in cur.fetchall())
+    return sorted(days)
+
+
+def rebuild(conn, days=None):
+    """Recompute the summary rows of *days*, or of every day when None.
+
+    Each batch of days is deleted and re-aggregated in one transaction, so
+    readers never see a half-built day.
+    """
+    batches = [None] if days is None else [
+        days[i:i + DAY_BATCH] for i in range(0, len(days), DAY_BATCH)
+    ]
+    with conn.cursor() as cur:
+        for batch in batches:
+            if batch is None:
+                delete, days_sql, params = "DELETE FROM fact_daily_summary", "", ()
+            else:
+                placeholders = ", ".join(["%s"] * len(batch))
+                delete = f"DELETE FROM fact_daily_summary WHERE date IN ({placeholders})"
+                days_sql = f"AND dt.date IN ({placeholders})"
+                params = tuple(batch)
+            conn.begin()
+            try:
+                cur.execute(delete, params or None)
+                for statement in (GLUCOSE_SUMMARY, CARBS_SUMMARY, INSULIN_SUMMARY):
+                    cur.execute(statement.format(days=days_sql), params or None)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Refresh the fact_daily_summary rollup")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        "--full",
+        action="store_true",
+        help="Rebuild every day instead of only days with new or changed facts",
+    )
+    group.add_argument(
+        "--since",
+        type=parse_date,
+        help="Rebuild every day from this date (YYYY-MM-DD) onwards",
+    )
+    args = parser.parse_args()
+
+    conn = connect_mysql()
+    cur = conn.cursor()
+    migrate(cur)
+    cur.execute("SELECT NOW()")
+    started = cur.fetchone()[0]
+
+    state = None if args.full else get_state(cur)
+    if args.since is not None:
+        days = days_from(cur, args.since)
+    elif state is None:
+        days = None
+    else:
+        days = changed_days(cur, state)
+
+    rebuild(conn, days)
+    if days is None or days:
+        bump_data_version(cur, days[0] if days else None)
+    print("Rebuilt all days" if days is None else f"Rebuilt {len(days)} days")
+    save_state(cur, started)
+    cur.close()
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
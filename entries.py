@@ -1,27 +1,85 @@
-from collections import defaultdict
 from pymongo import MongoClient
-from pprint import pprint
+from pprint import pformat, pprint
+import argparse
+import ast
 import os
 
-client = MongoClient(os.environ["MONGODBKEY"])
-db     = client["nightscout"]
+SCHEMA_FILE = os.path.join(os.path.dirname(__file__), "mondodbschema.txt")
 
-def infer_schema(db, sample_size=100):
+# BSON $type names mapped to the python type names used in mondodbschema.txt
+BSON_TYPE_NAMES = {
+    "objectId": "ObjectId",
+    "double": "float",
+    "int": "int",
+    "long": "int",
+    "decimal": "Decimal128",
+    "string": "str",
+    "bool": "bool",
+    "date": "datetime",
+    "object": "dict",
+    "array": "list",
+    "null": "NoneType",
+    "binData": "bytes",
+    "timestamp": "Timestamp",
+}
+
+
+def infer_schema(db, sample_size=100, previous=None):
+    """Infer field types per collection without pulling documents.
+
+    The server samples *sample_size* documents, flattens each one into
+    key/value pairs and groups the ``$type`` of every value by key, so only
+    the field/type summary crosses the wire. A collection whose sample is
+    empty keeps its entry from *previous*, or is left out.
+    """
+    previous = previous or {}
+    pipeline = [
+        {"$sample": {"size": sample_size}},
+        {"$project": {"kv": {"$objectToArray": "$$ROOT"}}},
+        {"$unwind": "$kv"},
+        {"$group": {"_id": "$kv.k", "types": {"$addToSet": {"$type": "$kv.v"}}}},
+    ]
     schema = {}
     for coll_name in db.list_collection_names():
-        coll = db[coll_name]
-        field_types = defaultdict(set)
+        field_types = {}
+        for row in db[coll_name].aggregate(pipeline):
+            field_types[row["_id"]] = sorted(
+                {BSON_TYPE_NAMES.get(t, t) for t in row["types"]}
+            )
+        if field_types:
+            schema[coll_name] = field_types
+        elif coll_name in previous:
+            schema[coll_name] = previous[coll_name]
+
+    return schema
 
-        # sample up to sample_size docs
-        for doc in coll.find({}, limit=sample_size):
-            for k, v in doc.items():
-                field_types[k].add(type(v).__name__)
 
-        # convert sets to sorted lists
-        schema[coll_name] = {k: sorted(list(types)) for k, types in field_types.items()}
+def read_schema(path=SCHEMA_FILE):
+    try:
+        with open(path) as f:
+            return ast.literal_eval(f.read())
+    except FileNotFoundError:
+        return {}
+
+
+def write_schema(schema, path=SCHEMA_FILE):
+    with open(path, "w") as f:
+        f.write(pformat(schema) + "\n")
 
-    return schema
 
 if __name__ == "__main__":
-    schema = infer_schema(db, sample_size=200)
-    pprint(schema)
+    parser = argparse.ArgumentParser(description="Infer Mongo collection schemas")
+    parser.add_argument("--sample-size", type=int, default=200)
+    parser.add_argument(
+        "--write",
+        action="store_true",
+        help="Write the result to mondodbschema.txt instead of printing it",
+    )
+    args = parser.parse_args()
+    client = MongoClient(os.environ["MONGODBKEY"])
+    schema = infer_schema(client["nightscout"], sample_size=args.sample_size, previous=read_schema())
+    client.close()
+    if args.write:
+        write_schema(schema)
+    else:
+        pprint(schema)
@@ -0,0 +1,314 @@
+"""Export the star schema to a Parquet dataset partitioned by year and month.
+
+Usage::
+
+    python export_parquet.py [--out star_parquet] [--full] [--compression zstd]
+
+``fact_glucose``, ``fact_meal``, ``fact_insulin`` and ``dim_time`` are
+written as ``<out>/<table>/year=YYYY/month=MM/part.parquet`` (hive-style
+partitions, readable by pyarrow.dataset, DuckDB or pandas); the month is
+the UTC ``dim_time`` month of each row. ``dim_insulin_type`` is small and
+rewritten as a single file on every run.
+
+Each run compares the per-month row count and latest ``modified_at`` of
+every table with ``_manifest.json`` from the previous export and rewrites
+only the months that differ, so deleted facts are noticed as well. The
+state lives with the dataset instead of ``star_state`` so that removing or
+copying the directory cannot leave it out of step.
+
+compute_metrics.py reads the dataset with ``--parquet DIR`` through
+read_facts(), loading only the columns and months it needs.
+
+Requires pyarrow.
+"""
+
+import os
+import json
+import shutil
+import argparse
+from datetime import datetime, timezone
+import pymysql
+from migrations import migrate
+
+MYSQL_HOST = os.environ.get("MYSQLHOST", "localhost")
+MYSQL_USER = os.environ.get("MYSQLUSER", "root")
+MYSQL_PASSWORD = os.environ.get("MYSQLPW", "")
+MYSQL_DB = os.environ.get("MYSQLDB", "test")
+
+DEFAULT_OUT = "star_parquet"
+DEFAULT_COMPRESSION = "zstd"
+
+MANIFEST = "_manifest.json"
+PART_FILE = "part.parquet"
+
+# Partitioned tables: (key column, ts column, change tracking column,
+# columns with their Arrow type names). year and month of dim_time are
+# the partition keys and so are not repeated inside the files.
+PARTITIONED = {
+    "fact_glucose": (
+        "entry_id",
+        "ts",
+        "modified_at",
+        [
+            ("entry_id", "int32"),
+            ("time_id", "int32"),
+            ("ts", "int64"),
+            ("sgv", "int32"),
+            ("delta", "float64"),
+            ("direction", "string"),
+        ],
+    ),
+    "fact_meal": (
+        "treatment_id",
+        "ts",
+        "modified_at",
+        [
+            ("treatment_id", "int32"),
+            ("time_id", "int32"),
+            ("ts", "int64"),
+            ("carbs", "float64"),
+            ("protein", "float64"),
+            ("fat", "float64"),
+            ("classification", "string"),
+        ],
+    ),
+    "fact_insulin": (
+        "fact_id",
+        "ts",
+        "modified_at",
+        [
+            ("fact_id", "int32"),
+            ("treatment_id", "int32"),
+            ("injection_idx", "int32"),
+            ("time_id", "int32"),
+            ("ts", "int64"),
+            ("insulin_type_id", "int32"),
+            ("units", "float64"),
+        ],
+    ),
+    "dim_time": (
+        "time_id",
+        "ts",
+        None,
+        [
+            ("time_id", "int32"),
+            ("ts", "int64"),
+            ("date", "date32"),
+            ("hour", "int8"),
+            ("minute", "int8"),
+            ("dow", "int8"),
+        ],
+    ),
+}
+
+DIMENSIONS = {
+    "dim_insulin_type": [
+        ("insulin_type_id", "int32"),
+        ("insulin_name", "string"),
+        ("insulin_class", "string"),
+    ],
+}
+
+
+def connect_mysql():
+    return pymysql.connect(
+        host=MYSQL_HOST,
+        user=MYSQL_USER,
+        password=MYSQL_PASSWORD,
+        database=MYSQL_DB,
+        charset="utf8mb4",
+        autocommit=True,
+    )
+
+
+def month_bounds(year, month):
+    """``[start, end)`` of a UTC calendar month in epoch seconds."""
+    start = datetime(year, month, 1, tzinfo=timezone.utc)
+    end = datetime(year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+    return int(start.timestamp()), int(end.timestamp())
+
+
+def month_of(ts):
+    day = datetime.fromtimestamp(ts, tz=timezone.utc)
+    return day.year, day.month
+
+
+def partition_dir(root, table, year, month):
+    return os.path.join(root, table, f"year={year:04d}", f"month={month:02d}")
+
+
+def existing_columns(cur, table, columns):
+    """*columns* restricted to those *table* has (classification is optional)."""
+    cur.execute(f"SELECT * FROM {table} LIMIT 0")
+    present = {column[0] for column in cur.description}
+    return [(name, kind) for name, kind in columns if name in present]
+
+
+def arrow_table(rows, columns):
+    import pyarrow as pa
+
+    values = list(zip(*rows)) if rows else [()] * len(columns)
+    return pa.table(
+        {name: pa.array(list(column), type=getattr(pa, kind)()) for (name, kind), column in zip(columns, values)}
+    )
+
+
+def write_parquet(rows, columns, path, compression):
+    """Write *rows* to *path*, replacing any previous file atomically."""
+    import pyarrow.parquet as pq
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    pq.write_table(arrow_table(rows, columns), tmp, compression=compression)
+    os.replace(tmp, path)
+
+
+def month_marks(cur, table, modified):
+    """``{"YYYY-MM": [rows, latest modified_at]}`` over the months of *table*."""
+    latest = f"MAX(f.{modified})" if modified else "NULL"
+    cur.execute(
+        f"""
+        SELECT dt.year, dt.month, COUNT(*), {latest}
+        FROM {table} f
+        JOIN dim_time dt ON f.time_id = dt.time_id
+        GROUP BY dt.year, dt.month
+        """
+    )
+    return {
+        f"{year:04d}-{month:02d}": [count, None if last is None else str(last)]
+        for year, month, count, last in cur.fetchall()
+    }
+
+
+def export_table(cur, root, table, previous, compression, full=False):
+    """Rewrite the months of *table* whose marks differ from *previous*,
+    or all of them when *full*, and drop months that no longer have rows.
+
+    Returns the new marks and the number of partitions written.
+    """
+    key, ts, modified, columns = PARTITIONED[table]
+    columns = existing_columns(cur, table, columns)
+    select = ", ".join(f"f.{name}" for name, _ in columns)
+    marks = month_marks(cur, table, modified)
+    written = 0
+    for month_key, mark in sorted(marks.items()):
+        if not full and previous.get(month_key) == mark:
+            continue
+        year, month = map(int, month_key.split("-"))
+        start, end = month_bounds(year, month)
+        cur.execute(
+            f"SELECT {select} FROM {table} f WHERE f.{ts} >= %s AND f.{ts} < %s ORDER BY f.{key}",
+            (start, end),
+        )
+        write_parquet(
+            cur.fetchall(), columns, os.path.join(partition_dir(root, table, year, month), PART_FILE), compression
+        )
+        written += 1
+    for month_key in set(previous) - set(marks):
+        year, month = map(int, month_key.split("-"))
+        shutil.rmtree(partition_dir(root, table, year, month), ignore_errors=True)
+        written += 1
+    return marks, written
+
+
+def export_dimension(cur, root, table, compression):
+    columns = DIMENSIONS[table]
+    cur.execute(f"SELECT {', '.join(name for name, _ in columns)} FROM {table} ORDER BY {columns[0][0]}")
+    write_parquet(cur.fetchall(), columns, os.path.join(root, table, PART_FILE), compression)
+
+
+def load_manifest(root):
+    try:
+        with open(os.path.join(root, MANIFEST)) as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(root, manifest):
+    os.makedirs(root, exist_ok=True)
+    path = os.path.join(root, MANIFEST)
+    with open(path + ".tmp", "w") as fh:
+        json.dump(manifest, fh, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def export(conn, root, full=False, compression=DEFAULT_COMPRESSION):
+    """Bring the dataset under *root* up to date; return partitions written."""
+    manifest = load_manifest(root)
+    written = 0
+    with conn.cursor() as cur:
+        for table in PARTITIONED:
+            marks, count = export_table(cur, root, table, manifest.get(table, {}), compression, full)
+            manifest[table] = marks
+            written += count
+            # Save after each table so an interrupted run resumes where it stopped.
+            save_manifest(root, manifest)
+        for table in DIMENSIONS:
+            export_dimension(cur, root, table, compression)
+    return written
+
+
+def read_facts(root, table, columns, start=None, end=None):
+    """Read *columns* of a partitioned table as a pyarrow Table.
+
+    With *start*/*end* (epoch seconds, inclusive) whole months outside the
+    range are skipped without opening their files, and rows are filtered on
+    ``ts`` inside the remaining ones.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    if not os.path.isdir(os.path.join(root, table)):
+        # Nothing was exported for an empty table.
+        return arrow_table([], [c for c in PARTITIONED[table][3] if c[0] in columns])
+    partitioning = ds.partitioning(pa.schema([("year", pa.int16()), ("month", pa.int8())]), flavor="hive")
+    dataset = ds.dataset(os.path.join(root, table), format="parquet", partitioning=partitioning)
+    year, month, ts = ds.field("year"), ds.field("month"), ds.field(PARTITIONED[table][1])
+    condition = None
+    if start is not None:
+        first_year, first_month = month_of(start)
+        condition = ((year > first_year) | ((year == first_year) & (month >= first_month))) & (ts >= start)
+    if end is not None:
+        last_year, last_month = month_of(end)
+        upper = ((year < last_year) | ((year == last_year) & (month <= last_month))) & (ts <= end)
+        condition = upper if condition is None else condition & upper
+    return dataset.to_table(columns=columns, filter=condition)
+
+
+def read_dimension(root, table, columns=None):
+    import pyarrow.parquet as pq
+
+    return pq.read_table(os.path.join(root, table, PART_FILE), columns=columns)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the star schema to partitioned Parquet files")
+    parser.add_argument(
+        "--out",
+        default=DEFAULT_OUT,
+        help=f"Dataset directory (default: {DEFAULT_OUT})",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Rewrite every partition instead of only changed months",
+    )
+    parser.add_argument(
+        "--compression",
+        default=DEFAULT_COMPRESSION,
+        choices=["zstd", "snappy", "gzip", "lz4", "none"],
+        help=f"Parquet compression codec (default: {DEFAULT_COMPRESSION})",
+    )
+    args = parser.parse_args()
+
+    conn = connect_mysql()
+    with conn.cursor() as cur:
+        migrate(cur)
+    written = export(conn, args.out, args.full, args.compression)
+    conn.close()
+    print(f"Wrote {written} partitions to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
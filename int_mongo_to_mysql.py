@@ -1,6 +1,9 @@
 import os
 import json
 import ast
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 from pymongo import MongoClient
 import pymysql
 
@@ -13,26 +16,35 @@ MYSQL_DB = os.environ.get("MYSQLDB", "test")
 if MONGODB_URI is None:
     raise RuntimeError("MONGODBKEY environment variable not set")
 
+# Collections large enough to be split into _id ranges copied in parallel
+PARTITIONED_COLLECTIONS = {"entries", "devicestatus"}
+
+DEFAULT_WORKERS = 4
+DEFAULT_PARTITIONS = 8
+DEFAULT_BATCH_SIZE = 1000
+# Rows between progress lines printed by each worker
+PROGRESS_EVERY = 50000
+
 # Read MongoDB schema
 SCHEMA_FILE = os.path.join(os.path.dirname(__file__), "mondodbschema.txt")
 with open(SCHEMA_FILE, "r") as f:
     schema = ast.literal_eval(f.read())
 
-# Connect to MongoDB
+# Connect to MongoDB. The client is thread-safe and pools its connections,
+# so every worker shares it while opening its own cursor.
 mongo_client = MongoClient(MONGODB_URI)
 mongo_db = mongo_client.get_default_database()
 
-# Connect to MySQL
-mysql_conn = pymysql.connect(
-    host="localhost",
-    user=MYSQL_USER,
-    password=MYSQL_PASSWORD,
-    database=MYSQL_DB,
-    charset="utf8mb4",
-    autocommit=True,
-)
 
-cur = mysql_conn.cursor()
+def connect_mysql():
+    return pymysql.connect(
+        host="localhost",
+        user=MYSQL_USER,
+        password=MYSQL_PASSWORD,
+        database=MYSQL_DB,
+        charset="utf8mb4",
+        autocommit=True,
+    )
 
 
 def mysql_type(field_types):
@@ -44,23 +56,45 @@ def mysql_type(field_types):
     return "TEXT"
 
 
-# Create tables for each collection based on schema
-for coll_name, fields in schema.items():
-    if not fields:
-        # store entire document as JSON
-        cur.execute(
-            f"CREATE TABLE IF NOT EXISTS `{coll_name}` (doc JSON)"
+def create_tables(cur, schema):
+    """Create tables for each collection based on schema"""
+    for coll_name, fields in schema.items():
+        if not fields:
+            # store entire document as JSON
+            cur.execute(
+                f"CREATE TABLE IF NOT EXISTS `{coll_name}` (doc JSON)"
+            )
+            continue
+        columns = []
+        for field, types in fields.items():
+            if field == "_id":
+                col_type = "VARCHAR(255)"
+            else:
+                col_type = mysql_type(set(types))
+            columns.append(f"`{field}` {col_type}")
+        column_sql = ", ".join(columns)
+        cur.execute(f"CREATE TABLE IF NOT EXISTS `{coll_name}` ({column_sql})")
+
+
+def evolve_tables(cur, schema):
+    """Add columns for fields that appeared since the tables were created.
+
+    Existing columns are left untouched, so data already copied stays in
+    place; only ``ALTER TABLE ... ADD COLUMN`` is issued.
+    """
+    for coll_name, fields in schema.items():
+        if not fields:
+            continue
+        cur.execute(f"SHOW COLUMNS FROM `{coll_name}`")
+        existing = {row[0] for row in cur.fetchall()}
+        missing = [field for field in fields if field not in existing]
+        if not missing:
+            continue
+        additions = ", ".join(
+            f"ADD COLUMN `{field}` {mysql_type(set(fields[field]))}" for field in missing
         )
-        continue
-    columns = []
-    for field, types in fields.items():
-        if field == "_id":
-            col_type = "VARCHAR(255)"
-        else:
-            col_type = mysql_type(set(types))
-        columns.append(f"`{field}` {col_type}")
-    column_sql = ", ".join(columns)
-    cur.execute(f"CREATE TABLE IF NOT EXISTS `{coll_name}` ({column_sql})")
+        cur.execute(f"ALTER TABLE `{coll_name}` {additions}")
+        print(f"{coll_name}: added columns {', '.join(missing)}")
 
 
 # Function to prepare values for insertion
@@ -80,28 +114,156 @@ def prepare_value(value):
     return value
 
 
-# Copy data from MongoDB to MySQL
-for coll_name, fields in schema.items():
+def id_ranges(coll_name, partitions):
+    """Split a collection into ``_id`` range queries of similar time span.
+
+    ObjectIds start with their creation time, so evenly spaced timestamps
+    between the first and last document give ranges that follow the insert
+    history. Collections whose ids are not ObjectIds are copied whole.
+    """
+    from bson import ObjectId
+
     collection = mongo_db[coll_name]
-    docs = collection.find({})
+    first = collection.find_one({}, {"_id": 1}, sort=[("_id", 1)])
+    last = collection.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+    if (
+        partitions < 2
+        or first is None
+        or not isinstance(first["_id"], ObjectId)
+        or not isinstance(last["_id"], ObjectId)
+    ):
+        return [{}]
+
+    start = first["_id"].generation_time
+    span = (last["_id"].generation_time - start) / partitions
+    bounds = [ObjectId.from_datetime(start + span * i) for i in range(1, partitions)]
+    lows = [first["_id"]] + bounds
+    highs = bounds + [None]
+    queries = []
+    for low, high in zip(lows, highs):
+        if high is None:
+            queries.append({"_id": {"$gte": low}})
+        else:
+            queries.append({"_id": {"$gte": low, "$lt": high}})
+    return queries
+
+
+def copy_range(coll_name, fields, query, label, batch_size):
+    """Copy the documents matching *query* on a dedicated MySQL connection."""
+    conn = connect_mysql()
+    cur = conn.cursor()
+    docs = mongo_db[coll_name].find(query).batch_size(batch_size)
 
-    if not fields:
+    if fields:
+        field_names = list(fields.keys())
+        placeholders = ", ".join(["%s"] * len(field_names))
+        insert_sql = f"INSERT INTO `{coll_name}` ({', '.join('`'+f+'`' for f in field_names)}) VALUES ({placeholders})"
+
+        def to_row(doc):
+            return [prepare_value(doc.get(f)) for f in field_names]
+    else:
         # Insert whole document as JSON
-        for doc in docs:
-            cur.execute(
-                f"INSERT INTO `{coll_name}` (doc) VALUES (%s)",
-                (json.dumps(doc, default=str),),
-            )
-        continue
+        insert_sql = f"INSERT INTO `{coll_name}` (doc) VALUES (%s)"
 
-    field_names = list(fields.keys())
-    placeholders = ", ".join(["%s"] * len(field_names))
-    insert_sql = f"INSERT INTO `{coll_name}` ({', '.join('`'+f+'`' for f in field_names)}) VALUES ({placeholders})"
+        def to_row(doc):
+            return (json.dumps(doc, default=str),)
 
+    start = time.monotonic()
+    total = 0
+    batch = []
     for doc in docs:
-        values = [prepare_value(doc.get(f)) for f in field_names]
-        cur.execute(insert_sql, values)
+        batch.append(to_row(doc))
+        if len(batch) >= batch_size:
+            cur.executemany(insert_sql, batch)
+            total += len(batch)
+            batch = []
+            if total % PROGRESS_EVERY < batch_size:
+                elapsed = time.monotonic() - start
+                print(f"[{label}] {total} rows ({total / elapsed:.0f} rows/s)")
+    if batch:
+        cur.executemany(insert_sql, batch)
+        total += len(batch)
+
+    cur.close()
+    conn.close()
+    elapsed = time.monotonic() - start
+    rate = total / elapsed if elapsed > 0 else 0.0
+    print(f"[{label}] done: {total} rows in {elapsed:.1f}s ({rate:.0f} rows/s)")
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Copy every Mongo collection into MySQL")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help=f"Concurrent copy workers (default: {DEFAULT_WORKERS})",
+    )
+    parser.add_argument(
+        "--partitions",
+        type=int,
+        default=DEFAULT_PARTITIONS,
+        help=f"_id ranges per large collection (default: {DEFAULT_PARTITIONS})",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help=f"Rows per batched insert (default: {DEFAULT_BATCH_SIZE})",
+    )
+    parser.add_argument(
+        "--infer",
+        action="store_true",
+        help="Infer the schema on the server and update mondodbschema.txt first",
+    )
+    parser.add_argument(
+        "--sample-size",
+        type=int,
+        default=200,
+        help="Documents sampled per collection with --infer (default: 200)",
+    )
+    args = parser.parse_args()
+
+    collections = schema
+    if args.infer:
+        from entries import infer_schema, write_schema
+
+        # Empty collections sample as {}; keep what the file already knew.
+        collections = infer_schema(mongo_db, sample_size=args.sample_size, previous=schema)
+        write_schema(collections, SCHEMA_FILE)
+
+    conn = connect_mysql()
+    cur = conn.cursor()
+    create_tables(cur, collections)
+    evolve_tables(cur, collections)
+    cur.close()
+    conn.close()
+
+    # Copy data from MongoDB to MySQL
+    tasks = []
+    for coll_name, fields in collections.items():
+        if coll_name in PARTITIONED_COLLECTIONS:
+            queries = id_ranges(coll_name, args.partitions)
+        else:
+            queries = [{}]
+        for i, query in enumerate(queries, 1):
+            label = coll_name if len(queries) == 1 else f"{coll_name} {i}/{len(queries)}"
+            tasks.append((coll_name, fields, query, label))
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = [
+            pool.submit(copy_range, coll_name, fields, query, label, args.batch_size)
+            for coll_name, fields, query, label in tasks
+        ]
+        total = sum(future.result() for future in futures)
+    elapsed = time.monotonic() - start
+    rate = total / elapsed if elapsed > 0 else 0.0
+    print(f"Copied {total} rows in {elapsed:.1f}s ({rate:.0f} rows/s)")
+
+    mongo_client.close()
+
 
-cur.close()
-mysql_conn.close()
-mongo_client.close()
+if __name__ == "__main__":
+    main()
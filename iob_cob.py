@@ -0,0 +1,283 @@
+"""Materialise insulin-on-board and carbs-on-board into ``fact_iob_cob``.
+
+Usage::
+
+    python iob_cob.py [--full | --since YYYY-MM-DD]
+
+IOB uses the absorption curve ``ka / (ka - ke) * (exp(-ke t) - exp(-ka t))``
+of every bolus dose over its action duration, with ``ka``/``ke``/``duration``
+taken from the matching ``insulin_rules`` row. COB decays each meal's carbs
+linearly over CARB_DURATION minutes. Doses and meals are binned per minute
+and convolved with these curves, so a dose late in the evening still counts
+after midnight. One row is stored per STEP seconds where either value is
+non-zero.
+
+Like daily_summary.py, this follows the ``modified_at`` column of the fact
+tables it reads: by default only the time from the earliest dose or meal fact
+added or changed since the previous run (tracked in ``star_state``) is
+recomputed, so facts loaded or re-derived by create_star_schema.py after a
+run are picked up by the next one. Run with ``--since`` or ``--full`` after
+deleting facts, e.g. with cleanup_insulin.py.
+"""
+
+import os
+import argparse
+from collections import defaultdict
+from datetime import datetime, timezone
+import numpy as np
+import pymysql
+from migrations import bump_data_version, migrate
+
+MYSQL_HOST = os.environ.get("MYSQLHOST", "localhost")
+MYSQL_USER = os.environ.get("MYSQLUSER", "root")
+MYSQL_PASSWORD = os.environ.get("MYSQLPW", "")
+MYSQL_DB = os.environ.get("MYSQLDB", "test")
+
+# Resolution of fact_iob_cob (seconds)
+STEP = 300
+
+# Action curve for bolus insulin without one in insulin_rules:
+# ka absorption and ke elimination rate (per minute), duration in minutes.
+DEFAULT_ACTION = (0.03, 0.008, 300)
+
+# Minutes until carbs are fully absorbed
+CARB_DURATION = 120
+
+# Rows per INSERT statement
+INSERT_BATCH = 5000
+
+STATE_SOURCE = "fact_iob_cob"
+
+
+def connect_mysql():
+    return pymysql.connect(
+        host=MYSQL_HOST,
+        user=MYSQL_USER,
+        password=MYSQL_PASSWORD,
+        database=MYSQL_DB,
+        charset="utf8mb4",
+        autocommit=True,
+    )
+
+
+def parse_since(value: str) -> int:
+    try:
+        day = datetime.fromisoformat(value).date()
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(f"Invalid date: {value}") from exc
+    return int(datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp())
+
+
+def insulin_curve(ka, ke, duration):
+    """Fraction of a dose on board 0 .. duration-1 minutes after injection."""
+    tau = np.arange(duration, dtype=np.float64)
+    return (ka / (ka - ke)) * (np.exp(-ke * tau) - np.exp(-ka * tau))
+
+
+def carb_curve(duration=CARB_DURATION):
+    """Fraction of a meal's carbs left 0 .. duration-1 minutes after eating."""
+    tau = np.arange(duration, dtype=np.float64)
+    return 1 - tau / duration
+
+
+def on_board(ts, amounts, curve, first_minute, minutes):
+    """Return the amount on board for each of *minutes* minutes from
+    *first_minute* (epoch minutes), for events at *ts* (epoch seconds)."""
+    offsets = np.asarray(ts, dtype=np.int64) // 60 - first_minute
+    keep = (offsets >= 0) & (offsets < minutes)
+    series = np.bincount(
+        offsets[keep], weights=np.asarray(amounts, dtype=np.float64)[keep], minlength=minutes
+    )
+    return np.convolve(series, curve)[:minutes]
+
+
+def compute(doses, meals, start, end):
+    """Return ``(ts, iob, cob)`` arrays on the STEP grid from *start* to *end*.
+
+    *doses* are ``(ts, units, (ka, ke, duration))`` and *meals* ``(ts, carbs)``;
+    both must include everything that can still be on board at *start*.
+    """
+    start = start // STEP * STEP
+    grid = np.arange(start, end + 1, STEP, dtype=np.int64)
+    reach = max([CARB_DURATION] + [action[2] for _, _, action in doses])
+    first_minute = start // 60 - reach
+    minutes = end // 60 - first_minute + 1
+    samples = grid // 60 - first_minute
+
+    iob = np.zeros(len(grid))
+    by_action = defaultdict(lambda: ([], []))
+    for ts, units, action in doses:
+        by_action[action][0].append(ts)
+        by_action[action][1].append(units or 0.0)
+    for (ka, ke, duration), (ts, units) in by_action.items():
+        iob += on_board(ts, units, insulin_curve(ka, ke, duration), first_minute, minutes)[samples]
+
+    cob = np.zeros(len(grid))
+    if meals:
+        ts, carbs = zip(*meals)
+        carbs = [c or 0.0 for c in carbs]
+        cob = on_board(ts, carbs, carb_curve(), first_minute, minutes)[samples]
+    return grid, iob, cob
+
+
+def load_actions(cur):
+    """Return ``{insulin_name: (ka, ke, duration)}`` for the bolus insulins.
+
+    Each name takes the curve of its first matching insulin_rules row, as
+    create_star_schema.py classifies it, or DEFAULT_ACTION.
+    """
+    cur.execute(
+        "SELECT pattern, ka, ke, duration FROM insulin_rules "
+        "ORDER BY priority DESC, CHAR_LENGTH(pattern) DESC"
+    )
+    rules = cur.fetchall()
+    cur.execute("SELECT insulin_name FROM dim_insulin_type WHERE insulin_class = 'bolus'")
+    actions = {}
+    for (name,) in cur.fetchall():
+        action = DEFAULT_ACTION
+        for pattern, ka, ke, duration in rules:
+            if pattern.lower() in (name or "").lower():
+                if ka is not None and ke is not None and duration:
+                    action = (ka, ke, int(duration))
+                break
+        actions[name] = action
+    return actions
+
+
+def load_facts(cur, since, actions):
+    """Return the bolus doses and meals from *since* (epoch seconds) on,
+    with each dose's action curve looked up in *actions*."""
+    cur.execute(
+        """
+        SELECT fi.ts, fi.units, dit.insulin_name
+        FROM fact_insulin fi
+        JOIN dim_insulin_type dit ON fi.insulin_type_id = dit.insulin_type_id
+        WHERE dit.insulin_class = 'bolus' AND fi.ts >= %s
+        """,
+        (since,),
+    )
+    doses = [(ts, units, actions.get(name, DEFAULT_ACTION)) for ts, units, name in cur.fetchall()]
+    cur.execute("SELECT ts, carbs FROM fact_meal WHERE ts >= %s AND carbs > 0", (since,))
+    return doses, list(cur.fetchall())
+
+
+def get_state(cur):
+    cur.execute("SELECT last_modified FROM star_state WHERE source=%s", (STATE_SOURCE,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def save_state(cur, last_modified):
+    cur.execute(
+        "INSERT INTO star_state (source, last_id, last_modified) VALUES (%s,NULL,%s) "
+        "ON DUPLICATE KEY UPDATE last_id=NULL, last_modified=VALUES(last_modified)",
+        (STATE_SOURCE, last_modified),
+    )
+
+
+def fact_mark(cur):
+    """The newest ``modified_at`` of the dose and meal facts.
+
+    ``modified_at`` has whole seconds, so while the current second is still
+    open the mark stays one second behind it; changed_since() can then use
+    ``>`` without missing a write later in that second.
+    """
+    cur.execute(
+        "SELECT NOW() - INTERVAL 1 SECOND, "
+        "(SELECT MAX(modified_at) FROM fact_insulin), (SELECT MAX(modified_at) FROM fact_meal)"
+    )
+    settled, *latest = cur.fetchone()
+    latest = [mark for mark in latest if mark is not None]
+    return min(settled, max(latest)) if latest else settled
+
+
+def changed_since(cur, since):
+    """Earliest ``ts`` of dose and meal facts added or changed after *since*."""
+    starts = []
+    for table in ("fact_insulin", "fact_meal"):
+        cur.execute(f"SELECT MIN(ts) FROM {table} WHERE modified_at > %s", (since,))
+        starts.append(cur.fetchone()[0])
+    starts = [ts for ts in starts if ts is not None]
+    return min(starts) if starts else None
+
+
+def refresh(conn, start):
+    """Recompute fact_iob_cob from *start* (epoch seconds) onwards.
+
+    Returns the number of rows written.
+    """
+    start = start // STEP * STEP
+    with conn.cursor() as cur:
+        actions = load_actions(cur)
+        # Longest time (seconds) a dose or meal stays on board
+        reach = max([CARB_DURATION] + [action[2] for action in actions.values()]) * 60
+        doses, meals = load_facts(cur, start - reach, actions)
+        rows = []
+        if doses or meals:
+            stamps = [ts for ts, _, _ in doses] + [ts for ts, _ in meals]
+            end = max(
+                [ts + action[2] * 60 for ts, _, action in doses]
+                + [ts + CARB_DURATION * 60 for ts, _ in meals]
+            )
+            # A full refresh starts at the first fact rather than at 0.
+            first = max(start, min(stamps) // STEP * STEP)
+            if end >= first:
+                grid, iob, cob = compute(doses, meals, first, end)
+                keep = (iob > 0) | (cob > 0)
+                rows = list(zip(grid[keep].tolist(), iob[keep].tolist(), cob[keep].tolist()))
+        conn.begin()
+        try:
+            cur.execute("DELETE FROM fact_iob_cob WHERE ts >= %s", (start,))
+            for i in range(0, len(rows), INSERT_BATCH):
+                cur.executemany(
+                    "INSERT INTO fact_iob_cob (ts, iob, cob) VALUES (%s,%s,%s)",
+                    rows[i:i + INSERT_BATCH],
+                )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute insulin and carbs on board")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        "--full",
+        action="store_true",
+        help="Recompute the whole series instead of only changed treatments",
+    )
+    group.add_argument(
+        "--since",
+        type=parse_since,
+        help="Recompute from this date (YYYY-MM-DD, UTC) onwards",
+    )
+    args = parser.parse_args()
+
+    conn = connect_mysql()
+    cur = conn.cursor()
+    migrate(cur)
+    mark = fact_mark(cur)
+
+    state = None if args.full or args.since is not None else get_state(cur)
+    if args.since is not None:
+        start = args.since
+    elif state is None:
+        start = 0
+    else:
+        start = changed_since(cur, state)
+
+    if start is None:
+        print("fact_iob_cob is up to date")
+    else:
+        written = refresh(conn, start)
+        bump_data_version(cur, start or None)
+        print(f"Wrote {written} IOB/COB rows")
+    save_state(cur, mark)
+    cur.close()
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
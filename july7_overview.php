@@ -57,6 +57,13 @@ $glucose_sql = "SELECT dt.ts, dt.hour, dt.minute, fg.sgv, fg.delta, fg.direction
                 ORDER BY dt.ts";
 $glucose = query_rows($mysqli, $glucose_sql, [$date, $threshold]);
 
+// Daily rollup maintained by daily_summary.py
+$summary_sql = "SELECT readings, mean_sgv, sd_sgv, cv, pct_in_range, pct_low, pct_very_low,
+                       pct_high, pct_very_high, gmi, spike_count, total_carbs, bolus_units, basal_units
+                FROM fact_daily_summary
+                WHERE date = ?";
+$summary = query_rows($mysqli, $summary_sql, [$date])[0] ?? null;
+
 $format_ts = function($ts) {
     // dim_time.ts stores epoch seconds already
     return date('Y-m-d H:i', $ts);
@@ -65,6 +72,22 @@ $format_ts = function($ts) {
 echo "Overview for $date\n";
 echo str_repeat('-', 40) . "\n";
 
+echo "Summary:\n";
+if ($summary && $summary['readings'] > 0) {
+    printf("Mean: %.0f mg/dL, SD: %.0f, CV: %.1f%%, GMI: %.1f%%\n",
+        $summary['mean_sgv'], $summary['sd_sgv'], $summary['cv'], $summary['gmi']);
+    printf("In range: %.0f%%, low: %.0f%%, very low: %.0f%%, high: %.0f%%, very high: %.0f%% (%d readings)\n",
+        $summary['pct_in_range'], $summary['pct_low'], $summary['pct_very_low'],
+        $summary['pct_high'], $summary['pct_very_high'], $summary['readings']);
+}
+if ($summary) {
+    printf("Spikes: %d, Carbs: %s g, Bolus: %s units, Basal: %s units\n",
+        $summary['spike_count'], $summary['total_carbs'], $summary['bolus_units'], $summary['basal_units']);
+} else {
+    echo "No summary (run daily_summary.py)." . PHP_EOL;
+}
+echo "\n";
+
 echo "Meals:\n";
 if ($meals) {
     foreach ($meals as $m) {
@@ -0,0 +1,165 @@
+"""In-memory window lookups for compute_metrics.py.
+
+Glucose readings and bolus times are loaded once into sorted NumPy arrays.
+Window averages then come from ``searchsorted`` plus prefix sums and bolus
+checks from interval counts, for every meal at once, instead of one query
+per meal and window.
+
+Usage::
+
+    python metrics_engine.py [CASES]    # check against a brute-force reference
+"""
+
+import sys
+from decimal import ROUND_HALF_UP, Decimal
+import numpy as np
+
+
+class MetricsEngine:
+    def __init__(self, glucose_ts, glucose_sgv, bolus_ts, bolus_units=None):
+        glucose_ts = np.asarray(glucose_ts, dtype=np.int64)
+        order = np.argsort(glucose_ts, kind="stable")
+        self.glucose_ts = glucose_ts[order]
+        sgv = np.asarray(glucose_sgv, dtype=np.int64)[order]
+        self.sgv_cumsum = np.concatenate(([0], np.cumsum(sgv)))
+        bolus_ts = np.asarray(bolus_ts, dtype=np.int64)
+        order = np.argsort(bolus_ts, kind="stable")
+        self.bolus_ts = bolus_ts[order]
+        if bolus_units is None:
+            bolus_units = [None] * len(bolus_ts)
+        # Python floats (None for a NULL dose) so sums match MySQL's SUM().
+        self.bolus_amounts = [bolus_units[i] for i in order]
+
+    @classmethod
+    def from_db(cls, cur, start=None, end=None):
+        """Load readings and bolus times, optionally only between *start*
+        and *end* (epoch seconds)."""
+        start = -2**62 if start is None else start
+        end = 2**62 if end is None else end
+        cur.execute(
+            "SELECT ts, sgv FROM fact_glucose "
+            "WHERE sgv IS NOT NULL AND ts IS NOT NULL AND ts BETWEEN %s AND %s",
+            (start, end),
+        )
+        glucose = cur.fetchall()
+        cur.execute(
+            """
+            SELECT fi.ts, fi.units
+            FROM fact_insulin fi
+            JOIN dim_insulin_type dit ON fi.insulin_type_id = dit.insulin_type_id
+            WHERE dit.insulin_class = 'bolus'
+              AND fi.ts BETWEEN %s AND %s
+            """,
+            (start, end),
+        )
+        bolus = cur.fetchall()
+        return cls(
+            [row[0] for row in glucose],
+            [row[1] for row in glucose],
+            [row[0] for row in bolus],
+            [row[1] for row in bolus],
+        )
+
+    def avg_glucose(self, starts, ends):
+        """Mean sgv with ``starts <= ts <= ends`` per window; NaN when empty.
+
+        Matches MySQL, which returns AVG() of an INT column as a DECIMAL
+        rounded half-up to four places.
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        lo = np.searchsorted(self.glucose_ts, starts, side="left")
+        hi = np.searchsorted(self.glucose_ts, ends, side="right")
+        count = np.maximum(hi - lo, 0)
+        total = self.sgv_cumsum[np.maximum(hi, lo)] - self.sgv_cumsum[lo]
+        divisor = np.where(count > 0, count, 1)
+        scaled = (total * 20000 + divisor) // (2 * divisor)
+        return np.where(count > 0, scaled / 10000.0, np.nan)
+
+    def has_bolus(self, starts, ends):
+        """True where a bolus falls in ``[starts, ends]`` and the window is
+        not empty (``ends > starts``)."""
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        lo = np.searchsorted(self.bolus_ts, starts, side="left")
+        hi = np.searchsorted(self.bolus_ts, ends, side="right")
+        return (ends > starts) & (hi > lo)
+
+    def bolus_units(self, meal_ts, window):
+        """Total bolus units within *window* seconds either side of each meal.
+
+        Like ``SUM(fi.units)`` in the meal query: None when no bolus falls in
+        the window or every dose in it has NULL units.
+        """
+        meal_ts = np.asarray(meal_ts, dtype=np.int64)
+        lo = np.searchsorted(self.bolus_ts, meal_ts - window, side="left")
+        hi = np.searchsorted(self.bolus_ts, meal_ts + window, side="right")
+        totals = []
+        for start, end in zip(lo.tolist(), hi.tolist()):
+            doses = [u for u in self.bolus_amounts[start:end] if u is not None]
+            totals.append(sum(doses) if doses else None)
+        return totals
+
+
+def reference_avg(readings, start, end):
+    """AVG(sgv) over ``start <= ts <= end`` as MySQL returns it, or None."""
+    values = [sgv for ts, sgv in readings if start <= ts <= end]
+    if not values:
+        return None
+    mean = Decimal(sum(values)) / Decimal(len(values))
+    return float(mean.quantize(Decimal("0.0001"), rounding=ROUND_HALF_UP))
+
+
+def check(cases=2000, seed=0):
+    """Compare MetricsEngine with per-window brute force on random data.
+
+    Windows include empty, zero-length and reversed ones, and readings are
+    chosen so means land exactly on the DECIMAL half-up rounding boundary.
+    Returns the number of mismatches.
+    """
+    import random
+
+    rng = random.Random(seed)
+    # 31 readings of 100 and one of 101 average 100.03125, which MySQL
+    # rounds half-up to 100.0313 (round-half-even would give 100.0312).
+    readings = [(1000 + i, 100) for i in range(31)] + [(1031, 101)]
+    readings += [(rng.randrange(2000, 50_000, 60), rng.randint(40, 400)) for _ in range(800)]
+    doses = [(rng.randrange(0, 52_000, 60), rng.choice([None, 1.0, 2.5, 4.0])) for _ in range(120)]
+    engine = MetricsEngine(
+        [ts for ts, _ in readings], [sgv for _, sgv in readings], [ts for ts, _ in doses], [u for _, u in doses]
+    )
+
+    windows = [(1000, 1031), (0, 999), (60_000, 70_000), (5000, 5000), (9000, 8000)]
+    for _ in range(cases):
+        start = rng.randrange(-1000, 53_000)
+        windows.append((start, start + rng.choice([0, 60, 900, 3600, -60])))
+    starts, ends = zip(*windows)
+
+    mismatches = 0
+    averages = engine.avg_glucose(starts, ends).tolist()
+    boluses = engine.has_bolus(starts, ends).tolist()
+    for (start, end), average, bolus in zip(windows, averages, boluses):
+        expected = reference_avg(readings, start, end)
+        if (None if average != average else average) != expected:
+            mismatches += 1
+            print(f"avg_glucose [{start}, {end}]: {average} != {expected}")
+        expected = end > start and any(start <= ts <= end for ts, _ in doses)
+        if bolus != expected:
+            mismatches += 1
+            print(f"has_bolus [{start}, {end}]: {bolus} != {expected}")
+
+    meal_ts = [rng.randrange(0, 52_000) for _ in range(cases)]
+    for ts, total in zip(meal_ts, engine.bolus_units(meal_ts, 3000)):
+        units = [u for t, u in doses if ts - 3000 <= t <= ts + 3000 and u is not None]
+        expected = sum(units) if units else None
+        if total != expected:
+            mismatches += 1
+            print(f"bolus_units {ts}: {total} != {expected}")
+    return mismatches
+
+
+if __name__ == "__main__":
+    cases = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    failed = check(cases)
+    print(f"{'OK' if not failed else f'{failed} MISMATCHES'} over {cases} random windows and meals")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,241 @@
+"""Versioned schema changes for the star-schema tables.
+
+Every script that reads or writes the fact tables calls ``migrate(cur)`` on
+start-up; each migration runs once and is recorded in ``schema_migrations``.
+
+Usage::
+
+    python migrations.py          # apply pending migrations
+    python migrations.py check    # EXPLAIN the hot queries, flag full scans
+"""
+
+import os
+import sys
+from datetime import datetime, timezone
+from backends import run_ddl
+
+MYSQL_HOST = os.environ.get("MYSQLHOST", "localhost")
+MYSQL_USER = os.environ.get("MYSQLUSER", "root")
+MYSQL_PASSWORD = os.environ.get("MYSQLPW", "")
+MYSQL_DB = os.environ.get("MYSQLDB", "test")
+
+# (version, description, statements). Append new entries; never edit old ones.
+MIGRATIONS = [
+    (
+        1,
+        "time-range indexes on the fact tables",
+        [
+            "ALTER TABLE fact_glucose ADD INDEX k_ts_sgv (ts, sgv)",
+            "ALTER TABLE fact_meal ADD INDEX k_ts (ts)",
+            "ALTER TABLE fact_insulin ADD INDEX k_ts (ts), ADD INDEX k_type_ts (insulin_type_id, ts)",
+        ],
+    ),
+    (
+        2,
+        "calendar-day lookups on dim_time",
+        [
+            "ALTER TABLE dim_time ADD INDEX k_date (date)",
+        ],
+    ),
+    (
+        3,
+        "precomputed insulin and carbs on board",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS fact_iob_cob (
+                ts BIGINT PRIMARY KEY,
+                iob DOUBLE NOT NULL,
+                cob DOUBLE NOT NULL
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+            """,
+        ],
+    ),
+    (
+        4,
+        "daily summary rollup and fact change tracking",
+        [
+            "ALTER TABLE fact_glucose ADD COLUMN modified_at TIMESTAMP NOT NULL "
+            "DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP, ADD KEY k_modified_at (modified_at)",
+            "ALTER TABLE fact_meal ADD COLUMN modified_at TIMESTAMP NOT NULL "
+            "DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP, ADD KEY k_modified_at (modified_at)",
+            "ALTER TABLE fact_insulin ADD COLUMN modified_at TIMESTAMP NOT NULL "
+            "DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP, ADD KEY k_modified_at (modified_at)",
+            """
+            CREATE TABLE IF NOT EXISTS fact_daily_summary (
+                date DATE PRIMARY KEY,
+                readings INT NOT NULL DEFAULT 0,
+                mean_sgv DOUBLE,
+                sd_sgv DOUBLE,
+                cv DOUBLE,
+                pct_very_low DOUBLE,
+                pct_low DOUBLE,
+                pct_in_range DOUBLE,
+                pct_high DOUBLE,
+                pct_very_high DOUBLE,
+                gmi DOUBLE,
+                spike_count INT NOT NULL DEFAULT 0,
+                total_carbs DOUBLE NOT NULL DEFAULT 0,
+                bolus_units DOUBLE NOT NULL DEFAULT 0,
+                basal_units DOUBLE NOT NULL DEFAULT 0
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+            """,
+        ],
+    ),
+    (
+        5,
+        "data version log for caches of the star schema",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS data_version (
+                version BIGINT AUTO_INCREMENT PRIMARY KEY,
+                changed_from DATE NULL,
+                bumped_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+            """,
+        ],
+    ),
+]
+
+# Queries the analysis scripts and PHP pages run on every call, with
+# representative parameters filled in by check().
+HOT_QUERIES = {
+    "avg_glucose": (
+        "SELECT AVG(sgv) FROM fact_glucose WHERE ts BETWEEN %(ts)s - 900 AND %(ts)s"
+    ),
+    "correction_bolus": (
+        "SELECT 1 FROM fact_insulin fi "
+        "JOIN dim_insulin_type dit ON fi.insulin_type_id = dit.insulin_type_id "
+        "WHERE dit.insulin_class = 'bolus' AND fi.ts BETWEEN %(ts)s - 7200 AND %(ts)s LIMIT 1"
+    ),
+    "meal_insulin_pairs": (
+        "SELECT m.treatment_id, SUM(fi.units) FROM fact_meal m "
+        "JOIN fact_insulin fi ON fi.ts BETWEEN m.ts - 3000 AND m.ts + 3000 "
+        "JOIN dim_insulin_type dit ON fi.insulin_type_id = dit.insulin_type_id "
+        "WHERE dit.insulin_class = 'bolus' AND m.ts BETWEEN %(ts)s - 2592000 AND %(ts)s "
+        "GROUP BY m.treatment_id"
+    ),
+    "classify_meal_insulin": (
+        "SELECT 1 FROM fact_insulin WHERE ts BETWEEN %(ts)s - 2700 AND %(ts)s + 2700 LIMIT 1"
+    ),
+    "day_glucose": (
+        "SELECT dt.ts, fg.sgv FROM fact_glucose fg "
+        "JOIN dim_time dt ON fg.time_id = dt.time_id "
+        "WHERE dt.date = DATE(FROM_UNIXTIME(%(ts)s)) AND fg.sgv > 39"
+    ),
+    "day_meals": (
+        "SELECT dt.ts, fm.carbs FROM fact_meal fm "
+        "JOIN dim_time dt ON fm.time_id = dt.time_id "
+        "WHERE dt.date = DATE(FROM_UNIXTIME(%(ts)s))"
+    ),
+    "day_iob_cob": (
+        "SELECT ts, iob, cob FROM fact_iob_cob WHERE ts BETWEEN %(ts)s - 86400 AND %(ts)s"
+    ),
+    "day_summary": (
+        "SELECT * FROM fact_daily_summary WHERE date = DATE(FROM_UNIXTIME(%(ts)s))"
+    ),
+    "summary_changed_days": (
+        "SELECT DISTINCT dt.date FROM fact_glucose f "
+        "JOIN dim_time dt ON f.time_id = dt.time_id "
+        "WHERE f.modified_at >= FROM_UNIXTIME(%(ts)s)"
+    ),
+}
+
+# Small tables where a full scan is expected and harmless.
+SCAN_OK = {"dim_insulin_type", "insulin_rules"}
+
+
+def connect_mysql():
+    # migrate() also runs on embedded databases, which must not need pymysql.
+    import pymysql
+
+    return pymysql.connect(
+        host=MYSQL_HOST,
+        user=MYSQL_USER,
+        password=MYSQL_PASSWORD,
+        database=MYSQL_DB,
+        charset="utf8mb4",
+        autocommit=True,
+    )
+
+
+def migrate(cur):
+    """Apply every migration newer than the recorded version.
+
+    The statements are written for MySQL; run_ddl() adapts them to an
+    embedded database (see backends.py).
+    """
+    run_ddl(
+        cur,
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT PRIMARY KEY,
+            description VARCHAR(255),
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+        """
+    )
+    cur.execute("SELECT version FROM schema_migrations")
+    applied = {row[0] for row in cur.fetchall()}
+    for version, description, statements in MIGRATIONS:
+        if version in applied:
+            continue
+        for statement in statements:
+            run_ddl(cur, statement)
+        cur.execute(
+            "INSERT INTO schema_migrations (version, description) VALUES (%s,%s)",
+            (version, description),
+        )
+        print(f"Applied migration {version}: {description}")
+
+
+def bump_data_version(cur, changed_from=None):
+    """Record that the star schema changed from *changed_from* onwards.
+
+    *changed_from* is the first affected ``dim_time.date`` (a date, or epoch
+    seconds), or None when any day may have changed. Caches such as
+    overview_service.py drop the days on or after it.
+    """
+    if isinstance(changed_from, (int, float)):
+        changed_from = datetime.fromtimestamp(changed_from, tz=timezone.utc).date()
+    cur.execute("INSERT INTO data_version (changed_from) VALUES (%s)", (changed_from,))
+
+
+def check(conn):
+    """EXPLAIN each hot query and return the number that scan a whole table."""
+    import pymysql.cursors
+
+    cur = conn.cursor(pymysql.cursors.DictCursor)
+    cur.execute("SELECT COALESCE(MAX(ts), UNIX_TIMESTAMP()) AS ts FROM fact_glucose")
+    params = {"ts": int(cur.fetchone()["ts"])}
+    problems = 0
+    for name, sql in HOT_QUERIES.items():
+        cur.execute("EXPLAIN " + sql, params)
+        scans = [
+            row for row in cur.fetchall()
+            if row.get("type") == "ALL" and row.get("table") not in SCAN_OK
+        ]
+        if scans:
+            problems += 1
+            tables = ", ".join(f"{row['table']} (~{row['rows']} rows)" for row in scans)
+            print(f"FULL SCAN {name}: {tables}")
+        else:
+            print(f"ok        {name}")
+    cur.close()
+    return problems
+
+
+def main():
+    conn = connect_mysql()
+    problems = 0
+    if len(sys.argv) > 1 and sys.argv[1] == "check":
+        problems = check(conn)
+    else:
+        cur = conn.cursor()
+        migrate(cur)
+        cur.close()
+    conn.close()
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
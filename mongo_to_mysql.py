@@ -1,7 +1,13 @@
 import os
 import json
+import time
+import argparse
+from collections import defaultdict
 from pymongo import MongoClient
+from pymongo.errors import OperationFailure
 import pymysql
+from migrations import bump_data_version, migrate
+from timeutil import OFFSET_MINUTES, epoch_ms, parse_time
 
 # Environment variables
 MONGODB_URI = os.environ.get("MONGODBKEY")
@@ -9,6 +15,11 @@ MYSQL_USER = os.environ.get("MYSQLUSER", "root")
 MYSQL_PASSWORD = os.environ.get("MYSQLPW", "")
 MYSQL_DB = os.environ.get("MYSQLDB", "test")
 
+# Number of Mongo documents written per executemany() call.
+DEFAULT_BATCH_SIZE = 1000
+# Seconds between polls when change streams are not available.
+DEFAULT_POLL_INTERVAL = 5
+
 if not MONGODB_URI:
     raise RuntimeError("MONGODBKEY environment variable not set")
 
@@ -64,6 +75,21 @@ TREATMENT_FIELDS = [
     "uuid",
 ]
 
+# High-water-mark fields per collection. Later runs only fetch documents whose
+# value for any of these fields is at or past the last one seen.
+SYNC_FIELDS = {
+    "entries": ["date"],
+    "treatments": ["created_at", "srvModified"],
+}
+# sync_state field holding the ``_id``s of the documents sitting exactly on a
+# mark, which the next run re-reads but does not need to apply again.
+SEEN_FIELD = "_seen"
+
+WATCH_COLLECTIONS = {
+    "entries": ENTRY_FIELDS,
+    "treatments": TREATMENT_FIELDS,
+}
+
 
 def create_tables():
     """Create the tables we need if they don't already exist."""
@@ -85,7 +111,8 @@ def create_tables():
             type TEXT DEFAULT NULL,
             unfiltered DOUBLE DEFAULT NULL,
             utcOffset INT(11) DEFAULT NULL,
-            PRIMARY KEY (mysqlid)
+            PRIMARY KEY (mysqlid),
+            UNIQUE KEY u_id (_id)
         ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
         """
     )
@@ -110,11 +137,54 @@ def create_tables():
             timestamp TEXT DEFAULT NULL,
             utcOffset INT(11) DEFAULT NULL,
             uuid TEXT DEFAULT NULL,
-            PRIMARY KEY (mysqlid)
+            PRIMARY KEY (mysqlid),
+            UNIQUE KEY u_id (_id)
         ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
         """
     )
 
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sync_state (
+            collection VARCHAR(64) NOT NULL,
+            field VARCHAR(64) NOT NULL,
+            value TEXT DEFAULT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            PRIMARY KEY (collection, field)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+        """
+    )
+
+
+def load_sync_state(collection_name):
+    """Return ``{field: last_seen_value}`` stored for *collection_name*."""
+    cur.execute(
+        "SELECT field, value FROM sync_state WHERE collection=%s",
+        (collection_name,),
+    )
+    return {field: json.loads(value) for field, value in cur.fetchall() if value is not None}
+
+
+def save_sync_state(collection_name, marks):
+    cur.executemany(
+        "INSERT INTO sync_state (collection, field, value) VALUES (%s,%s,%s) "
+        "ON DUPLICATE KEY UPDATE value=VALUES(value)",
+        [(collection_name, field, json.dumps(value)) for field, value in marks.items()],
+    )
+
+
+def build_query(marks):
+    """Range query selecting documents at or after any stored mark.
+
+    ``$gte`` rather than ``$gt`` re-reads the boundary documents so readings
+    sharing the last timestamp are never skipped; sync_collection() drops the
+    ones it already applied.
+    """
+    if not marks:
+        return {}
+    clauses = [{field: {"$gte": value}} for field, value in marks.items()]
+    return clauses[0] if len(clauses) == 1 else {"$or": clauses}
+
 
 def prepare_value(value):
     """Convert Mongo values to something MySQL can store."""
@@ -131,42 +201,301 @@ def prepare_value(value):
     return value
 
 
-def upsert_row(table, fields, doc):
-    doc_id = str(doc.get("_id")) if doc.get("_id") is not None else None
+def ensure_unique_id(table):
+    """Add the unique key on ``_id`` to tables created before it existed.
+
+    Duplicate ``_id`` rows left behind by older imports are removed first,
+    keeping the lowest ``mysqlid`` so star-schema facts keep pointing at the
+    original row.
+    """
+    cur.execute(f"SHOW INDEX FROM {table} WHERE Key_name='u_id'")
+    if cur.fetchone():
+        return
+    cur.execute(
+        f"""
+        DELETE t1 FROM {table} t1
+        JOIN {table} t2 ON t1._id = t2._id AND t1.mysqlid > t2.mysqlid
+        """
+    )
+    cur.execute(f"ALTER TABLE {table} ADD UNIQUE KEY u_id (_id)")
+
+
+def upsert_rows(table, fields, docs):
+    """Insert or update a batch of documents in a single round trip."""
+    if not docs:
+        return
+    columns = ", ".join(f"`{f}`" for f in fields)
+    placeholders = ", ".join(["%s"] * len(fields))
+    updates = ", ".join(f"`{f}`=VALUES(`{f}`)" for f in fields if f != "_id")
+    rows = [[prepare_value(doc.get(f)) for f in fields] for doc in docs]
+    cur.executemany(
+        f"INSERT INTO {table} ({columns}) VALUES ({placeholders}) "
+        f"ON DUPLICATE KEY UPDATE {updates}",
+        rows,
+    )
+
+
+def past_mark(value, mark):
+    """Whether a document's *value* for a mark field lies beyond *mark*."""
+    if value is None or isinstance(value, bool):
+        return False
+    # Values whose type differs from the stored mark (e.g. an occasional
+    # string ``date``) cannot be compared and never move it.
+    return mark is None or (type(value) is type(mark) and value > mark)
+
+
+def ensure_mark_indexes(collection, fields):
+    """Index the high-water-mark fields so range queries avoid a collection
+    scan. Read-only users may not create indexes; the sync then runs without."""
+    for field in fields:
+        try:
+            collection.create_index(field)
+        except OperationFailure as exc:
+            print(f"Could not index {collection.name}.{field}, continuing without: {exc}")
 
-    cur.execute(f"SELECT mysqlid FROM {table} WHERE _id=%s", (doc_id,))
-    existing = cur.fetchone()
 
-    values = [prepare_value(doc.get(f)) for f in fields]
+def sync_collection(
+    collection_name,
+    fields,
+    batch_size=DEFAULT_BATCH_SIZE,
+    full=False,
+    on_batch=None,
+    quiet=False,
+    create_indexes=False,
+):
+    """Copy new documents of *collection_name* into MySQL.
 
-    if existing:
-        # Build update statement without _id
-        update_cols = ", ".join(f"`{f}`=%s" for f in fields if f != "_id")
-        update_vals = [prepare_value(doc.get(f)) for f in fields if f != "_id"]
-        update_vals.append(doc_id)
+    *on_batch* is called with every batch of documents after it has been
+    written, which lets the live mode push them on into the star schema.
+    With *create_indexes* the high-water-mark fields are indexed in MongoDB
+    first. Documents already applied on a previous run (same ``_id`` and no
+    mark value past the stored one) are skipped. Returns the number of
+    documents copied.
+    """
+    collection = mongo_db[collection_name]
+    ensure_unique_id(collection_name)
+    mark_fields = SYNC_FIELDS.get(collection_name, [])
+    if create_indexes:
+        ensure_mark_indexes(collection, mark_fields)
+    marks = {} if full else load_sync_state(collection_name)
+    seen = set(marks.pop(SEEN_FIELD, []))
+    projection = {f: 1 for f in set(fields) | set(mark_fields)}
+
+    start = time.monotonic()
+    total = 0
+    batch = []
+    new_marks = dict(marks)
+    # _ids of the documents sitting on each field's newest mark
+    boundary = {field: set() for field in mark_fields}
+
+    def flush():
+        nonlocal total
+        upsert_rows(collection_name, fields, batch)
+        if on_batch and batch:
+            on_batch(batch)
+        total += len(batch)
+        batch.clear()
+
+    cursor = collection.find(build_query(marks), projection).batch_size(batch_size)
+    for doc in cursor:
+        doc_id = prepare_value(doc.get("_id"))
+        for field in mark_fields:
+            value = doc.get(field)
+            if past_mark(value, new_marks.get(field)):
+                new_marks[field] = value
+                boundary[field] = {doc_id}
+            elif value is not None and type(value) is type(new_marks.get(field)) and value == new_marks[field]:
+                boundary[field].add(doc_id)
+        if doc_id in seen and not any(past_mark(doc.get(field), marks.get(field)) for field in mark_fields):
+            continue
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+    # Only advance the marks once every document has been written so an
+    # interrupted run simply repeats the same range next time.
+    new_seen = sorted(set().union(*boundary.values()))
+    if new_marks != marks or set(new_seen) != seen:
+        save_sync_state(collection_name, {**new_marks, SEEN_FIELD: new_seen})
+    elapsed = time.monotonic() - start
+    if total or not quiet:
+        rate = total / elapsed if elapsed > 0 else 0.0
+        print(f"{collection_name}: {total} rows in {elapsed:.1f}s ({rate:.0f} rows/s)")
+    return total
+
+
+def ensure_epocdate_column():
+    cur.execute("SHOW COLUMNS FROM treatments LIKE 'epocdate'")
+    if not cur.fetchone():
+        cur.execute("ALTER TABLE treatments ADD COLUMN epocdate BIGINT DEFAULT NULL")
+
+
+def push_to_star_schema(star, collection_name, docs):
+    """Run freshly upserted documents through the create_star_schema transforms.
+
+    The data version is bumped from the earliest day touched, so caches of
+    older days stay valid.
+    """
+    stamps = []
+    ids = list({prepare_value(doc.get("_id")) for doc in docs})
+    placeholders = ", ".join(["%s"] * len(ids))
+    if collection_name == "entries":
         cur.execute(
-            f"UPDATE {table} SET {update_cols} WHERE _id=%s",
-            update_vals,
+            f"SELECT mysqlid, date, sgv, delta, direction FROM entries WHERE _id IN ({placeholders})",
+            ids,
+        )
+        for row in cur.fetchall():
+            star.load_glucose_row(*row)
+            stamps.append(parse_time(row[1], OFFSET_MINUTES))
+    elif collection_name == "treatments":
+        cur.executemany(
+            "UPDATE treatments SET epocdate=%s WHERE _id=%s",
+            [(epoch_ms(doc.get("created_at"), OFFSET_MINUTES), prepare_value(doc.get("_id"))) for doc in docs],
         )
-    else:
-        placeholders = ", ".join(["%s"] * len(fields))
-        columns = ", ".join(f"`{f}`" for f in fields)
         cur.execute(
-            f"INSERT INTO {table} ({columns}) VALUES ({placeholders})",
-            values,
+            "SELECT mysqlid, epocdate, eventType, carbs, protein, fat, insulinInjections, notes "
+            f"FROM treatments WHERE _id IN ({placeholders})",
+            ids,
         )
+        for row in cur.fetchall():
+            star.load_treatment_row(*row)
+            stamps.append(parse_time(row[1]))
+    stamps = [dt for dt in stamps if dt is not None]
+    if stamps:
+        bump_data_version(cur, min(stamps).date())
 
 
-def sync_collection(collection_name, fields):
-    collection = mongo_db[collection_name]
-    for doc in collection.find({}):
-        upsert_row(collection_name, fields, doc)
+def tail_change_stream(star, batch_size):
+    """Apply inserts and updates from a change stream as they arrive.
+
+    The resume token is kept in ``sync_state`` so a restarted daemon picks up
+    where it stopped.
+    """
+    state = load_sync_state("_watch")
+    pipeline = [
+        {
+            "$match": {
+                "ns.coll": {"$in": list(WATCH_COLLECTIONS)},
+                "operationType": {"$in": ["insert", "update", "replace"]},
+            }
+        }
+    ]
+    with mongo_db.watch(
+        pipeline,
+        full_document="updateLookup",
+        resume_after=state.get("resume_token"),
+        max_await_time_ms=1000,
+    ) as stream:
+        print("Watching entries and treatments via change stream")
+        while stream.alive:
+            pending = defaultdict(list)
+            count = 0
+            change = stream.try_next()
+            while change is not None:
+                doc = change.get("fullDocument")
+                if doc is not None:
+                    pending[change["ns"]["coll"]].append(doc)
+                    count += 1
+                if count >= batch_size:
+                    break
+                change = stream.try_next()
+            if not count:
+                continue
+            for name, docs in pending.items():
+                upsert_rows(name, WATCH_COLLECTIONS[name], docs)
+                push_to_star_schema(star, name, docs)
+            save_sync_state("_watch", {"resume_token": stream.resume_token})
+            print(f"Applied {count} changes")
+
+
+def poll(star, batch_size, interval):
+    """Fallback for servers without change streams: repeated incremental syncs."""
+    print(f"Polling entries and treatments every {interval}s")
+    while True:
+        for name, fields in WATCH_COLLECTIONS.items():
+            sync_collection(
+                name,
+                fields,
+                batch_size,
+                on_batch=lambda docs, name=name: push_to_star_schema(star, name, docs),
+                quiet=True,
+            )
+        time.sleep(interval)
+
+
+def watch(batch_size=DEFAULT_BATCH_SIZE, interval=DEFAULT_POLL_INTERVAL, create_indexes=False):
+    """Keep MySQL and the star schema current with new Nightscout documents."""
+    import create_star_schema as star
+
+    # The sync writes the raw tables in MySQL, so the star schema lives there too.
+    star.open_db("mysql")
+    star.create_dimension_tables()
+    star.create_fact_tables()
+    if star.insulin_key_missing():
+        # Rebuilding the key clears the insulin facts, which only a full load restores.
+        raise SystemExit("fact_insulin predates its natural key; run create_star_schema.py once first")
+    migrate(cur)
+    ensure_epocdate_column()
+
+    # Catch up on anything written while the daemon was not running.
+    for name, fields in WATCH_COLLECTIONS.items():
+        sync_collection(
+            name,
+            fields,
+            batch_size,
+            on_batch=lambda docs, name=name: push_to_star_schema(star, name, docs),
+            create_indexes=create_indexes,
+        )
+    try:
+        tail_change_stream(star, batch_size)
+    except OperationFailure as exc:
+        # Standalone servers do not support change streams.
+        print(f"Change streams unavailable: {exc}")
+        poll(star, batch_size, interval)
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Copy Nightscout collections into MySQL")
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help=f"Documents per batched upsert (default: {DEFAULT_BATCH_SIZE})",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Ignore the stored high-water marks and re-read every document",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running and push new documents into MySQL and the star schema",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=int,
+        default=DEFAULT_POLL_INTERVAL,
+        help=f"Seconds between polls without change streams (default: {DEFAULT_POLL_INTERVAL})",
+    )
+    parser.add_argument(
+        "--create-indexes",
+        action="store_true",
+        help="Index the high-water-mark fields in MongoDB (needs write access there)",
+    )
+    args = parser.parse_args()
+
     create_tables()
-    sync_collection("entries", ENTRY_FIELDS)
-    sync_collection("treatments", TREATMENT_FIELDS)
+    if args.watch:
+        try:
+            watch(args.batch_size, args.poll_interval, args.create_indexes)
+        except KeyboardInterrupt:
+            print("Stopped")
+    else:
+        sync_collection("entries", ENTRY_FIELDS, args.batch_size, args.full, create_indexes=args.create_indexes)
+        sync_collection(
+            "treatments", TREATMENT_FIELDS, args.batch_size, args.full, create_indexes=args.create_indexes
+        )
 
     cur.close()
     mysql_conn.close()
@@ -4,7 +4,7 @@ $user = getenv('MYSQLUSER') ?: 'root';
 $password = getenv('MYSQLPW') ?: '';
 $database = getenv('MYSQLDB') ?: 'test';
 
-$date = $_GET['date'] ?? date('Y-m-d');
+$date = $_GET['date'] ?? gmdate('Y-m-d');
 $threshold_mgdl = 180; // blood glucose spike threshold in mg/dL
 $mgdl_to_mmol = function($v) { return round($v / 18, 1); };
 $threshold = $mgdl_to_mmol($threshold_mgdl); // threshold in mmol/L for display
@@ -51,7 +51,7 @@ $insulin_sql = "SELECT dt.ts, dit.insulin_name, dit.insulin_class, fi.units
                 ORDER BY dt.ts";
 $insulin = query_rows($mysqli, $insulin_sql, [$date]);
 
-// Only bolus insulin should contribute to IOB calculations
+// Only bolus insulin is marked on the chart; IOB comes from fact_iob_cob
 $bolus_insulin = array_values(array_filter(
     $insulin,
     function ($i) { return ($i['insulin_class'] ?? null) === 'bolus'; }
@@ -73,53 +73,40 @@ $glucose_sql = "SELECT dt.ts, fg.sgv
                 ORDER BY dt.ts";
 $glucose = query_rows($mysqli, $glucose_sql, [$date]);
 
-$minutes = function($ts) { return intval(date('H', $ts)) * 60 + intval(date('i', $ts)); };
-
-function compute_iob_points(array $insulin, callable $to_minutes, int $step = 5) {
-    // Pharmacokinetic model parameters for rapid acting insulin
-    // ka: absorption rate constant (per minute), typical ~0.03 min^-1
-    // ke: elimination rate constant (per minute), typical ~0.008 min^-1
-    $ka = 0.03;
-    $ke = 0.008;
-    $duration = 300; // minutes of activity window
-
-    $entries = array_map(function($i) use ($to_minutes) {
-        return ['min' => $to_minutes($i['ts']), 'units' => (float)$i['units']];
-    }, $insulin);
-
-    $points = [];
+// Daily rollup maintained by daily_summary.py
+$summary_sql = "SELECT readings, mean_sgv, sd_sgv, cv, pct_in_range, pct_low, pct_very_low,
+                       pct_high, pct_very_high, gmi, spike_count, total_carbs, bolus_units, basal_units
+                FROM fact_daily_summary
+                WHERE date = ?";
+$summary = query_rows($mysqli, $summary_sql, [$date])[0] ?? null;
+
+// dim_time.date and fact_iob_cob are keyed by UTC day, so plot in UTC too.
+$minutes = function($ts) { return intval(gmdate('H', $ts)) * 60 + intval(gmdate('i', $ts)); };
+
+// Insulin and carbs on board are precomputed at 5-minute resolution by
+// iob_cob.py, so doses from the evening before still count after midnight.
+// Minutes without a stored row have nothing on board.
+function load_on_board_points(mysqli $mysqli, string $date, int $step = 5) {
+    $day_start = strtotime($date . ' 00:00:00 UTC');
+    $rows = query_rows(
+        $mysqli,
+        "SELECT ts, iob, cob FROM fact_iob_cob WHERE ts BETWEEN ? AND ? ORDER BY ts",
+        [$day_start, $day_start + 86400]
+    );
+    $iob = [];
+    $cob = [];
     for ($t = 0; $t <= 1440; $t += $step) {
-        $iob = 0.0;
-        foreach ($entries as $e) {
-            $tau = $t - $e['min'];
-            if ($tau >= 0 && $tau < $duration) {
-                $f = ($ka / ($ka - $ke)) * (exp(-$ke * $tau) - exp(-$ka * $tau));
-                $iob += $f * $e['units'];
-            }
-        }
-        $points[] = ['x' => $t, 'y' => $iob];
+        $iob[$t] = ['x' => $t, 'y' => 0.0];
+        $cob[$t] = ['x' => $t, 'y' => 0.0];
     }
-    return $points;
-}
-
-function compute_cob_points(array $meals, callable $to_minutes, int $step = 5) {
-    $duration = 120; // minutes until carbs fully absorbed
-    $entries = array_map(function($m) use ($to_minutes) {
-        return ['min' => $to_minutes($m['ts']), 'carbs' => (float)$m['carbs']];
-    }, $meals);
-
-    $points = [];
-    for ($t = 0; $t <= 1440; $t += $step) {
-        $cob = 0.0;
-        foreach ($entries as $e) {
-            $tau = $t - $e['min'];
-            if ($tau >= 0 && $tau < $duration) {
-                $cob += $e['carbs'] * (1 - $tau / $duration);
-            }
+    foreach ($rows as $row) {
+        $t = intdiv((int)$row['ts'] - $day_start, 60);
+        if (isset($iob[$t])) {
+            $iob[$t]['y'] = (float)$row['iob'];
+            $cob[$t]['y'] = (float)$row['cob'];
         }
-        $points[] = ['x' => $t, 'y' => $cob];
     }
-    return $points;
+    return [array_values($iob), array_values($cob)];
 }
 
 // Compute average carbohydrate ratio and insulin sensitivity for
@@ -280,10 +267,9 @@ $time_bucket = function(int $min): string {
     return 'evening';
 };
 
-// Pre-compute IOB and COB curves
+// IOB and COB curves
 $step = 5;
-$iob_points = compute_iob_points($bolus_insulin, $minutes, $step);
-$cob_points = compute_cob_points($meals, $minutes, $step);
+[$iob_points, $cob_points] = load_on_board_points($mysqli, $date, $step);
 
 // Linear interpolation helper
 $interp = function(array $points, int $t) use ($step) {
@@ -442,6 +428,22 @@ var chart = new Chart(ctx, {
     }
 });
 </script>
+<h2>Day Summary</h2>
+<?php if ($summary): ?>
+<table border="1" cellpadding="4" cellspacing="0">
+<?php if ($summary['readings'] > 0): ?>
+<tr><th>Mean</th><td><?php echo $mgdl_to_mmol($summary['mean_sgv']); ?> mmol/L</td></tr>
+<tr><th>SD / CV</th><td><?php echo $mgdl_to_mmol($summary['sd_sgv']); ?> mmol/L / <?php echo number_format($summary['cv'], 1); ?>%</td></tr>
+<tr><th>GMI</th><td><?php echo number_format($summary['gmi'], 1); ?>%</td></tr>
+<tr><th>Time in range</th><td><?php echo number_format($summary['pct_in_range'], 0); ?>% (low <?php echo number_format($summary['pct_low'] + $summary['pct_very_low'], 0); ?>%, high <?php echo number_format($summary['pct_high'] + $summary['pct_very_high'], 0); ?>%)</td></tr>
+<?php endif; ?>
+<tr><th>Spikes</th><td><?php echo (int)$summary['spike_count']; ?> readings</td></tr>
+<tr><th>Carbs</th><td><?php echo (float)$summary['total_carbs']; ?> g</td></tr>
+<tr><th>Insulin</th><td><?php echo (float)$summary['bolus_units']; ?> units bolus, <?php echo (float)$summary['basal_units']; ?> units basal</td></tr>
+</table>
+<?php else: ?>
+<p>No summary for this day.</p>
+<?php endif; ?>
 <h2>Computed Metrics</h2>
 <table border="1" cellpadding="4" cellspacing="0">
 <tr><th>Time of Day</th><th>Carb Ratio</th><th>Insulin Sensitivity</th></tr>
@@ -457,7 +459,7 @@ var chart = new Chart(ctx, {
 <?php if ($meals): ?>
 <ul>
 <?php foreach ($meals as $m): ?>
-<li><?php echo date('H:i', $m['ts']); ?> - <?php echo htmlspecialchars($m['meal_type'] ?: 'unknown'); ?> - Carbs: <?php echo $m['carbs']; ?> g, Protein: <?php echo $m['protein']; ?> g, Fat: <?php echo $m['fat']; ?> g</li>
+<li><?php echo gmdate('H:i', $m['ts']); ?> - <?php echo htmlspecialchars($m['meal_type'] ?: 'unknown'); ?> - Carbs: <?php echo $m['carbs']; ?> g, Protein: <?php echo $m['protein']; ?> g, Fat: <?php echo $m['fat']; ?> g</li>
 <?php endforeach; ?>
 </ul>
 <?php else: ?>
@@ -467,7 +469,7 @@ var chart = new Chart(ctx, {
 <?php if ($insulin): ?>
 <ul>
 <?php foreach ($insulin as $i): ?>
-<li><?php echo date('H:i', $i['ts']); ?> - <?php echo $i['units']; ?> units (<?php echo htmlspecialchars($i['insulin_name'] ?: 'unknown'); ?>)</li>
+<li><?php echo gmdate('H:i', $i['ts']); ?> - <?php echo $i['units']; ?> units (<?php echo htmlspecialchars($i['insulin_name'] ?: 'unknown'); ?>)</li>
 <?php endforeach; ?>
 </ul>
 <?php else: ?>
@@ -477,7 +479,7 @@ var chart = new Chart(ctx, {
 <?php if ($glucose_spikes): ?>
 <ul>
 <?php foreach ($glucose_spikes as $g): ?>
-<li><?php echo date('H:i', $g['ts']); ?> - SGV: <?php echo $mgdl_to_mmol($g['sgv']); ?> mmol/L, Delta: <?php echo $mgdl_to_mmol($g['delta']); ?>, Direction: <?php echo htmlspecialchars($g['direction']); ?></li>
+<li><?php echo gmdate('H:i', $g['ts']); ?> - SGV: <?php echo $mgdl_to_mmol($g['sgv']); ?> mmol/L, Delta: <?php echo $mgdl_to_mmol($g['delta']); ?>, Direction: <?php echo htmlspecialchars($g['direction']); ?></li>
 <?php endforeach; ?>
 </ul>
 <?php else: ?>
@@ -0,0 +1,199 @@
+"""Load-test overview_service.py against the days in the local MySQL.
+
+Usage::
+
+    python overview_loadtest.py [--url http://127.0.0.1:8080] [--requests 2000] [--concurrency 20]
+
+The last --days dates of ``fact_daily_summary`` are requested at random by
+--concurrency keep-alive connections, with --today-share of the requests
+going to the most recent day. ``--bump-every N`` records a data version
+change from that day every N seconds, as the ``--watch`` sync does for new
+readings, so it is recomputed while older days stay cached. Throughput,
+latency percentiles and the service's cache hits/misses are printed.
+"""
+
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+from urllib.parse import urlsplit
+import pymysql
+from migrations import bump_data_version
+
+MYSQL_HOST = os.environ.get("MYSQLHOST", "localhost")
+MYSQL_USER = os.environ.get("MYSQLUSER", "root")
+MYSQL_PASSWORD = os.environ.get("MYSQLPW", "")
+MYSQL_DB = os.environ.get("MYSQLDB", "test")
+
+DEFAULT_URL = "http://127.0.0.1:8080"
+DEFAULT_REQUESTS = 2000
+DEFAULT_CONCURRENCY = 20
+DEFAULT_DAYS = 90
+DEFAULT_TODAY_SHARE = 0.2
+
+
+def connect_mysql():
+    return pymysql.connect(
+        host=MYSQL_HOST,
+        user=MYSQL_USER,
+        password=MYSQL_PASSWORD,
+        database=MYSQL_DB,
+        charset="utf8mb4",
+        autocommit=True,
+    )
+
+
+def recent_days(cur, count):
+    """The latest *count* dates with a summary row, newest first."""
+    cur.execute("SELECT date FROM fact_daily_summary ORDER BY date DESC LIMIT %s", (count,))
+    return [row[0] for row in cur.fetchall()]
+
+
+async def get(reader, writer, host, path):
+    """Send one GET over a keep-alive connection; return ``(status, bytes)``."""
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+    await writer.drain()
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("server closed the connection")
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    body = await reader.readexactly(length)
+    return int(status_line.split()[1]), body
+
+
+async def health(host, port):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        _, body = await get(reader, writer, host, "/health")
+    finally:
+        writer.close()
+    return json.loads(body)
+
+
+async def client(host, port, paths, latencies, statuses):
+    """Issue requests from the shared *paths* list until it is empty."""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while paths:
+            path = paths.pop()
+            started = time.perf_counter()
+            try:
+                status, _ = await get(reader, writer, host, path)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                reader, writer = await asyncio.open_connection(host, port)
+                status = "error"
+            latencies.append(time.perf_counter() - started)
+            statuses[status] = statuses.get(status, 0) + 1
+    finally:
+        writer.close()
+
+
+async def bump_periodically(day, interval):
+    conn = connect_mysql()
+    try:
+        with conn.cursor() as cur:
+            while True:
+                await asyncio.sleep(interval)
+                bump_data_version(cur, day)
+    finally:
+        conn.close()
+
+
+def percentile(ordered, pct):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def run(url, requests, concurrency, days, today_share, bump_every):
+    target = urlsplit(url)
+    host, port = target.hostname, target.port or 80
+
+    conn = connect_mysql()
+    with conn.cursor() as cur:
+        dates = recent_days(cur, days)
+    conn.close()
+    if not dates:
+        print("fact_daily_summary is empty; run daily_summary.py first")
+        return
+
+    rng = random.Random(0)
+    today, past = dates[0], dates[1:] or dates
+    paths = [
+        f"/overview?date={(today if rng.random() < today_share else rng.choice(past)).isoformat()}"
+        for _ in range(requests)
+    ]
+    before = await health(host, port)
+    bumper = asyncio.ensure_future(bump_periodically(today, bump_every)) if bump_every else None
+    latencies, statuses = [], {}
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(client(host, port, paths, latencies, statuses) for _ in range(concurrency))
+    )
+    elapsed = time.perf_counter() - started
+    if bumper is not None:
+        bumper.cancel()
+    after = await health(host, port)
+
+    latencies.sort()
+    print(f"{len(latencies)} requests over {len(dates)} days in {elapsed:.2f}s ({len(latencies) / elapsed:.0f} req/s)")
+    print(
+        "latency ms: "
+        + ", ".join(f"p{pct} {percentile(latencies, pct) * 1000:.1f}" for pct in (50, 90, 99))
+        + f", max {latencies[-1] * 1000:.1f}"
+    )
+    print("status: " + ", ".join(f"{status}={count}" for status, count in sorted(statuses.items(), key=str)))
+    hits = after["hits"] - before["hits"]
+    misses = after["misses"] - before["misses"]
+    print(f"cache: {hits} hits, {misses} misses, data version {before['version']} -> {after['version']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the day overview service")
+    parser.add_argument("--url", default=DEFAULT_URL, help=f"Service address (default: {DEFAULT_URL})")
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=DEFAULT_REQUESTS,
+        help=f"Requests to send (default: {DEFAULT_REQUESTS})",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help=f"Parallel keep-alive connections (default: {DEFAULT_CONCURRENCY})",
+    )
+    parser.add_argument(
+        "--days",
+        type=int,
+        default=DEFAULT_DAYS,
+        help=f"Most recent days to spread requests over (default: {DEFAULT_DAYS})",
+    )
+    parser.add_argument(
+        "--today-share",
+        type=float,
+        default=DEFAULT_TODAY_SHARE,
+        help=f"Fraction of requests for the most recent day (default: {DEFAULT_TODAY_SHARE})",
+    )
+    parser.add_argument(
+        "--bump-every",
+        type=float,
+        help="Seconds between data version bumps for the most recent day",
+    )
+    args = parser.parse_args()
+
+    asyncio.run(
+        run(args.url, args.requests, args.concurrency, args.days, args.today_share, args.bump_every)
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,409 @@
+"""Serve the day-overview payload as JSON from an in-memory cache.
+
+Usage::
+
+    python overview_service.py [--host 127.0.0.1] [--port 8080] [--cache-size 400]
+
+``GET /overview?date=YYYY-MM-DD`` returns the same data as
+overview_graph.php: glucose readings, meals, insulin, IOB/COB from
+``fact_iob_cob``, the ``fact_daily_summary`` row and the morning/afternoon/
+evening bucket metrics of compute_metrics.py. The date defaults to today
+(UTC, like ``dim_time.date``). ``GET /health`` reports the data version and
+cache counters.
+
+Day payloads sit in an LRU cache keyed by date and that day's data version.
+The ETL scripts log every change to the star schema in ``data_version``
+together with the first day it touched (see migrations.bump_data_version());
+the log is polled every --poll-interval seconds and a day's version is the
+latest bump starting on or before it. New readings only move today's
+version, so past days are served from memory and today is recomputed on its
+next request. The bucket metrics cover every meal and are recomputed on the
+first request after the latest version moved.
+
+Only the standard library's asyncio server is used; MySQL queries run in a
+thread pool with one connection per thread.
+"""
+
+import os
+import json
+import asyncio
+import argparse
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from urllib.parse import parse_qs, urlsplit
+import pymysql
+import pymysql.cursors
+from compute_metrics import compute_metrics, load_data, summarize
+from migrations import migrate
+
+MYSQL_HOST = os.environ.get("MYSQLHOST", "localhost")
+MYSQL_USER = os.environ.get("MYSQLUSER", "root")
+MYSQL_PASSWORD = os.environ.get("MYSQLPW", "")
+MYSQL_DB = os.environ.get("MYSQLDB", "test")
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+DEFAULT_CACHE_SIZE = 400  # days
+DEFAULT_POLL_INTERVAL = 5  # seconds
+DEFAULT_WORKERS = 4  # threads, each with a MySQL connection
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+_local = threading.local()
+
+
+def connect_mysql():
+    return pymysql.connect(
+        host=MYSQL_HOST,
+        user=MYSQL_USER,
+        password=MYSQL_PASSWORD,
+        database=MYSQL_DB,
+        charset="utf8mb4",
+        autocommit=True,
+    )
+
+
+def thread_connection():
+    """The calling worker thread's MySQL connection, reconnected if dropped."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = connect_mysql()
+    else:
+        conn.ping(reconnect=True)
+    return conn
+
+
+def json_default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def encode(payload):
+    return json.dumps(payload, default=json_default, separators=(",", ":")).encode()
+
+
+def load_day(day, version):
+    """Return the JSON-encoded overview of *day* without the bucket metrics."""
+    start = int(datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp())
+    with thread_connection().cursor(pymysql.cursors.DictCursor) as cur:
+        cur.execute(
+            """
+            SELECT dt.ts, fg.sgv, fg.delta, fg.direction
+            FROM fact_glucose fg
+            JOIN dim_time dt ON fg.time_id = dt.time_id
+            WHERE dt.date = %s AND fg.sgv > 39
+            ORDER BY dt.ts
+            """,
+            (day,),
+        )
+        glucose = cur.fetchall()
+        cur.execute(
+            """
+            SELECT dt.ts, fm.carbs, fm.protein, fm.fat, fm.classification AS meal_type
+            FROM fact_meal fm
+            JOIN dim_time dt ON fm.time_id = dt.time_id
+            WHERE dt.date = %s
+            ORDER BY dt.ts
+            """,
+            (day,),
+        )
+        meals = cur.fetchall()
+        cur.execute(
+            """
+            SELECT dt.ts, dit.insulin_name, dit.insulin_class, fi.units
+            FROM fact_insulin fi
+            JOIN dim_time dt ON fi.time_id = dt.time_id
+            LEFT JOIN dim_insulin_type dit ON fi.insulin_type_id = dit.insulin_type_id
+            WHERE dt.date = %s
+            ORDER BY dt.ts
+            """,
+            (day,),
+        )
+        insulin = cur.fetchall()
+        cur.execute(
+            "SELECT ts, iob, cob FROM fact_iob_cob WHERE ts BETWEEN %s AND %s ORDER BY ts",
+            (start, start + 86400),
+        )
+        on_board = cur.fetchall()
+        cur.execute("SELECT * FROM fact_daily_summary WHERE date = %s", (day,))
+        summary = cur.fetchone()
+    return encode(
+        {
+            "date": day,
+            "version": version,
+            "glucose": glucose,
+            "meals": meals,
+            "insulin": insulin,
+            "iob_cob": on_board,
+            "summary": summary,
+        }
+    )
+
+
+def load_metrics():
+    """Return the JSON-encoded per-bucket mean of every metric over all meals."""
+    with thread_connection().cursor() as cur:
+        stats = compute_metrics(load_data(cur))
+    return encode(
+        {
+            bucket: {metric: values[0] for metric, values in metrics.items()}
+            for bucket, metrics in summarize(stats).items()
+        }
+    )
+
+
+def load_version_log(since):
+    """Return ``(version, changed_from)`` of every bump after *since*."""
+    with thread_connection().cursor() as cur:
+        cur.execute(
+            "SELECT version, changed_from FROM data_version WHERE version > %s ORDER BY version",
+            (since,),
+        )
+        return cur.fetchall()
+
+
+class DataVersions:
+    """Per-day data versions folded from the ``data_version`` log.
+
+    A bump starting at day D changes every day from D on, so it supersedes
+    all earlier bumps starting at D or later. What remains is a staircase of
+    start days and versions that both increase; a day's version is that of
+    the last step on or before it.
+    """
+
+    def __init__(self):
+        self.latest = 0
+        self.starts = []
+        self.versions = []
+
+    def apply(self, rows):
+        for version, changed_from in rows:
+            start = changed_from or date.min
+            cut = bisect_left(self.starts, start)
+            del self.starts[cut:], self.versions[cut:]
+            self.starts.append(start)
+            self.versions.append(version)
+            self.latest = version
+
+    def of(self, day):
+        i = bisect_right(self.starts, day)
+        return self.versions[i - 1] if i else 0
+
+
+class OverviewCache:
+    """LRU cache of day payloads plus the shared bucket metrics."""
+
+    def __init__(self, executor, size=DEFAULT_CACHE_SIZE):
+        self.executor = executor
+        self.size = size
+        self.versions = DataVersions()
+        self.days = OrderedDict()  # date -> (version, encoded payload)
+        self.pending = {}  # (date, version) -> task loading it
+        self.metrics = None
+        self.metrics_version = None
+        self.metrics_pending = {}  # version -> task computing the metrics
+        self.hits = 0
+        self.misses = 0
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def refresh(self):
+        """Apply new data_version rows."""
+        self.versions.apply(await self.run(load_version_log, self.versions.latest))
+
+    async def poll(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh()
+            except Exception as exc:
+                print(f"Refreshing the data version failed: {exc}")
+
+    async def day(self, day):
+        """Return the encoded overview of *day*, loading it on a cache miss.
+
+        Concurrent misses for the same day share one load.
+        """
+        version = self.versions.of(day)
+        cached = self.days.get(day)
+        if cached is not None and cached[0] == version:
+            self.days.move_to_end(day)
+            self.hits += 1
+            return cached[1]
+        key = (day, version)
+        task = self.pending.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self.run(load_day, day, version))
+            self.pending[key] = task
+            task.add_done_callback(lambda _: self.pending.pop(key, None))
+        # A client hanging up must not cancel the load other requests await.
+        body = await asyncio.shield(task)
+        # The version was read before querying, so a newer bump arriving
+        # meanwhile still triggers a reload.
+        if self.versions.of(day) == version:
+            self.days[day] = (version, body)
+            self.days.move_to_end(day)
+            while len(self.days) > self.size:
+                self.days.popitem(last=False)
+        return body
+
+    async def current_metrics(self):
+        """Return the encoded bucket metrics, recomputing them if the latest
+        version moved since they were computed.
+
+        Concurrent requests share one computation.
+        """
+        version = self.versions.latest
+        if self.metrics_version != version:
+            task = self.metrics_pending.get(version)
+            if task is None:
+                task = asyncio.ensure_future(self.run(load_metrics))
+                self.metrics_pending[version] = task
+                task.add_done_callback(lambda _: self.metrics_pending.pop(version, None))
+            metrics = await asyncio.shield(task)
+            if self.metrics_version is None or self.metrics_version < version:
+                self.metrics, self.metrics_version = metrics, version
+        return self.metrics
+
+    async def overview(self, day):
+        metrics, body = await asyncio.gather(self.current_metrics(), self.day(day))
+        # Splice the shared metrics into the cached object instead of
+        # decoding and re-encoding the day payload.
+        return b'{"metrics":' + metrics + b"," + body[1:]
+
+
+def parse_date(value: str):
+    return datetime.fromisoformat(value).date()
+
+
+async def respond(cache, method, target):
+    """Return ``(status, body)`` for one request."""
+    if method != "GET":
+        return 405, encode({"error": "only GET is supported"})
+    url = urlsplit(target)
+    if url.path == "/overview":
+        query = parse_qs(url.query)
+        try:
+            day = parse_date(query["date"][0]) if "date" in query else datetime.now(timezone.utc).date()
+        except ValueError:
+            return 400, encode({"error": "date must be YYYY-MM-DD"})
+        try:
+            return 200, await cache.overview(day)
+        except pymysql.MySQLError as exc:
+            print(f"Loading {day} failed: {exc}")
+            return 500, encode({"error": "database error"})
+    if url.path == "/health":
+        return 200, encode(
+            {
+                "version": cache.versions.latest,
+                "cached_days": len(cache.days),
+                "hits": cache.hits,
+                "misses": cache.misses,
+            }
+        )
+    return 404, encode({"error": "not found"})
+
+
+async def handle(cache, reader, writer):
+    """Serve HTTP/1.1 requests on one connection until the client closes it."""
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            parts = request_line.decode("latin-1").split()
+            if len(parts) != 3:
+                status, body, keep_alive = 400, encode({"error": "malformed request"}), False
+            else:
+                method, target, version = parts
+                status, body = await respond(cache, method, target)
+                # Request bodies are not read, so only bodiless requests keep the connection.
+                keep_alive = (
+                    version == "HTTP/1.1"
+                    and headers.get("connection", "").lower() != "close"
+                    and not headers.get("content-length", "0").strip("0")
+                )
+            writer.write(
+                f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host, port, cache_size, poll_interval, workers):
+    conn = connect_mysql()
+    with conn.cursor() as cur:
+        migrate(cur)
+    conn.close()
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    cache = OverviewCache(executor, cache_size)
+    await cache.refresh()
+    poller = asyncio.ensure_future(cache.poll(poll_interval))
+    server = await asyncio.start_server(lambda r, w: handle(cache, r, w), host, port)
+    print(f"Serving day overviews on http://{host}:{port}/overview (data version {cache.versions.latest})")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        poller.cancel()
+        executor.shutdown(wait=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve cached day overviews as JSON")
+    parser.add_argument("--host", default=DEFAULT_HOST, help=f"Address to listen on (default: {DEFAULT_HOST})")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"Port to listen on (default: {DEFAULT_PORT})")
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=DEFAULT_CACHE_SIZE,
+        help=f"Days kept in memory (default: {DEFAULT_CACHE_SIZE})",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=DEFAULT_POLL_INTERVAL,
+        help=f"Seconds between checks for a new data version (default: {DEFAULT_POLL_INTERVAL})",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help=f"Threads (and MySQL connections) running queries (default: {DEFAULT_WORKERS})",
+    )
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.host, args.port, args.cache_size, args.poll_interval, args.workers))
+    except KeyboardInterrupt:
+        print("Stopped")
+
+
+if __name__ == "__main__":
+    main()
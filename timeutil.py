@@ -0,0 +1,205 @@
+"""Timestamp normalisation shared by the loaders.
+
+Source rows carry times as epoch seconds, milliseconds or microseconds
+(``entries.date``, ``treatments.epocdate``) or as ISO-8601 strings
+(``created_at``). ``parse_time()`` converts a single value and
+``epoch_seconds()`` a whole column at once with NumPy; the ``*_TS_SQL``
+expressions compute the same fact timestamps inside MySQL.
+
+Usage::
+
+    python timeutil.py [ROWS]    # benchmark against the per-row conversion
+"""
+
+import sys
+from datetime import datetime, timedelta, timezone
+
+# Numeric epochs above these are microseconds / milliseconds
+MICROS_THRESHOLD = 1e14
+MILLIS_THRESHOLD = 1e11
+
+# Layouts epoch_seconds() hands to datetime64 in one go, by datetime64 unit;
+# "0" stands for any digit.
+ISO_LAYOUTS = {
+    "s": "0000-00-00T00:00:00",
+    "ms": "0000-00-00T00:00:00.000",
+    "us": "0000-00-00T00:00:00.000000",
+}
+
+# Shift applied to entries.date for the glucose facts and to created_at when
+# deriving treatments.epocdate, to align with the expected timezone.
+OFFSET_MINUTES = 120
+
+# SQL equivalents of parse_time() over the aliased source columns: epoch
+# seconds from entries.date (``e``) shifted by OFFSET_MINUTES, and from
+# treatments.epocdate (``t``).
+GLUCOSE_TS_SQL = (
+    "CAST(FLOOR(CASE WHEN e.date > 1e14 THEN e.date / 1000000 "
+    f"WHEN e.date > 1e11 THEN e.date / 1000 ELSE e.date END + {OFFSET_MINUTES * 60}) AS SIGNED)"
+)
+TREATMENT_TS_SQL = (
+    "CAST(FLOOR(CASE WHEN t.epocdate > 1e14 THEN t.epocdate / 1000000 "
+    "WHEN t.epocdate > 1e11 THEN t.epocdate / 1000 ELSE t.epocdate END) AS SIGNED)"
+)
+
+
+def parse_time(value, offset_minutes=0):
+    """Parse various timestamp formats and apply an optional offset."""
+    if value is None:
+        return None
+    try:
+        # Numeric values are epoch based
+        if isinstance(value, (int, float)):
+            if value > MICROS_THRESHOLD:
+                value = value / 1_000_000.0
+            elif value > MILLIS_THRESHOLD:
+                value = value / 1000.0
+            dt = datetime.fromtimestamp(value, tz=timezone.utc)
+        else:
+            string_value = str(value)
+            if string_value.endswith("Z"):
+                string_value = string_value[:-1] + "+00:00"
+            dt = datetime.fromisoformat(string_value)
+            if dt.tzinfo is None:
+                dt = dt.replace(tzinfo=timezone.utc)
+    except (ValueError, OverflowError, OSError):
+        return None
+
+    if offset_minutes:
+        dt += timedelta(minutes=offset_minutes)
+    return dt
+
+
+def epoch_ms(value, offset_minutes=0):
+    """Return epoch milliseconds for *value* shifted by *offset_minutes*."""
+    dt = parse_time(value, offset_minutes)
+    return int(dt.timestamp() * 1000) if dt else None
+
+
+def _numeric_seconds(values, offset_minutes=0):
+    """Whole seconds of float epochs plus *offset_minutes*, rounded as
+    ``datetime.fromtimestamp`` and truncated as ``int(dt.timestamp())``."""
+    import numpy as np
+
+    scaled = np.where(
+        values > MICROS_THRESHOLD,
+        values / 1_000_000.0,
+        np.where(values > MILLIS_THRESHOLD, values / 1000.0, values),
+    )
+    whole = np.trunc(scaled)
+    micros = np.round((scaled - whole) * 1e6)
+    whole = np.where(micros >= 1e6, whole + 1, np.where(micros < 0, whole - 1, whole))
+    micros = np.where(micros >= 1e6, micros - 1e6, np.where(micros < 0, micros + 1e6, micros))
+    whole += offset_minutes * 60
+    # int(dt.timestamp()) truncates towards zero
+    return np.where((whole < 0) & (micros > 0), whole + 1, whole)
+
+
+def _iso_seconds(texts, offset_minutes=0):
+    """Whole seconds of ISO-8601 strings plus *offset_minutes*.
+
+    Strings in one of the ISO_LAYOUTS, optionally ending in ``Z``, are parsed
+    per layout as ``datetime64``, which rejects impossible dates and times
+    just like parse_time(). Every other string (offsets other than ``Z``,
+    other separators or precisions, anything malformed) goes through
+    parse_time() one by one.
+    """
+    import numpy as np
+
+    column = np.array(texts, dtype=str)
+    result = np.full(len(column), np.nan)
+    done = np.zeros(len(column), dtype=bool)
+    if column.itemsize:
+        # Drop one trailing Z by overwriting it with NUL, which ends a NumPy string.
+        chars = column.view(np.uint32).reshape(len(column), -1).copy()
+        lengths = np.char.str_len(column)
+        zulu = np.flatnonzero(np.char.endswith(column, "Z"))
+        chars[zulu, lengths[zulu] - 1] = 0
+        lengths[zulu] -= 1
+        naive = chars.view(column.dtype).ravel()
+        for unit, layout in ISO_LAYOUTS.items():
+            rows = np.flatnonzero(lengths == len(layout))
+            if not len(rows):
+                continue
+            template = np.array([ord(c) for c in layout], dtype=np.uint32)
+            head = chars[rows, : len(layout)]
+            digit = (head >= ord("0")) & (head <= ord("9"))
+            rows = rows[np.where(template == ord("0"), digit, head == template).all(axis=1)]
+            try:
+                stamps = naive[rows].astype(f"datetime64[{unit}]")
+            except ValueError:
+                # An impossible date or time in the batch; parse_time() sorts it out.
+                continue
+            # datetime64 has a year 0, datetime does not.
+            valid = stamps >= np.datetime64("0001-01-01", unit)
+            rows = rows[valid]
+            micros = stamps[valid].astype("datetime64[us]").astype(np.int64) + offset_minutes * 60_000_000
+            # Same truncation towards zero as int(dt.timestamp())
+            result[rows] = np.where(micros >= 0, micros // 1_000_000, -(-micros // 1_000_000))
+            done[rows] = True
+    for i in np.flatnonzero(~done).tolist():
+        dt = parse_time(texts[i], offset_minutes)
+        if dt is not None:
+            result[i] = int(dt.timestamp())
+    return result
+
+
+def epoch_seconds(values, offset_minutes=0):
+    """Return whole epoch seconds for a column of raw timestamps.
+
+    *values* may hold epoch s/ms/µs numbers, ISO-8601 strings and None. The
+    result is a float64 array with ``int(parse_time(v, offset_minutes).timestamp())``
+    for every element and NaN where parse_time() gives None.
+    """
+    import numpy as np
+
+    values = list(values)
+    try:
+        # All numeric (None becomes NaN): the common case for date/epocdate.
+        result = _numeric_seconds(np.array(values, dtype=np.float64), offset_minutes)
+    except (TypeError, ValueError):
+        if set(map(type, values)) == {str}:
+            return _iso_seconds(values, offset_minutes)
+        result = np.full(len(values), np.nan)
+        numeric = [i for i, v in enumerate(values) if isinstance(v, (int, float))]
+        text = [i for i, v in enumerate(values) if v is not None and not isinstance(v, (int, float))]
+        if numeric:
+            result[numeric] = _numeric_seconds(np.array([values[i] for i in numeric], dtype=np.float64), offset_minutes)
+        if text:
+            result[text] = _iso_seconds([str(values[i]) for i in text], offset_minutes)
+    return result
+
+
+def benchmark(rows=100_000):
+    """Time the per-row conversion against epoch_seconds() and check they agree."""
+    import random
+    import timeit
+
+    rng = random.Random(0)
+    start_ms = 1_700_000_000_000
+    millis = [start_ms + i * 300_000 + rng.randrange(-2000, 2000) for i in range(rows)]
+    iso = [
+        datetime.fromtimestamp(ms / 1000, tz=timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+        for ms in millis
+    ]
+    # A few values with an explicit offset, as older uploaders wrote them.
+    for i in range(0, rows, 97):
+        iso[i] = datetime.fromtimestamp(millis[i] / 1000, tz=timezone(timedelta(hours=2))).isoformat()
+
+    def per_row(value, offset_minutes):
+        dt = parse_time(value, offset_minutes)
+        return int(dt.timestamp()) if dt else None
+
+    for label, column, offset in (("epoch ms", millis, OFFSET_MINUTES), ("ISO-8601", iso, 0)):
+        expected = [per_row(v, offset) for v in column]
+        same = expected == [int(s) for s in epoch_seconds(column, offset).tolist()]
+        row_elapsed = min(timeit.repeat(lambda: [per_row(v, offset) for v in column], number=1, repeat=3))
+        column_elapsed = min(timeit.repeat(lambda: epoch_seconds(column, offset), number=1, repeat=3))
+        print(
+            f"{label}: parse_time {row_elapsed:.3f}s, epoch_seconds {column_elapsed:.3f}s "
+            f"({row_elapsed / column_elapsed:.1f}x) over {rows} values; {'identical' if same else 'MISMATCH'}"
+        )
+
+
+if __name__ == "__main__":
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
@@ -1,95 +1,150 @@
 import os
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import pymysql
-from datetime import datetime, timedelta, timezone
+from timeutil import GLUCOSE_TS_SQL, TREATMENT_TS_SQL
 
 MYSQL_HOST = os.environ.get("MYSQLHOST", "localhost")
 MYSQL_USER = os.environ.get("MYSQLUSER", "root")
 MYSQL_PASSWORD = os.environ.get("MYSQLPW", "")
 MYSQL_DB = os.environ.get("MYSQLDB", "test")
 
-mysql_conn = pymysql.connect(
-    host=MYSQL_HOST,
-    user=MYSQL_USER,
-    password=MYSQL_PASSWORD,
-    database=MYSQL_DB,
-    charset="utf8mb4",
-    autocommit=True,
-)
-cur = mysql_conn.cursor()
+DEFAULT_WORKERS = 4
+# Key ranges per worker, so uneven ranges still spread across the pool
+CHUNKS_PER_WORKER = 4
 
 
-def parse_time(value, offset_minutes=0):
-    if value is None:
-        return None
-    try:
-        if isinstance(value, (int, float)):
-            if value > 1e14:
-                value = value / 1_000_000.0
-            elif value > 1e11:
-                value = value / 1000.0
-            dt = datetime.fromtimestamp(value, tz=timezone.utc)
-        else:
-            string_value = str(value)
-            if string_value.endswith("Z"):
-                string_value = string_value[:-1] + "+00:00"
-            dt = datetime.fromisoformat(string_value)
-            if dt.tzinfo is None:
-                dt = dt.replace(tzinfo=timezone.utc)
-    except Exception:
-        return None
-    if offset_minutes:
-        dt += timedelta(minutes=offset_minutes)
-    return dt
-
-
-def verify_glucose():
-    mismatches = 0
-    cur.execute(
-        "SELECT f.entry_id, f.ts, e.date FROM fact_glucose f JOIN entries e ON f.entry_id = e.mysqlid"
+def connect_mysql():
+    return pymysql.connect(
+        host=MYSQL_HOST,
+        user=MYSQL_USER,
+        password=MYSQL_PASSWORD,
+        database=MYSQL_DB,
+        charset="utf8mb4",
+        autocommit=True,
     )
-    for entry_id, ts, date_val in cur.fetchall():
-        dt = parse_time(date_val, offset_minutes=120)
-        if not dt:
-            continue
-        if int(dt.timestamp()) != ts:
-            mismatches += 1
-            print(f"Glucose mismatch id={entry_id}: {dt.timestamp()} vs {ts}")
-    return mismatches
 
 
-def verify_treatments():
-    mismatches = 0
-    cur.execute(
-        "SELECT f.treatment_id, f.ts, t.epocdate FROM fact_meal f JOIN treatments t ON f.treatment_id = t.mysqlid"
-    )
-    for tid, ts, epocdate in cur.fetchall():
-        dt = parse_time(epocdate)
-        if not dt:
-            continue
-        if int(dt.timestamp()) != ts:
-            mismatches += 1
-            print(f"Meal mismatch id={tid}: {dt.timestamp()} vs {ts}")
-    cur.execute(
-        "SELECT fi.treatment_id, fi.ts, t.epocdate FROM fact_insulin fi JOIN treatments t ON fi.treatment_id = t.mysqlid"
+def parse_fraction(value: str) -> float:
+    try:
+        fraction = float(value)
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(f"Invalid fraction: {value}") from exc
+    if not 0 < fraction <= 1:
+        raise argparse.ArgumentTypeError(f"Fraction must be in (0, 1]: {value}")
+    return fraction
+
+
+# name: (joined tables, key column, expected ts, source not null). The
+# expected timestamps are timeutil's SQL equivalents of parse_time().
+CHECKS = {
+    "Glucose": (
+        "fact_glucose f JOIN entries e ON f.entry_id = e.mysqlid",
+        "f.entry_id",
+        GLUCOSE_TS_SQL,
+        "e.date IS NOT NULL",
+    ),
+    "Meal": (
+        "fact_meal f JOIN treatments t ON f.treatment_id = t.mysqlid",
+        "f.treatment_id",
+        TREATMENT_TS_SQL,
+        "t.epocdate IS NOT NULL",
+    ),
+    "Insulin": (
+        "fact_insulin f JOIN treatments t ON f.treatment_id = t.mysqlid",
+        "f.treatment_id",
+        TREATMENT_TS_SQL,
+        "t.epocdate IS NOT NULL",
+    ),
+}
+
+
+def key_ranges(cur, name, chunks):
+    tables, key, _, _ = CHECKS[name]
+    cur.execute(f"SELECT MIN({key}), MAX({key}) FROM {tables}")
+    low, high = cur.fetchone()
+    if low is None:
+        return []
+    step = max(1, (high - low + chunks) // chunks)
+    return [(lo, min(lo + step - 1, high)) for lo in range(low, high + 1, step)]
+
+
+def offset_histogram(name, low, high, sample=None):
+    """Count ``expected - stored`` timestamp offsets for one key range."""
+    tables, key, expected, not_null = CHECKS[name]
+    query = (
+        f"SELECT {expected} - f.ts AS off, COUNT(*) FROM {tables} "
+        f"WHERE {not_null} AND {key} BETWEEN %s AND %s"
     )
-    for tid, ts, epocdate in cur.fetchall():
-        dt = parse_time(epocdate)
-        if not dt:
-            continue
-        if int(dt.timestamp()) != ts:
-            mismatches += 1
-            print(f"Insulin mismatch id={tid}: {dt.timestamp()} vs {ts}")
+    params = [low, high]
+    if sample is not None:
+        query += " AND RAND() < %s"
+        params.append(sample)
+    query += " GROUP BY off"
+    conn = connect_mysql()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(query, params)
+            return Counter({off: count for off, count in cur.fetchall()})
+    finally:
+        conn.close()
+
+
+def describe_offset(off):
+    if off is None:
+        return "missing ts"
+    if off % 60 == 0:
+        return f"{off:+d}s ({off // 60:+d} min)"
+    return f"{off:+d}s"
+
+
+def verify(name, workers, sample=None):
+    """Check one fact table and print a histogram of its offset errors.
+
+    Returns the number of mismatching rows.
+    """
+    conn = connect_mysql()
+    with conn.cursor() as cur:
+        ranges = key_ranges(cur, name, workers * CHUNKS_PER_WORKER)
+    conn.close()
+
+    histogram = Counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for part in pool.map(lambda r: offset_histogram(name, r[0], r[1], sample), ranges):
+            histogram.update(part)
+
+    checked = sum(histogram.values())
+    mismatches = checked - histogram.get(0, 0)
+    print(f"{name}: {checked} rows checked, {mismatches} mismatches")
+    errors = [(off, count) for off, count in histogram.items() if off != 0]
+    for off, count in sorted(errors, key=lambda item: -item[1])[:10]:
+        print(f"  {describe_offset(off)}: {count}")
+    if len(errors) > 10:
+        print(f"  ... {len(errors) - 10} more offsets")
     return mismatches
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Check star-schema timestamps against the source tables")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help=f"Parallel connections checking key ranges (default: {DEFAULT_WORKERS})",
+    )
+    parser.add_argument(
+        "--sample",
+        type=parse_fraction,
+        help="Only check this random fraction of rows, e.g. 0.01",
+    )
+    args = parser.parse_args()
+
     total = 0
-    total += verify_glucose()
-    total += verify_treatments()
+    for name in CHECKS:
+        total += verify(name, args.workers, args.sample)
     if total == 0:
         print("All timestamps match.")
-    cur.close()
-    mysql_conn.close()
 
 if __name__ == "__main__":
     main()